@@ -1,7 +1,7 @@
 #!/usr/bin/python
 #
-# Usage: 
-#         arpgraph_from_json.py FILE
+# Usage:
+#         DataToUsage.py [options] FILE [FILE ...]
 
 # JSON Format (that matters, you can ignore the rest)
 #{
@@ -9,83 +9,563 @@
 #    "m" : "192.168.168.1 is at 00:13:10:1a:a2:88",   # ARP Message
 #    "s" : "00:13:10:1a:a2:88",                       # Source MAC
 #    "pk" : 377,                                      # Number of times this happened
-#    "te" : 1361939174.023005,                        
+#    "te" : 1361939174.023005,
 #    "tb" : 1361917125.970395,
 #}
+#
+# The capture is streamed: it's read a chunk at a time, only s/d/pk are kept
+# from each document, and the graph is written out a node or link at a time.
+# Memory use depends on the number of distinct MACs and links, not on the size
+# of the capture.
+#
+# With --jobs, the captures are cut into shards on line boundaries and each
+# shard is aggregated in its own process.  The partial tables are merged back
+# together in input order, so the node numbering is the same as a single
+# process run over the same files.
+#
+# The graph itself is kept in a trafmongo.arpgraph.ARPEdgeTable: MACs are
+# interned as integers and links are packed into array columns.  It's written
+# straight from those columns, as json or (--format binary) in the compact
+# binary format described in trafmongo/arpgraph.py.
+#
+# With --state, the aggregation (node numbering, link weights and how far into
+# the capture we got) is saved to a snapshot file after each run, and the next
+# run only reads lines appended since.  --follow keeps doing that every few
+# seconds, rewriting the output each time.
+#
+# With --window, records are put into time windows using tb/te, and a graph is
+# made for each window in the same single pass over the captures.  A record
+# counts, in full, toward every window its [tb, te] overlaps.  Windows are
+# tumbling unless --slide is given, and are aligned to the epoch.
+#
+# With --top or --min-weight, links are counted in a fixed-size summary rather
+# than kept exactly (see trafmongo.arpgraph.HeavyLinkSummary), and only the
+# heaviest links and the nodes they touch are written.  The summary's error
+# bound goes in the output as "approximation".
 
+import math
+import os
 import sys
-import json
-
-# Get the command line arguements
-# See http://docs.python.org/2/library/sys.html#sys.argv
-# Example usage `./test.py filename.json`
-filename = sys.argv[1]  # filename.json
-
-# Open the file given by the command line argument
-# See http://docs.python.org/2/library/functions.html#open
-data_file = open(filename)
-
-mac_to_number = {}  # { "00:1e:37:d2:f1:55": 0, "00:13:10:1a:a2:88": 1 ... }
-new_mac_number = 0
-macs_to_count = {}
-# Loop through each line in the file.  Each line is a json document.
-for line in data_file:
-    #print line
-    # Parse each json document ( json.loads(line) , I think). This will turn json text into python dictionaries and lists.
-    jsondoc = json.loads(line)
-    # Get the two addresses
-    macto = jsondoc['d']
-    macfrom = jsondoc['s']
-    # For each IP address, you need to find or make up it's number. What I would do is create a dictionary where the key is the IP address and the value is the number.  For each IP address, get the number from ip_to_number, or, if it's not there, add it yourself.
-    # mac_to_number["00:1e:37:d2:f1:55"] = 0
-    if not macto in mac_to_number:  
-        mac_to_number[macto] = new_mac_number  #  <-- This is the form you want
-        new_mac_number += 1
-        
-    if not macfrom in mac_to_number:
-        mac_to_number[macfrom] = new_mac_number        #  <-- this should be like the above, but make sure new_mac_number gets updated!
-        new_mac_number = new_mac_number+1
-    
-    # Generate Key
-    linkkey = [macto, macfrom]
-    linkkey.sort()
-    linkkey = tuple(linkkey)
-    
-    linkstrength = jsondoc['pk']
-    if linkkey in macs_to_count:
-        macs_to_count[linkkey] += linkstrength
-    else:
-        macs_to_count[linkkey] = linkstrength
+import time
+import cPickle as pickle
+from multiprocessing import Pool
+from optparse import OptionParser
+
+from trafmongo.arpgraph import (ARPEdgeTable, HeavyLinkSummary,
+                                write_graph_json, write_graph_binary)
+
+# ujson is much faster at this than the stdlib, and is already one of our
+# requirements.  Fall back to the stdlib so the script still works without it.
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+# How much of the capture to read at once.
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024 # Bytes
+
+# How big a piece of a capture each worker process gets in parallel mode.
+DEFAULT_SHARD_SIZE = 64 * 1024 * 1024 # Bytes
+
+# How many links the heavy hitter summary tracks, unless told otherwise.
+DEFAULT_COUNTERS = 100000
+
+def iter_lines(data_file, chunk_size=DEFAULT_CHUNK_SIZE, length=None):
+    """
+    Yields each line of data_file, reading chunk_size bytes at a time. A line
+    split across two chunks is carried over to the next one.  If length is
+    given, stops after that many bytes.
+    """
+    leftover = ''
+    while length is None or length > 0:
+        if length is None:
+            chunk = data_file.read(chunk_size)
+        else:
+            chunk = data_file.read(min(chunk_size, length))
+            length -= len(chunk)
+        if not chunk:
+            break
+
+        lines = (leftover + chunk).split('\n')
+        leftover = lines.pop()
+        for line in lines:
+            yield line
+
+    if leftover:
+        yield leftover
+
+def iter_records(data_file, chunk_size=DEFAULT_CHUNK_SIZE, length=None):
+    """
+    Yields (source, destination, count) from each json document in data_file.
+    Everything else in the document is thrown away right away.
+    """
+    loads = json.loads
+    for line in iter_lines(data_file, chunk_size, length):
+        if not line.strip():
+            continue
+
+        jsondoc = loads(line)
+        yield jsondoc['s'], jsondoc['d'], jsondoc['pk']
+
+def iter_timed_records(data_file, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Like iter_records, but yields (source, destination, count, tb, te).
+    """
+    loads = json.loads
+    for line in iter_lines(data_file, chunk_size):
+        if not line.strip():
+            continue
+
+        jsondoc = loads(line)
+        yield (jsondoc['s'], jsondoc['d'], jsondoc['pk'],
+               jsondoc['tb'], jsondoc['te'])
+
+def split_file(filename, shard_size=DEFAULT_SHARD_SIZE):
+    """
+    Cuts filename into (filename, offset, length) shards of about shard_size
+    bytes.  Every shard starts at the beginning of a line.
+    """
+    size = os.path.getsize(filename)
+    offsets = [0]
+    data_file = open(filename, 'rb')
+    try:
+        while offsets[-1] + shard_size < size:
+            # Move the cut forward to just past the next newline.
+            data_file.seek(offsets[-1] + shard_size)
+            data_file.readline()
+            offset = data_file.tell()
+            if offset >= size:
+                break
+            offsets.append(offset)
+    finally:
+        data_file.close()
+
+    offsets.append(size)
+    return [(filename, start, end - start)
+            for start, end in zip(offsets, offsets[1:])]
+
+def aggregate_shard(shard, chunk_size=DEFAULT_CHUNK_SIZE,
+                    factory=ARPEdgeTable, factory_args=()):
+    """
+    Builds the partial graph for a single (filename, offset, length) shard
+    with factory(*factory_args), an ARPEdgeTable or a HeavyLinkSummary.  Runs
+    in a worker process, so it returns plain data rather than a table.
+    """
+    filename, offset, length = shard
+    table = factory(*factory_args)
+    data_file = open(filename, 'rb')
+    try:
+        data_file.seek(offset)
+        table.add_all(iter_records(data_file, chunk_size, length))
+    finally:
+        data_file.close()
+
+    return table.partial()
+
+def _aggregate_shard_star(args):
+    # Pool.imap only passes a single argument.
+    return aggregate_shard(*args)
+
+def build_parallel(filenames, jobs, shard_size=DEFAULT_SHARD_SIZE,
+                   chunk_size=DEFAULT_CHUNK_SIZE, factory=ARPEdgeTable,
+                   factory_args=()):
+    """
+    Aggregates filenames with a pool of jobs processes and merges the partial
+    results, in input order, into a single table.
+    """
+    shards = []
+    for filename in filenames:
+        shards.extend(split_file(filename, shard_size))
+
+    table = factory(*factory_args)
+    pool = Pool(jobs)
+    try:
+        # imap hands back results in shard order, which keeps the numbering
+        # stable, while letting the workers run ahead of the merge.
+        work = [(shard, chunk_size, factory, factory_args) for shard in shards]
+        for partial in pool.imap(_aggregate_shard_star, work):
+            table.merge(*partial)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return table
+
+def build_serial(filenames, chunk_size=DEFAULT_CHUNK_SIZE,
+                 factory=ARPEdgeTable, factory_args=()):
+    """
+    Aggregates filenames, one after the other, in this process.
+    """
+    table = factory(*factory_args)
+    for filename in filenames:
+        data_file = open(filename, 'rb')
+        try:
+            table.add_all(iter_records(data_file, chunk_size))
+        finally:
+            data_file.close()
+
+    return table
 
 ###
-#print mac_to_number
-#print macs_to_count
+# Time windows
 
-# End the loop.  At the point, link_counts looks like with this:
-#   {(0, 1): count_number, (0,2): count_number, (1,2): count_number ...}
-#
+class WindowedGraphs(object):
+    """
+    One ARPEdgeTable per time window.  Window k covers
+    [k * slide, k * slide + size); with slide == size the windows tumble.
+    """
+    def __init__(self, size, slide=None):
+        if slide is None:
+            slide = size
+        if size <= 0 or slide <= 0:
+            raise ValueError("Window size and slide must be positive")
+        self.size = size
+        self.slide = slide
+        self.tables = {}    # k -> ARPEdgeTable
+
+    def windows(self, tb, te):
+        """
+        Returns the range of window numbers that [tb, te] overlaps.  As with
+        InfoTimeframe, a record overlaps a window if it begins before the
+        window ends and doesn't end before the window begins.
+        """
+        first = int(math.floor((tb - self.size) / self.slide)) + 1
+        last = int(math.floor(te / self.slide))
+        return xrange(first, last + 1)
+
+    def add(self, macfrom, macto, linkstrength, tb, te):
+        tables = self.tables
+        for k in self.windows(tb, te):
+            table = tables.get(k)
+            if table is None:
+                table = tables[k] = ARPEdgeTable()
+            table.add(macfrom, macto, linkstrength)
+
+    def add_all(self, records):
+        for macfrom, macto, linkstrength, tb, te in records:
+            self.add(macfrom, macto, linkstrength, tb, te)
+
+    def iter_windows(self):
+        """
+        Yields (start, end, table) for each window with any data, in time
+        order.
+        """
+        for k in sorted(self.tables):
+            start = k * self.slide
+            yield start, start + self.size, self.tables[k]
+
+def build_windowed(filenames, size, slide=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Aggregates filenames into per-window tables in one pass.
+    """
+    graphs = WindowedGraphs(size, slide)
+    for filename in filenames:
+        data_file = open(filename, 'rb')
+        try:
+            graphs.add_all(iter_timed_records(data_file, chunk_size))
+        finally:
+            data_file.close()
+
+    return graphs
+
+def write_windows(out, graphs):
+    """
+    Writes every window to out as a json list of graphs, each with its
+    "start" and "end" times.
+    """
+    out.write('[')
+    separator = ''
+    for start, end, table in graphs.iter_windows():
+        out.write(separator)
+        write_graph_json(out, table, (('start', start), ('end', end)))
+        separator = ', '
+    out.write(']\n')
+
+def write_window_dir(directory, graphs, format='json'):
+    """
+    Writes each window to its own file in directory, named for its start time.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for start, end, table in graphs.iter_windows():
+        filename = os.path.join(directory, '%d.%s' % (start, FORMATS[format]))
+        replace_file(filename, lambda out: write_graph(
+            out, table, format, (('start', start), ('end', end))))
+
+###
+# Snapshots and tailing
+
+# Bump this when the layout of the snapshot changes.
+STATE_VERSION = 1
+
+def last_line_end(data_file, start, end, chunk_size=64 * 1024):
+    """
+    Returns the offset just past the last newline between start and end, or
+    start if there isn't one.  Used so that a line still being written is
+    left for the next run.
+    """
+    position = end
+    while position > start:
+        step = min(chunk_size, position - start)
+        data_file.seek(position - step)
+        chunk = data_file.read(step)
+        newline = chunk.rfind('\n')
+        if newline >= 0:
+            return position - step + newline + 1
+        position -= step
+    return start
+
+def load_state(state_filename, filename):
+    """
+    Returns (table, offset, inode) from a snapshot, or a fresh table and
+    offset 0 if there isn't one yet.
+    """
+    table = ARPEdgeTable()
+    if not os.path.exists(state_filename):
+        return table, 0, None
+
+    state_file = open(state_filename, 'rb')
+    try:
+        state = pickle.load(state_file)
+    finally:
+        state_file.close()
+
+    if state.get('version') != STATE_VERSION:
+        raise ValueError(state_filename + " is not a snapshot this version"
+                         + " of DataToUsage.py can read.")
+    if state['filename'] != os.path.abspath(filename):
+        raise ValueError(state_filename + " is a snapshot of "
+                         + state['filename'] + ", not " + filename)
+
+    table.merge(*state['table'])
+    return table, state['offset'], state['inode']
+
+def save_state(state_filename, filename, table, offset, inode):
+    """
+    Atomically replaces the snapshot at state_filename.
+    """
+    state = {
+        'version': STATE_VERSION,
+        'filename': os.path.abspath(filename),
+        'inode': inode,
+        'offset': offset,
+        'table': table.partial(),
+    }
+    replace_file(state_filename,
+                 lambda out: pickle.dump(state, out, pickle.HIGHEST_PROTOCOL))
+
+def ingest_appended(table, filename, offset, inode,
+                    chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Adds the complete lines appended to filename since offset.  Returns the
+    new (offset, inode).  If the file was truncated or replaced (rotated),
+    it's read again from the start, on top of what's been aggregated so far.
+    """
+    data_file = open(filename, 'rb')
+    try:
+        stat = os.fstat(data_file.fileno())
+        if (inode is not None and stat.st_ino != inode) or stat.st_size < offset:
+            sys.stderr.write(filename + " was truncated or rotated, reading"
+                             + " it from the start.\n")
+            offset = 0
+
+        end = last_line_end(data_file, offset, stat.st_size)
+        data_file.seek(offset)
+        table.add_all(iter_records(data_file, chunk_size, end - offset))
+    finally:
+        data_file.close()
+
+    return end, stat.st_ino
+
+def replace_file(filename, write):
+    """
+    Calls write(fileobj) on a temporary file, then moves it over filename,
+    so that readers never see a half-written file.
+    """
+    temp_filename = filename + '.tmp'
+    out = open(temp_filename, 'wb')
+    try:
+        write(out)
+    finally:
+        out.close()
+    os.rename(temp_filename, filename)
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options] FILE [FILE ...]")
+    parser.add_option("-o", "--output", metavar="FILE",
+                      help="Write the graph to FILE instead of stdout")
+    parser.add_option("--chunk-size", type="int", default=DEFAULT_CHUNK_SIZE,
+                      metavar="BYTES",
+                      help="Read the capture BYTES at a time [%default]")
+    parser.add_option("-j", "--jobs", type="int", default=1,
+                      help="Aggregate with JOBS worker processes [%default]")
+    parser.add_option("--shard-size", type="int", default=DEFAULT_SHARD_SIZE,
+                      metavar="BYTES",
+                      help="Give each worker BYTES of capture at a time "
+                           "[%default]")
+    parser.add_option("--state", metavar="FILE",
+                      help="Resume from, and save progress to, the snapshot "
+                           "FILE.  Only lines appended since the last run are "
+                           "read.")
+    parser.add_option("-f", "--follow", type="float", metavar="SECONDS",
+                      help="With --state, keep reading new lines and rewrite "
+                           "the output every SECONDS")
+    parser.add_option("-w", "--window", type="int", metavar="SECONDS",
+                      help="Make a graph for each SECONDS long window of "
+                           "time, using tb/te")
+    parser.add_option("--slide", type="int", metavar="SECONDS",
+                      help="With --window, start a new window every SECONDS "
+                           "(sliding windows) [the window size]")
+    parser.add_option("--window-dir", metavar="DIR",
+                      help="With --window, write each window to DIR/START.json "
+                           "instead of a single list of graphs")
+    parser.add_option("--top", type="int", metavar="N",
+                      help="Only write the N heaviest links, found with a "
+                           "bounded-memory summary")
+    parser.add_option("--min-weight", type="int", metavar="PACKETS",
+                      help="Only write links weighing at least PACKETS, found "
+                           "with a bounded-memory summary")
+    parser.add_option("--counters", type="int", metavar="N",
+                      help="With --top or --min-weight, track N links at once "
+                           "[%d, or 10 times --top if that's more]"
+                           % DEFAULT_COUNTERS)
+    parser.add_option("--format", type="choice", choices=sorted(FORMATS),
+                      default="json",
+                      help="Write the graph as json or binary [%default]")
+    options, args = parser.parse_args(argv)
+
+    if len(args) < 1:
+        parser.error("Expected at least one FILE")
+    if options.chunk_size < 1:
+        parser.error("--chunk-size must be positive")
+    if options.jobs < 1:
+        parser.error("--jobs must be positive")
+    if options.shard_size < 1:
+        parser.error("--shard-size must be positive")
+    if options.state is not None:
+        if len(args) != 1:
+            parser.error("--state works with exactly one FILE")
+        if options.jobs != 1:
+            parser.error("--state can't be combined with --jobs")
+    if options.follow is not None:
+        if options.state is None or options.output is None:
+            parser.error("--follow needs --state and --output")
+        if options.follow <= 0:
+            parser.error("--follow must be positive")
+
+    if options.window is not None:
+        if options.window <= 0 or (options.slide is not None
+                                   and options.slide <= 0):
+            parser.error("--window and --slide must be positive")
+        if options.state is not None or options.jobs != 1:
+            parser.error("--window can't be combined with --state or --jobs")
+        if options.format != 'json' and options.window_dir is None:
+            parser.error("--window writes a single json list unless "
+                         "--window-dir is given")
+    elif options.slide is not None or options.window_dir is not None:
+        parser.error("--slide and --window-dir need --window")
+
+    heavy = options.top is not None or options.min_weight is not None
+    if heavy:
+        if options.top is not None and options.top < 1:
+            parser.error("--top must be positive")
+        if options.counters is None:
+            options.counters = max(DEFAULT_COUNTERS, 10 * (options.top or 0))
+        if options.counters < 1:
+            parser.error("--counters must be positive")
+        if options.window is not None or options.state is not None:
+            parser.error("--top and --min-weight can't be combined with "
+                         "--window or --state")
+    elif options.counters is not None:
+        parser.error("--counters needs --top or --min-weight")
+
+    if heavy:
+        if options.jobs == 1:
+            summary = build_serial(args, options.chunk_size, HeavyLinkSummary,
+                                   (options.counters,))
+        else:
+            summary = build_parallel(args, options.jobs, options.shard_size,
+                                     options.chunk_size, HeavyLinkSummary,
+                                     (options.counters,))
+        table = summary.to_table(options.top, options.min_weight or 0)
+        approximation = summary.error_bound()
+        if options.format != 'json':
+            sys.stderr.write("approximation: %r\n" % approximation)
+        write_output(options.output, table, options.format,
+                     (('approximation', approximation),))
+        return
+
+    if options.window is not None:
+        graphs = build_windowed(args, options.window, options.slide,
+                                options.chunk_size)
+        if options.window_dir is not None:
+            write_window_dir(options.window_dir, graphs, options.format)
+        elif options.output is None:
+            write_windows(sys.stdout, graphs)
+        else:
+            replace_file(options.output,
+                         lambda out: write_windows(out, graphs))
+        return
+
+    if options.state is not None:
+        tail(args[0], options.state, options.output, options.follow,
+             options.chunk_size, options.format)
+        return
+
+    if options.jobs == 1:
+        table = build_serial(args, options.chunk_size)
+    else:
+        table = build_parallel(args, options.jobs, options.shard_size,
+                               options.chunk_size)
+
+    write_output(options.output, table, options.format)
+
+# Output formats, and the file extension for each.
+FORMATS = {'json': 'json', 'binary': 'arpg'}
+
+def write_graph(out, table, format='json', header=()):
+    """
+    Writes the graph to out.  The binary format has no room for header.
+    """
+    if format == 'binary':
+        write_graph_binary(out, table)
+    else:
+        write_graph_json(out, table, header)
+        out.write('\n')
+
+def write_output(output, table, format='json', header=()):
+    """
+    Writes the graph to the output filename, or stdout if that's None.
+    """
+    if output is None:
+        write_graph(sys.stdout, table, format, header)
+    else:
+        replace_file(output,
+                     lambda out: write_graph(out, table, format, header))
+
+def tail(filename, state_filename, output, interval, chunk_size,
+         format='json'):
+    """
+    Brings the snapshot up to date with filename and writes the graph.  With
+    an interval, keeps doing so every interval seconds until interrupted.
+    """
+    table, offset, inode = load_state(state_filename, filename)
+    try:
+        while True:
+            offset, inode = ingest_appended(table, filename, offset, inode,
+                                            chunk_size)
+            save_state(state_filename, filename, table, offset, inode)
+            write_output(output, table, format)
+
+            if interval is None:
+                break
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        # The last snapshot saved is still consistent, so the next run picks
+        # up from there.
+        if interval is None:
+            raise
 
-# Now, using the two dictionaries, generate nodes (from ip_to_number) and links (from link_counts).  Save them to a file. The file should have a structure like arp_graph.
-nodes_tup = list(mac_to_number.items())
-# http://stackoverflow.com/questions/3121979/how-to-sort-list-tuple-of-lists-tuples
-nodes_tup.sort(key=lambda inner: inner[1])
-
-nodes = []
-for node in nodes_tup:
-    nodes.append({
-        "name": node[0]
-    })
-
-links = []
-for macs, value in macs_to_count.items():
-    links.append({
-        "source": mac_to_number[macs[0]],
-        "target": mac_to_number[macs[1]],
-        "value": value
-    })
-    
-
-print json.dumps({
-    "nodes": nodes,
-    "links": links
-})
+if __name__ == '__main__':
+    main()
@@ -43,6 +43,10 @@ setup(name='TrafMongo',
       entry_points = """\
       [paste.app_factory]
       main = trafmongo:main
+
+      [console_scripts]
+      trafmongo-arp-rollup = trafmongo.scripts:arp_rollup
+      trafmongo-ensure-indexes = trafmongo.scripts:ensure_indexes
       """,
       paster_plugins=['pyramid'],
       )
@@ -1,10 +1,19 @@
 from pyramid.config import Configurator
 from pyramid.events import subscriber
 from pyramid.events import NewRequest
+from pyramid.settings import asbool
 from trafmongo.resources import Root
+from trafmongo.indexes import IndexChecker, ensure_indexes
+from trafmongo.arpgraph_commands import ARP_GRAPH_FLIGHTS
+from trafmongo.cache import private_directory
 import pymongo
 from ConfigParser import SafeConfigParser
 
+# Where the traffic database lives.
+DB_URI = 'localhost'
+DB_PORT = 27017
+DB_NAME = "traffic1"
+
 def main(global_config, **settings):
     """
     This function returns a Pyramid WSGI application.
@@ -12,15 +21,57 @@ def main(global_config, **settings):
 
     # Modified from the pyramid cookbook
     # Generate persistence objects
-    db_uri = 'localhost'
-    db_port = 27017
-    db_name = "traffic1"
-    conn = pymongo.Connection(db_uri, db_port)
-    db = conn[db_name]
+    conn = pymongo.Connection(DB_URI, DB_PORT)
+    db = conn[DB_NAME]
+
+    # Indexes.  trafmongo.ensure_indexes creates any that are missing (in the
+    # background) on startup.  trafmongo.index_check is "off", "warn" to log
+    # queries that would scan a whole collection, or "strict" to refuse them.
+    if asbool(settings.get('trafmongo.ensure_indexes', False)):
+        ensure_indexes(db)
+    index_check = settings.get('trafmongo.index_check', 'warn')
+    if index_check not in ('off', 'warn', 'strict'):
+        raise ValueError("trafmongo.index_check must be off, warn or strict")
+    index_checker = None
+    if index_check != 'off':
+        index_checker = IndexChecker(db, strict=(index_check == 'strict'))
+
+    # How long, in seconds, an API request's queries get before they're
+    # abandoned, and whether to send what was found in that time rather than
+    # an error.
+    query_budget = float(settings.get('trafmongo.query_budget', 30))
+    partial_results = asbool(settings.get('trafmongo.partial_results', False))
+
+    # How many chunks to split long graph queries into, to run at once (see
+    # ARPGraphCommand).  Each takes a thread from the shared pool, and a
+    # connection.
+    query_shards = int(settings.get('trafmongo.query_shards', 1))
+
+    # The fraction of API requests to profile (see profiling.py), and
+    # whether any that ask with ?profile=1 are too.  Profiling runs each
+    # query again, so anyone able to ask could double the load on mongo.
+    profile_sample_rate = float(settings.get('trafmongo.profile_sample_rate',
+                                             0))
+    profile_on_request = asbool(settings.get('trafmongo.profile_on_request',
+                                             False))
+
+    # Identical queries running at once in different workers are run once,
+    # if the workers are given a directory to coordinate through.  Results
+    # are passed through it, so it has to be private to the app's user
+    # (mode 0700), or the app won't start.
+    coalesce_dir = settings.get('trafmongo.coalesce_dir')
+    if coalesce_dir:
+        ARP_GRAPH_FLIGHTS.lock_dir = private_directory(coalesce_dir)
 
     # Store persistence objects for use during requests
     settings['db_conn'] = conn
     settings['db'] = db
+    settings['index_checker'] = index_checker
+    settings['query_budget'] = query_budget
+    settings['partial_results'] = partial_results
+    settings['query_shards'] = query_shards
+    settings['profile_sample_rate'] = profile_sample_rate
+    settings['profile_on_request'] = profile_on_request
 
     config = Configurator(root_factory=Root, settings=settings)
     config.add_static_view('static', 'trafmongo:static')
@@ -40,3 +91,4 @@ def add_mongo_db(event):
     """
     settings = event.request.registry.settings
     event.request.db = settings['db']
+    event.request.index_checker = settings['index_checker']
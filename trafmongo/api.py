@@ -1,8 +1,23 @@
+from __future__ import with_statement
+
 from pyramid.view import view_config
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
 from trafmongo import resources 
 #from trafmongo.parse import TrafficTimeseriesParser, TrafficTableParser, HostByIPParser
 from trafmongo.db_schema import Timeframe, HotDataFormat
-from trafmongo.arpgraph_commands import ARPGraphCommandFactory
+from trafmongo.commands import CommandTimeout
+from trafmongo.arpgraph_commands import (ARPGraphLayoutCommandFactory,
+                                         ARPGraphCoarsenCommandFactory,
+                                         ARPGraphDeltaCommandFactory)
+from trafmongo.parse import ARPGraphCoarsenParser, ARPGraphDeltaParser
+from trafmongo.arpgraph import iter_graph_json
+from trafmongo.streaming import iter_envelope, streaming_json_response
+from trafmongo.profiling import profiler_for
 
 #XXX: These were to be classes, but Python 2.5 doesn't support class decorators
 #class PyramidView(object):
@@ -13,25 +28,100 @@ from trafmongo.arpgraph_commands import ARPGraphCommandFactory
 #    def __call__(self):
 #        return NotImplementedError
 
-@view_config(name='', renderer='json', context=resources.ARPGraphData)
+def set_budget(options, request):
+    """
+    Gives the request's commands the configured time budget, and the number
+    of shards to split long queries into.
+    """
+    settings = request.registry.settings
+    options['budget'] = settings.get('query_budget')
+    options['allow_partial'] = settings.get('partial_results', False)
+    options['shards'] = settings.get('query_shards', 1)
+
+def request_profiler(request):
+    """
+    Returns the profiler for a request: a real one if it was sampled, or
+    asked (?profile=1) and that's allowed, otherwise one that does nothing.
+    """
+    settings = request.registry.settings
+    return profiler_for(request, settings.get('profile_sample_rate', 0.0),
+                        on_request=settings.get('profile_on_request', False))
+
+@view_config(context=CommandTimeout, renderer='json')
+def CommandTimeoutView(exc, request):
+    # Fail fast, and say so, rather than hold the worker.
+    request.response.status = '504 Gateway Timeout'
+    return {"error": str(exc)}
+
+@view_config(name='', context=resources.ARPGraphData)
 def ARPGraphView(context, request):
     #parser = TrafficTimeseriesParser()
     #subfactory = InOutTimeseriesCommandFactory
 
+    profiler = request_profiler(request)
+
+    # Parse user input
+    with profiler.phase("parse"):
+        parser = ARPGraphCoarsenParser()
+        options = parser.parse(request)
+    options['db'] = context.db
+    options['index_checker'] = context.request.index_checker
+    options['profiler'] = profiler
+    set_budget(options, request)
+
+    # Build and run command
+    with profiler.phase("execute"):
+        if 'coarsen' in options:
+            factory = ARPGraphCoarsenCommandFactory(options)
+        else:
+            factory = ARPGraphLayoutCommandFactory(options)
+        command = factory.create_command()
+        command.execute()
+    if profiler.enabled:
+        command.debug_info['profile'] = profiler.report
+
+    # Graphs can be big, so they're streamed out a chunk at a time rather
+    # than going through the json renderer in one piece.  Coarse graphs are
+    # small by design.  Data is written before debug, so the time spent
+    # serializing it makes it into the profile.
+    if 'coarsen' in options:
+        graph = [json.dumps(command.annotated_results)]
+    else:
+        graph = iter_graph_json(command.annotated_results,
+                                positions=command.positions)
+    graph = profiler.iter_phase("serialize", graph)
+    results = iter_envelope(graph,
+                            debug=command.debug_info,
+                            request=dict(request.GET))
+
+    return streaming_json_response(request, results)
+
+@view_config(name='', context=resources.ARPGraphDeltaData)
+def ARPGraphDeltaView(context, request):
+    profiler = request_profiler(request)
+
     # Parse user input
-    #options = parser.parse(request)
-    options = request.GET
-    #options['db'] = context.db
+    with profiler.phase("parse"):
+        parser = ARPGraphDeltaParser()
+        options = parser.parse(request)
+    options['db'] = context.db
+    options['index_checker'] = context.request.index_checker
+    options['profiler'] = profiler
+    set_budget(options, request)
 
     # Build and run command
-    factory = ARPGraphCommandFactory(options)
-    command = factory.create_command()
-    command.execute()
+    with profiler.phase("execute"):
+        factory = ARPGraphDeltaCommandFactory(options)
+        command = factory.create_command()
+        command.execute()
+    if profiler.enabled:
+        command.debug_info['profile'] = profiler.report
 
-    results = {
-        "data": command.annotated_results,
-        "debug": command.debug_info,
-        "request": dict(request.GET)
-    }
+    # Usually tiny, but a reset is the whole graph.
+    with profiler.phase("serialize"):
+        delta = [json.dumps(command.annotated_results)]
+    results = iter_envelope(delta,
+                            debug=command.debug_info,
+                            request=dict(request.GET))
 
-    return results
+    return streaming_json_response(request, results)
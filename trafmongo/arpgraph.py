@@ -0,0 +1,578 @@
+# arpgraph.py
+#
+# Compact, array backed storage for ARP graphs: nodes are MAC addresses and
+# links are undirected, weighted pairs of MACs.
+#
+# Each MAC is interned as a 48-bit integer and numbered in the order it's first
+# seen.  Each link is a single 64-bit key, (lower node number << 32) | higher
+# node number, where "lower" is the node with the smaller MAC.  Keys and
+# weights live in parallel, sorted columns, and new records are folded in a
+# batch at a time.  With NumPy the batches are merged with vectorized
+# operations; without it a plain dict keyed on the packed int is used.
+#
+# Graphs are written straight from those columns, either as the d3 json
+# structure, {"nodes": [...], "links": [...]}, produced a chunk at a time, or
+# in a compact binary format (see write_graph_binary).  Neither builds the
+# graph as python dicts first.
+
+import struct
+from array import array
+from hashlib import sha1
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+# The vectorized path keeps keys in unsigned 64-bit columns.
+VECTORIZED = numpy is not None and array('L').itemsize == 8
+
+NODE_BITS = 32
+NODE_MASK = (1 << NODE_BITS) - 1
+
+def mac_to_int(mac):
+    """
+    Turns "00:1e:37:d2:f1:55" into the 48-bit integer 0x001e37d2f155.
+    """
+    try:
+        value = int(mac.replace(':', ''), 16)
+    except (ValueError, AttributeError):
+        raise ValueError("Not a MAC address: " + repr(mac))
+    if not 0 <= value < 2 ** 48:
+        raise ValueError("Not a MAC address: " + repr(mac))
+    return value
+
+def int_to_mac(value):
+    """
+    The inverse of mac_to_int.
+    """
+    digits = '%012x' % value
+    return ':'.join(digits[i:i + 2] for i in xrange(0, 12, 2))
+
+# A link as hashed by ARPEdgeTable.digest
+LINK_ROW = struct.Struct('<QQQ')
+
+class ARPEdgeTable(object):
+    """
+    The nodes and links of an ARP graph.
+
+    Nodes are numbered in the order they're first seen, destination before
+    source, which is the numbering DataToUsage.py has always produced.
+    """
+    BATCH_SIZE = 1 << 16
+
+    def __init__(self):
+        self._number = {}           # MAC string -> node number
+        self._names = []            # node number -> MAC string
+        self._macs = array('L') if VECTORIZED else []   # node number -> MAC int
+
+        # Records not yet folded into the columns below.
+        self._pending_keys = array('L')
+        self._pending_weights = array('L')
+
+        if VECTORIZED:
+            self._keys = numpy.zeros(0, dtype=numpy.uint64)
+            self._weights = numpy.zeros(0, dtype=numpy.uint64)
+        else:
+            self._edges = {}        # key -> weight
+
+        self._digest = None
+
+    def node(self, mac):
+        """
+        Returns mac's node number, numbering it if it's new.
+        """
+        number = self._number.get(mac)
+        if number is None:
+            number = len(self._names)
+            self._macs.append(mac_to_int(mac))
+            self._number[mac] = number
+            self._names.append(mac)
+        return number
+
+    def add(self, macfrom, macto, linkstrength):
+        """
+        Adds a single record.
+        """
+        self._digest = None
+        node = self.node
+        to_number = node(macto)
+        from_number = node(macfrom)
+
+        macs = self._macs
+        if macs[to_number] < macs[from_number]:
+            key = (to_number << NODE_BITS) | from_number
+        else:
+            key = (from_number << NODE_BITS) | to_number
+
+        if VECTORIZED:
+            self._pending_keys.append(key)
+            self._pending_weights.append(linkstrength)
+            if len(self._pending_keys) >= self.BATCH_SIZE:
+                self.flush()
+        else:
+            edges = self._edges
+            edges[key] = edges.get(key, 0) + linkstrength
+
+    def add_all(self, records):
+        for macfrom, macto, linkstrength in records:
+            self.add(macfrom, macto, linkstrength)
+        self.flush()
+
+    def flush(self):
+        """
+        Folds pending records into the key and weight columns.
+        """
+        if not VECTORIZED or not len(self._pending_keys):
+            return
+
+        keys = numpy.frombuffer(self._pending_keys, dtype=numpy.uint64)
+        weights = numpy.frombuffer(self._pending_weights, dtype=numpy.uint64)
+        self._fold(keys, weights)
+
+        self._pending_keys = array('L')
+        self._pending_weights = array('L')
+
+    def _fold(self, keys, weights):
+        # Sum the batch by key, then merge it into the sorted columns.
+        batch_keys, inverse = numpy.unique(keys, return_inverse=True)
+        batch_weights = numpy.zeros(len(batch_keys), dtype=numpy.uint64)
+        numpy.add.at(batch_weights, inverse, weights)
+
+        where = numpy.searchsorted(self._keys, batch_keys)
+        found = where < len(self._keys)
+        found[found] = self._keys[where[found]] == batch_keys[found]
+
+        self._weights[where[found]] += batch_weights[found]
+
+        new = ~found
+        if new.any():
+            self._keys = numpy.insert(self._keys, where[new], batch_keys[new])
+            self._weights = numpy.insert(self._weights, where[new],
+                                         batch_weights[new])
+
+    def merge(self, names, sources, targets, weights):
+        """
+        Merges a partial table, as returned by partial(), into this one.
+        names must be in the order the partial table numbered them; merging
+        partial tables in input order then numbers the nodes exactly as a
+        single table would have.
+        """
+        self.flush()
+        self._digest = None
+        node = self.node
+        renumber = [node(name) for name in names]
+
+        if VECTORIZED:
+            renumber = numpy.array(renumber, dtype=numpy.uint64)
+            sources = renumber[numpy.asarray(sources, dtype=numpy.intp)]
+            targets = renumber[numpy.asarray(targets, dtype=numpy.intp)]
+            # Renumbering doesn't change which end has the lower MAC.
+            keys = (sources << numpy.uint64(NODE_BITS)) | targets
+            self._fold(keys, numpy.asarray(weights, dtype=numpy.uint64))
+        else:
+            edges = self._edges
+            for source, target, weight in zip(sources, targets, weights):
+                key = (renumber[source] << NODE_BITS) | renumber[target]
+                edges[key] = edges.get(key, 0) + weight
+
+    def partial(self):
+        """
+        Returns this table's state as arguments for merge().
+        """
+        sources, targets, weights = self.columns()
+        return list(self._names), sources, targets, weights
+
+    def columns(self):
+        """
+        Returns parallel (source, target, weight) columns, sorted by source
+        then target.
+        """
+        self.flush()
+        if VECTORIZED:
+            keys = self._keys
+            return (keys >> numpy.uint64(NODE_BITS),
+                    keys & numpy.uint64(NODE_MASK),
+                    self._weights)
+
+        sources = array('L')
+        targets = array('L')
+        weights = []
+        for key in sorted(self._edges):
+            sources.append(key >> NODE_BITS)
+            targets.append(key & NODE_MASK)
+            weights.append(self._edges[key])
+        return sources, targets, weights
+
+    @property
+    def node_count(self):
+        return len(self._names)
+
+    @property
+    def link_count(self):
+        self.flush()
+        if VECTORIZED:
+            return len(self._keys)
+        return len(self._edges)
+
+    def iter_nodes(self):
+        """
+        Yields node names in node number order.
+        """
+        return iter(self._names)
+
+    def to_graph(self):
+        """
+        Returns the graph as d3 style python structures,
+        {"nodes": [{"name": ...}, ...], "links": [{"source": ..., ...}, ...]}.
+        Prefer iter_graph_json for anything big.
+        """
+        return {
+            "nodes": [{"name": name} for name in self.iter_nodes()],
+            "links": [{"source": source, "target": target, "value": value}
+                      for source, target, value in self.iter_links()],
+        }
+
+    def iter_links(self):
+        """
+        Yields (source number, target number, value) for each link.
+        """
+        sources, targets, weights = self.columns()
+        if VECTORIZED:
+            sources = sources.tolist()
+            targets = targets.tolist()
+            weights = weights.tolist()
+        for source, target, weight in zip(sources, targets, weights):
+            yield int(source), int(target), int(weight)
+
+    def link_weights(self):
+        """
+        Returns {(source MAC, target MAC): value}.  The source is always the
+        lower MAC, so the same link has the same pair in any table.
+        """
+        names = self._names
+        return dict(((names[source], names[target]), weight)
+                    for source, target, weight in self.iter_links())
+
+    def digest(self):
+        """
+        Returns a hex sha1 of the links, as (lower MAC, higher MAC, value)
+        rows in MAC order.  It doesn't depend on how the nodes happen to be
+        numbered, so tables with the same links have the same digest.  It's
+        remembered until the table changes.
+        """
+        if self._digest is not None:
+            return self._digest
+
+        sources, targets, weights = self.columns()
+        rows = LINK_ROW.size * len(weights)
+        if VECTORIZED and rows:
+            macs = numpy.frombuffer(self._macs, dtype=numpy.uint64)
+            low = macs[sources.astype(numpy.intp)]
+            high = macs[targets.astype(numpy.intp)]
+            order = numpy.lexsort((high, low))
+            table = numpy.empty((len(order), 3), dtype='<u8')
+            table[:, 0] = low[order]
+            table[:, 1] = high[order]
+            table[:, 2] = weights[order]
+            data = table.tostring()
+        else:
+            macs = self._macs
+            links = sorted((macs[source], macs[target], weight)
+                           for source, target, weight
+                           in zip(sources, targets, weights))
+            data = ''.join(LINK_ROW.pack(*link) for link in links)
+
+        self._digest = sha1(data).hexdigest()
+        return self._digest
+
+def graph_delta(old, new):
+    """
+    Returns the changes from table old to table new, naming nodes by MAC:
+
+        {"nodes": {"added": [MAC, ...], "removed": [MAC, ...]},
+         "links": {"added": [{"source": MAC, "target": MAC, "value": n}, ...],
+                   "removed": [{"source": MAC, "target": MAC}, ...],
+                   "changed": [{"source": MAC, "target": MAC, "value": n,
+                                "delta": n - old n}, ...]}}
+
+    Everything is sorted, so the same two tables always give the same delta.
+    """
+    old_nodes = set(old.iter_nodes())
+    new_nodes = set(new.iter_nodes())
+    old_links = old.link_weights()
+    new_links = new.link_weights()
+
+    added = []
+    changed = []
+    for (source, target), value in sorted(new_links.iteritems()):
+        before = old_links.get((source, target))
+        if before is None:
+            added.append({"source": source, "target": target, "value": value})
+        elif before != value:
+            changed.append({"source": source, "target": target,
+                            "value": value, "delta": value - before})
+    removed = [{"source": source, "target": target}
+               for source, target in sorted(old_links)
+               if (source, target) not in new_links]
+
+    return {
+        "nodes": {"added": sorted(new_nodes - old_nodes),
+                  "removed": sorted(old_nodes - new_nodes)},
+        "links": {"added": added, "removed": removed, "changed": changed},
+    }
+
+###
+# Heavy hitters
+
+class HeavyLinkSummary(object):
+    """
+    Approximate link weights in fixed memory, for graphs with far too many
+    links to keep.  This is the weighted Misra-Gries summary (the
+    deterministic twin of Space-Saving): at most 2 * counters links are
+    tracked at once, each keyed on its two 48-bit MACs packed into one 96-bit
+    int.  When it fills up, the (counters + 1)-th largest weight is taken off
+    every link and the ones left with nothing are dropped.
+
+    Reported weights are never more than the true weight and never less than
+    it by more than error, which itself is at most total / (counters + 1).
+    Any link heavier than error is guaranteed to be reported.
+    """
+    def __init__(self, counters):
+        if counters < 1:
+            raise ValueError("A summary needs at least one counter")
+        self.counters = counters
+        self.weights = {}   # 96-bit key -> weight, less error
+        self.error = 0      # Total taken off each link so far
+        self.total = 0      # Total weight seen
+        self._macs = {}     # MAC string -> int, to skip re-parsing
+
+    def _mac(self, mac):
+        value = self._macs.get(mac)
+        if value is None:
+            value = self._macs[mac] = mac_to_int(mac)
+        return value
+
+    def add(self, macfrom, macto, linkstrength):
+        a = self._mac(macfrom)
+        b = self._mac(macto)
+        if a < b:
+            key = (a << 48) | b
+        else:
+            key = (b << 48) | a
+
+        weights = self.weights
+        weights[key] = weights.get(key, 0) + linkstrength
+        self.total += linkstrength
+        if len(weights) > 2 * self.counters:
+            self._compact()
+
+    def add_all(self, records):
+        for macfrom, macto, linkstrength in records:
+            self.add(macfrom, macto, linkstrength)
+
+    def merge(self, weights, error, total):
+        """
+        Merges another summary, as returned by partial(), into this one.  The
+        errors add up.
+        """
+        mine = self.weights
+        for key, weight in weights.iteritems():
+            mine[key] = mine.get(key, 0) + weight
+        self.error += error
+        self.total += total
+        if len(mine) > self.counters:
+            self._compact()
+
+    def partial(self):
+        """
+        Returns this summary's state as arguments for merge().
+        """
+        return self.weights, self.error, self.total
+
+    def _compact(self):
+        weights = self.weights
+        if len(weights) <= self.counters:
+            return
+        cut = sorted(weights.itervalues(), reverse=True)[self.counters]
+        self.error += cut
+        self.weights = dict((key, weight - cut)
+                            for key, weight in weights.iteritems()
+                            if weight > cut)
+
+    def heaviest(self, top=None, min_weight=0):
+        """
+        Returns [(mac, mac, weight), ...] for the top heaviest links weighing
+        at least min_weight, heaviest first.
+        """
+        links = [(weight, key) for key, weight in self.weights.iteritems()
+                 if weight >= min_weight]
+        links.sort(reverse=True)
+        if top is not None:
+            links = links[:top]
+        return [(int_to_mac(key >> 48), int_to_mac(key & (2 ** 48 - 1)),
+                 weight)
+                for weight, key in links]
+
+    def to_table(self, top=None, min_weight=0):
+        """
+        Returns an ARPEdgeTable of just the heaviest links and the nodes they
+        touch.
+        """
+        table = ARPEdgeTable()
+        table.add_all(self.heaviest(top, min_weight))
+        return table
+
+    def error_bound(self):
+        """
+        Describes how far off the weights might be, for the output.
+        """
+        return {
+            "method": "misra-gries",
+            "counters": self.counters,
+            "total_weight": self.total,
+            "max_underestimate": self.error,
+        }
+
+###
+# Output
+
+# Roughly how much json iter_graph_json yields at a time.
+JSON_CHUNK_SIZE = 64 * 1024 # Bytes
+
+def iter_graph_json(table, header=(), chunk_size=JSON_CHUNK_SIZE,
+                    positions=None):
+    """
+    Yields table as d3 json, {"nodes": [...], "links": [...]}, in strings of
+    about chunk_size bytes.  Any (name, value) pairs in header are written
+    into the object first.  If positions, a list of (x, y) per node, is
+    given, each node gets "x" and "y" too.
+    """
+    dumps = json.dumps
+    pieces = ['{']
+    size = 1
+    for name, value in header:
+        piece = '%s: %s, ' % (dumps(name), dumps(value))
+        pieces.append(piece)
+        size += len(piece)
+    pieces.append('"nodes": [')
+
+    separator = ''
+    for number, name in enumerate(table.iter_nodes()):
+        if positions is None:
+            piece = '%s{"name": %s}' % (separator, dumps(name))
+        else:
+            piece = ('%s{"name": %s, "x": %.4f, "y": %.4f}'
+                     % ((separator, dumps(name)) + tuple(positions[number])))
+        pieces.append(piece)
+        size += len(piece)
+        separator = ', '
+        if size >= chunk_size:
+            yield ''.join(pieces)
+            pieces = []
+            size = 0
+
+    pieces.append('], "links": [')
+    separator = ''
+    for source, target, value in table.iter_links():
+        piece = ('%s{"source": %d, "target": %d, "value": %d}'
+                 % (separator, source, target, value))
+        pieces.append(piece)
+        size += len(piece)
+        separator = ', '
+        if size >= chunk_size:
+            yield ''.join(pieces)
+            pieces = []
+            size = 0
+
+    pieces.append(']}')
+    yield ''.join(pieces)
+
+def write_graph_json(out, table, header=()):
+    """
+    Writes table to the file object out as d3 json.
+    """
+    for chunk in iter_graph_json(table, header):
+        out.write(chunk)
+
+# The binary format, all little-endian:
+#
+#   header:    magic "ARPG", uint16 version, uint16 reserved (0),
+#              uint32 node count, uint64 link count, uint64 string table size
+#   strings:   node names, utf-8, each followed by a NUL, in node order
+#   sources:   uint32 source node number per link
+#   targets:   uint32 target node number per link
+#   weights:   uint64 weight per link
+BINARY_MAGIC = 'ARPG'
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct('<4sHHIQQ')
+
+def _pack(values, code):
+    """
+    Packs a column of numbers as little-endian code ('I' or 'Q') values.
+    """
+    if numpy is not None:
+        dtype = {'I': '<u4', 'Q': '<u8'}[code]
+        return numpy.asarray(values, dtype=dtype).tostring()
+    return struct.pack('<%d%s' % (len(values), code), *values)
+
+def _unpack(data, code, count):
+    if numpy is not None:
+        dtype = {'I': '<u4', 'Q': '<u8'}[code]
+        return numpy.frombuffer(data, dtype=dtype, count=count)
+    return struct.unpack('<%d%s' % (count, code), data)
+
+def _encode(name):
+    if isinstance(name, unicode):
+        return name.encode('utf-8')
+    return name
+
+def write_graph_binary(out, table):
+    """
+    Writes table to the file object out in the binary format.
+    """
+    strings = ''.join(_encode(name) + '\0' for name in table.iter_nodes())
+    sources, targets, weights = table.columns()
+
+    out.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, 0,
+                                 table.node_count, len(weights),
+                                 len(strings)))
+    out.write(strings)
+    out.write(_pack(sources, 'I'))
+    out.write(_pack(targets, 'I'))
+    out.write(_pack(weights, 'Q'))
+
+def read_graph_binary(infile):
+    """
+    Reads a graph written by write_graph_binary back into an ARPEdgeTable.
+    """
+    def read(size):
+        data = infile.read(size)
+        if len(data) != size:
+            raise ValueError("Truncated ARP graph")
+        return data
+
+    (magic, version, reserved, node_count, link_count,
+     strings_size) = BINARY_HEADER.unpack(read(BINARY_HEADER.size))
+    if magic != BINARY_MAGIC:
+        raise ValueError("Not an ARP graph")
+    if version != BINARY_VERSION:
+        raise ValueError("Unsupported ARP graph version " + str(version))
+
+    names = read(strings_size).split('\0')[:-1]
+    if len(names) != node_count:
+        raise ValueError("Corrupt ARP graph string table")
+    names = [name.decode('utf-8') for name in names]
+
+    sources = _unpack(read(4 * link_count), 'I', link_count)
+    targets = _unpack(read(4 * link_count), 'I', link_count)
+    weights = _unpack(read(8 * link_count), 'Q', link_count)
+
+    table = ARPEdgeTable()
+    table.merge(names, sources, targets, weights)
+    return table
@@ -18,8 +18,23 @@
 #
 ###
 
+from __future__ import with_statement
+
+import json
 import sys
-from trafmongo.commands import CommandFactoryABS, MongoQueryCommandABS
+import time
+from trafmongo.commands import (CommandInterface, CommandFactoryABS,
+                                MongoQueryCommandABS, CachedCommand,
+                                CommandTimeout)
+from trafmongo.db_schema import (HDF, Timeframe, InfoTimeframe,
+                                 InfoStartTimeframe, GroupsTimeframe,
+                                 Groups2Timeframe, OtherTrafficSegment,
+                                 TrafficFilterList, TrafficSegmentABS,
+                                 split_timeframe)
+from trafmongo.arpgraph import (ARPEdgeTable, graph_delta, read_graph_binary,
+                                write_graph_binary)
+from trafmongo.cache import ResultCache, SingleFlight, JSONCodec
+from trafmongo import coarsen, layout
 
 # XXX: Python 2.5 Doesn't support @property.setter, so we hack it in for now.
 # Squeeze uses python 2.6, which DOES support @property.setter
@@ -41,31 +56,770 @@ if sys.version_info < (2,6,0):
             return self.fget.__doc__
 # End Hack
 
+# ARP records are kept with the rest of the non-IP traffic, and rolled up into
+# per-window link weights at two resolutions.
+RAW = OtherTrafficSegment.collectionNames['info']
+GROUPS = OtherTrafficSegment.collectionNames['arp_groups']
+GROUPS2 = OtherTrafficSegment.collectionNames['arp_groups2']
+ROLLUP_STATUS = OtherTrafficSegment.collectionNames['arp_rollup_status']
+
+GROUPS_DURATION = TrafficSegmentABS.GROUPS_DOC_DURATION
+GROUPS2_DURATION = TrafficSegmentABS.GROUPS2_DOC_DURATION
+
+def rolled_up_until(db, collection):
+    """
+    Returns the end of the last window rolled up into collection, or None.
+    """
+    status = db[ROLLUP_STATUS].find_one({"_id": collection})
+    if status is None:
+        return None
+    return status["until"]
+
 class ARPGraphCommand(MongoQueryCommandABS):
+    """
+    Builds the ARP graph for a timeframe.
+
+    The grouping by (sorted) pair of MACs and the summing of packet counts
+    all happen inside mongo, in an aggregation pipeline whose $match uses the
+    timeframe's and filters' match documents (and so the indexes).  Only the
+    reduced edge list comes back to the worker.
+
+    Long timeframes are answered mostly from the rollups (see
+    ARPRollupCommand): the middle of the timeframe, aligned to the rollup
+    windows, is read from the 3 hour and 15 minute rollups, and only the
+    unaligned ends from the raw records.  Since rollups lose the "m" field,
+    filters on it always read the raw records.
+
+    With shards above 1, each long piece of that plan is split further, into
+    about that many chunks on the rollup windows, and the chunks are queried
+    at once in the shared pool (see ConfigurableCommandABS.run_ordered).
+    Their edges are merged in time order as they come in, and iter_partials()
+    hands back the graph so far after each.
+    """
+    COLLECTION = RAW
+
+    def __init__(self, options):
+        self._timeframe = None
+        self._filters = TrafficFilterList()
+        self._shards = 1
+        super(ARPGraphCommand, self).__init__(options)
+
+    @property
+    def timeframe(self):
+        return self._timeframe
+
+    @timeframe.setter
+    def timeframe(self, timeframe):
+        self._timeframe = timeframe
+
+    @property
+    def filters(self):
+        return self._filters
+
+    @filters.setter
+    def filters(self, filters):
+        self._filters = filters
+
+    @property
+    def shards(self):
+        """
+        How many chunks to split each piece of the plan into, to query at
+        once.  1, the default, doesn't split anything.
+        """
+        return self._shards
+
+    @shards.setter
+    def shards(self, shards):
+        shards = int(shards or 1)
+        if shards < 1:
+            raise ValueError("A graph can't be split into fewer than 1 shard")
+        self._shards = shards
+
+    def match_doc(self, timeframe=None):
+        """
+        Returns the $match document: the timeframe (by default, the
+        command's) and every filter.
+        """
+        if timeframe is None:
+            timeframe = self.timeframe
+        return self.filters.match_plan().to_match_doc(timeframe)
+
+    def pipeline(self, timeframe=None):
+        """
+        Returns the aggregation pipeline, which produces one document per
+        link: {"_id": {"a": lower MAC, "b": higher MAC}, "pk": packets}.
+        Raw records and rollups have the same fields, so it works on both.
+        """
+        source = "$" + HDF.SOURCE
+        dest = "$" + HDF.DEST
+        source_first = {"$lt": [source, dest]}
+
+        return [
+            {"$match": self.match_doc(timeframe)},
+            {"$project": {
+                "_id": 0,
+                "a": {"$cond": [source_first, source, dest]},
+                "b": {"$cond": [source_first, dest, source]},
+                HDF.PACKETS: 1,
+            }},
+            {"$group": {
+                "_id": {"a": "$a", "b": "$b"},
+                HDF.PACKETS: {"$sum": "$" + HDF.PACKETS},
+            }},
+        ]
+
+    def plan(self):
+        """
+        Returns [(collection, timeframe), ...], the pieces the graph is read
+        from.  Together they match exactly the raw records an InfoTimeframe
+        over the whole timeframe would: the first piece is the records
+        overlapping the start of the timeframe, and the rest partition the
+        records that begin after it.
+
+        The rollups count a record toward the window it began in, so records
+        that began before the timeframe but are still going at its start
+        are only in the raw records.  The first piece is always read from
+        them, up to the end of the window the start is in, even when the
+        start is on a window boundary.
+        """
+        start = self.timeframe.start
+        end = self.timeframe.end
+        whole = [(RAW, self.timeframe)]
+
+        if self.filters.contains_param('m'):
+            return whole
+
+        # The middle: whole 15 minute windows that have been rolled up,
+        # after the one the start is in.
+        middle_start = Timeframe.floor(start + GROUPS_DURATION,
+                                       GROUPS_DURATION)
+        middle_end = min(Timeframe.floor(end, GROUPS_DURATION),
+                         rolled_up_until(self.db, GROUPS) or 0)
+        if middle_start >= middle_end:
+            return whole
+
+        pieces = [(RAW, InfoTimeframe(start, middle_start))]
+
+        # Within the middle, whole 3 hour windows come from groups2.
+        inner_start = Timeframe.ceil(middle_start, GROUPS2_DURATION)
+        inner_end = min(Timeframe.floor(middle_end, GROUPS2_DURATION),
+                        rolled_up_until(self.db, GROUPS2) or 0)
+        if inner_start < inner_end:
+            if middle_start < inner_start:
+                pieces.append((GROUPS, GroupsTimeframe(middle_start,
+                                                       inner_start)))
+            pieces.append((GROUPS2, Groups2Timeframe(inner_start, inner_end)))
+            if inner_end < middle_end:
+                pieces.append((GROUPS, GroupsTimeframe(inner_end, middle_end)))
+        else:
+            pieces.append((GROUPS, GroupsTimeframe(middle_start, middle_end)))
+
+        if middle_end < end:
+            pieces.append((RAW, InfoStartTimeframe(middle_end, end)))
+
+        return pieces
+
+    def chunks(self, plan):
+        """
+        Splits the pieces of a plan into shards chunks each, on the rollup
+        windows (the 3 hour ones, for groups2).
+        """
+        if self.shards == 1:
+            return plan
+        chunks = []
+        for collection, timeframe in plan:
+            align = getattr(timeframe, 'SECONDS_PER_DOC', GROUPS_DURATION)
+            chunks.extend((collection, chunk) for chunk in
+                          split_timeframe(timeframe, self.shards, align))
+        return chunks
+
+    def query(self, collection, timeframe):
+        """
+        Returns the edges in one chunk of the plan.  Runs in the pool.
+        """
+        with self.profiler.phase("match"):
+            pipeline = self.pipeline(timeframe)
+        with self.profiler.phase("query"):
+            return list(self.aggregate(collection, pipeline))
+
+    def iter_partials(self):
+        """
+        Builds the graph, yielding it (an ARPEdgeTable, which goes on
+        growing) each time another chunk's edges have been merged in.
+        """
+        table = self.annotated_results = ARPEdgeTable()
+        plan = self.plan()
+        chunks = self.chunks(plan)
+        self.debug_info["plan"] = [[collection, timeframe.start, timeframe.end]
+                                   for collection, timeframe in plan]
+        self.debug_info["shards"] = len(chunks)
+
+        merged = 0
+        try:
+            for (collection, timeframe), edges in \
+                    self.run_ordered(self.query, chunks):
+                with self.profiler.phase("post-process"):
+                    for edge in edges:
+                        macs = edge["_id"]
+                        table.add(macs["a"], macs["b"], edge[HDF.PACKETS])
+                    table.flush()
+                merged += 1
+                self._count(table)
+                yield table
+        except CommandTimeout:
+            collection, timeframe = chunks[merged]
+            self.timed_out("%s %d-%d" % (collection, timeframe.start,
+                                         timeframe.end))
+        self._count(table)
+
+    def _count(self, table):
+        self.debug_info["nodes"] = table.node_count
+        self.debug_info["links"] = table.link_count
+
     def execute(self):
+        # The table itself is the result, so it can be written out a piece
+        # at a time (see arpgraph.iter_graph_json).
+        for table in self.iter_partials():
+            pass
+
+class ARPRollupCommand(MongoQueryCommandABS):
+    """
+    Brings the ARP graph rollups up to date.
+
+    The 15 minute rollup is built from the raw records, each record counting
+    toward the window it began in.  The 3 hour rollup is built from the 15
+    minute one.  Windows are rolled up in order, each rewritten whole, and
+    never looked at again.  Running it again is harmless.
+
+    A record is only written once it has ended, so one that began in a
+    window can turn up as long after the window as the record lasted.  A
+    window is only rolled up once it's been over for max_duration, the
+    longest a record is expected to last, plus lag, for the record to be
+    written.  Records longer than max_duration that arrive after their
+    window was rolled up are only in the raw records.
+    """
+    MAX_DURATION = 60 * 60 # Seconds
+    LAG = TrafficSegmentABS.GROUPS_DOC_DURATION # Seconds
+
+    def __init__(self, options):
+        self._max_duration = self.MAX_DURATION
+        self._lag = self.LAG
+        self._since = None
+        super(ARPRollupCommand, self).__init__(options)
+
+    @property
+    def max_duration(self):
         """
-        This is where the bulk of your code should go, until we start worrying
-        about options.
+        The longest a record is expected to last, in seconds.
+        """
+        return self._max_duration
+
+    @max_duration.setter
+    def max_duration(self, max_duration):
+        max_duration = int(max_duration)
+        if max_duration < 0:
+            raise ValueError("The longest record can't be negative")
+        self._max_duration = max_duration
+
+    @property
+    def lag(self):
+        return self._lag
 
-        Here, self.db is defined as a pymongo database:
-        http://api.mongodb.org/python/current/api/pymongo/database.html
+    @lag.setter
+    def lag(self, lag):
+        lag = int(lag)
+        if lag < 0:
+            raise ValueError("The rollup lag can't be negative")
+        self._lag = lag
+
+    @property
+    def since(self):
+        """
+        Where to start a rollup that's never been run.  By default, the
+        oldest data available.
         """
+        return self._since
+
+    @since.setter
+    def since(self, since):
+        self._since = Timeframe.parse_time(since)
+
+    def execute(self):
+        groups_until = Timeframe.floor(self.rollable_until(),
+                                       GROUPS_DURATION)
+        groups_windows = self.roll_up(GROUPS, GROUPS_DURATION, RAW,
+                                      InfoStartTimeframe, groups_until)
+
+        groups2_until = Timeframe.floor(rolled_up_until(self.db, GROUPS) or 0,
+                                        GROUPS2_DURATION)
+        groups2_windows = self.roll_up(GROUPS2, GROUPS2_DURATION, GROUPS,
+                                       GroupsTimeframe, groups2_until)
+
+        self.annotated_results = {
+            GROUPS: {"windows": groups_windows,
+                     "until": rolled_up_until(self.db, GROUPS)},
+            GROUPS2: {"windows": groups2_windows,
+                      "until": rolled_up_until(self.db, GROUPS2)},
+        }
+
+    def rollable_until(self):
+        """
+        Returns the time before which every record should have been written.
+        """
+        return max(int(time.time()) - self.max_duration - self.lag, 0)
+
+    def first_window(self, source, duration):
+        """
+        Returns the start of the first window to roll up from source when
+        there's no status yet, or None if there's nothing there.
+
+        The oldest document is found on tbm, which every source has an index
+        on.  In raw records it's tb rounded to the minute, so the window is
+        taken from a minute before it.
+        """
+        if self.since is not None:
+            return Timeframe.floor(self.since, duration)
+
+        oldest = list(self.db[source].find({}, {HDF.INDX_TIME_BEGIN: 1})
+                      .sort(HDF.INDX_TIME_BEGIN, 1).limit(1))
+        if not oldest:
+            return None
+        start = int(oldest[0][HDF.INDX_TIME_BEGIN])
+        if source == RAW:
+            start = max(start - 59, 0)
+        return Timeframe.floor(start, duration)
+
+    def roll_up(self, collection, duration, source, TimeframeClass, until):
+        """
+        Rolls up source into collection, a window of duration at a time, up
+        to until.  Returns how many windows were done.
+        """
+        start = rolled_up_until(self.db, collection)
+        if start is None:
+            start = self.first_window(source, duration)
+            if start is None:
+                return 0
+
+        windows = 0
+        for window in xrange(start, until, duration):
+            # Stopping between windows is always safe; the next run carries
+            # on from the status.
+            stage = "%s %d" % (collection, window)
+            if self.out_of_time(stage):
+                break
+            timeframe = TimeframeClass(window, window + duration)
+            pipeline = [
+                {"$match": timeframe.to_match_doc()},
+                {"$group": {
+                    "_id": {HDF.SOURCE: "$" + HDF.SOURCE,
+                            HDF.DEST: "$" + HDF.DEST},
+                    HDF.PACKETS: {"$sum": "$" + HDF.PACKETS},
+                }},
+            ]
+
+            docs = []
+            try:
+                for link in self.aggregate(source, pipeline):
+                    docs.append({
+                        HDF.INDX_TIME_BEGIN: window,
+                        HDF.SOURCE: link["_id"][HDF.SOURCE],
+                        HDF.DEST: link["_id"][HDF.DEST],
+                        HDF.PACKETS: link[HDF.PACKETS],
+                    })
+            except CommandTimeout:
+                self.timed_out(stage)
+                break
+
+            self.db[collection].remove({HDF.INDX_TIME_BEGIN: window})
+            if docs:
+                self.db[collection].insert(docs)
+            self.db[ROLLUP_STATUS].update({"_id": collection},
+                                          {"$set": {"until": window + duration}},
+                                          upsert=True)
+            windows += 1
+
+        return windows
 
-        # Do stuff here
-        # self.db["my_collection_name"].find(blah blah)
+class ARPRollupCommandFactory(CommandFactoryABS):
+    """
+    Creates an ARPRollupCommand.  No intelligence.
+    """
+    def create_command(self):
+        return ARPRollupCommand(self._options)
 
-        self.annotated_results = {"put_something": "here"}
-        # Debug infor can go in this dictionary if you ever want.
-        self.debug_info = {"nothing": "here_yet"} 
+# Finished graphs, per worker process.
+ARP_GRAPH_CACHE = ResultCache(maxsize=64)
+
+# Graphs being queried for.  Shared between workers if given a lock_dir (see
+# trafmongo.coalesce_dir).
+ARP_GRAPH_FLIGHTS = SingleFlight()
+
+class ARPGraphResultCodec(object):
+    """
+    Passes an ARPGraphCommand's (table, debug_info, partial) between workers
+    (see cache.SingleFlight): a line of json, then the table in the binary
+    format.  Neither can run code when it's loaded.
+    """
+    def dump(self, result, stream):
+        table, debug_info, partial = result
+        stream.write(json.dumps([debug_info, partial]) + '\n')
+        write_graph_binary(stream, table)
+
+    def load(self, stream):
+        debug_info, partial = json.loads(stream.readline())
+        return read_graph_binary(stream), debug_info, partial
 
 class ARPGraphCommandFactory(CommandFactoryABS):
     """
-    Creates an ARPGraphCommand.  No intelligence.
+    Creates an ARPGraphCommand from parsed options (see
+    parse.ARPGraphParser).  The parser's timeframe becomes an InfoTimeframe,
+    and only the filters for the non-IP segment are kept.
+
+    Unless cache is None, the command is put behind a result cache.  To let
+    requests a few milliseconds apart share an entry, the timeframe is
+    widened out to the GROUPS_DATA_PITCH grid, and the key is that timeframe
+    plus the filters' fingerprint.  Identical requests that miss the cache
+    at the same time share one query, through flights.
+    """
+    # Timeframes are snapped outwards to multiples of this.
+    SNAP = TrafficSegmentABS.GROUPS_DATA_PITCH # Seconds
+
+    # Data for the last group document's worth of time may still be coming
+    # in, so a graph that ends within it is only cached briefly.
+    OPEN_WINDOW = TrafficSegmentABS.GROUPS_DOC_DURATION # Seconds
+    OPEN_TTL = TrafficSegmentABS.GROUPS_DATA_PITCH # Seconds
+    CLOSED_TTL = 60 * 60 # Seconds
+
+    def __init__(self, options, cache=ARP_GRAPH_CACHE, clock=time.time,
+                 flights=ARP_GRAPH_FLIGHTS):
+        self._options = options
+        self._cache = cache
+        self._clock = clock
+        self._flights = flights
+
+    def snap(self, timeframe):
+        """
+        Returns an InfoTimeframe covering timeframe, aligned to SNAP.
+        """
+        start = timeframe.start - (timeframe.start % self.SNAP)
+        end = timeframe.end + (-timeframe.end % self.SNAP)
+        return InfoTimeframe(start, end)
+
+    def cache_key(self, timeframe, filters):
+        return (ARPGraphCommand.__name__, timeframe.start, timeframe.end,
+                filters.fingerprint())
+
+    def cache_ttl(self, timeframe):
+        if timeframe.end > self._clock() - self.OPEN_WINDOW:
+            return self.OPEN_TTL
+        return self.CLOSED_TTL
+
+    def filters(self):
+        """
+        Returns the filters that apply to the graph: those for the non-IP
+        segment.
+        """
+        filters = self._options.get('filters') or {}
+        return filters.get(OtherTrafficSegment, TrafficFilterList())
+
+    def create_command(self):
+        options = dict(self._options)
+        filters = options['filters'] = self.filters()
+
+        if self._cache is None:
+            timeframe = options['timeframe']
+            options['timeframe'] = InfoTimeframe(timeframe.start,
+                                                 timeframe.end)
+            return ARPGraphCommand(options)
+
+        timeframe = options['timeframe'] = self.snap(options['timeframe'])
+        return CachedCommand(ARPGraphCommand(options), self._cache,
+                             self.cache_key(timeframe, filters),
+                             self.cache_ttl(timeframe), self._flights,
+                             ARPGraphResultCodec())
+
+class ARPGraphDeltaCommand(CommandInterface):
+    """
+    Wraps a command producing an ARP graph (an ARPEdgeTable), and reports
+    how the graph has changed since the one a client already has.
+
+    Every graph is identified by a watermark, its digest, and is remembered
+    in versions under it for a while.  Given the watermark of an earlier
+    graph (since), the result is the delta from it (see
+    arpgraph.graph_delta), plus the new watermark.  If since is unknown (too
+    old, or from another worker), the result is a reset: a delta from
+    nothing, which is the whole graph.
+    """
+    def __init__(self, command, versions, since=None):
+        super(ARPGraphDeltaCommand, self).__init__()
+        self.command = command
+        self.versions = versions
+        self.since = since
+
+    def execute(self):
+        self.command.execute()
+        table = self.command.annotated_results
+        watermark = table.digest()
+        if not getattr(self.command, 'partial', False):
+            self.versions.store(watermark, table)
+
+        if self.since == watermark:
+            found, old = True, table
+        elif self.since is not None:
+            found, old = self.versions.lookup(self.since)
+        else:
+            found, old = False, None
+        if not found:
+            old = ARPEdgeTable()
+
+        self.annotated_results = graph_delta(old, table)
+        self.annotated_results["watermark"] = watermark
+        self.annotated_results["since"] = self.since
+        self.annotated_results["reset"] = not found
+
+        self.debug_info = dict(self.command.debug_info)
+        self.debug_info["versions"] = len(self.versions)
+
+# Graphs recently sent to clients, by watermark, per worker process.
+ARP_GRAPH_VERSIONS = ResultCache(maxsize=32, ttl=60 * 60)
+
+class ARPGraphDeltaCommandFactory(CommandFactoryABS):
+    """
+    Creates an ARPGraphDeltaCommand from parsed options (see
+    parse.ARPGraphDeltaParser).  The graph itself comes from an
+    ARPGraphCommandFactory, and so from its cache when it can.
+    """
+    def __init__(self, options, versions=ARP_GRAPH_VERSIONS,
+                 cache=ARP_GRAPH_CACHE, clock=time.time):
+        self._options = options
+        self._versions = versions
+        self._cache = cache
+        self._clock = clock
+
+    def create_command(self):
+        options = dict(self._options)
+        since = options.pop('since', None)
+        graph_command = ARPGraphCommandFactory(options, self._cache,
+                                               self._clock).create_command()
+        return ARPGraphDeltaCommand(graph_command, self._versions, since)
+
+class ARPGraphLayoutCommand(CommandInterface):
     """
+    Wraps a command producing an ARP graph (an ARPEdgeTable), and lays the
+    graph out, so the client only has to draw it.  annotated_results is
+    still the table; positions is a list of (x, y) per node, in the unit
+    square, or None without NumPy, or for graphs of more than
+    layout.MAX_NODES nodes, which are left to the client.
+
+    The last few layouts are kept in cache under key, one per timeframe (a
+    (start, end) pair), along with the digest of the graph each was for.
+    The same graph over the same timeframe gets the same positions back,
+    and a changed one is warm started from the layout for its timeframe, or
+    else the latest (see layout.layout_table).
+
+    The layout stops between steps once the wrapped command's deadline has
+    passed, and the positions so far are used.  They're kept only to warm
+    start the next layout from.
+    """
+    # How many timeframes' layouts are kept under a key.
+    LAYOUTS_PER_KEY = 4
+
+    def __init__(self, command, cache, key, timeframe=None):
+        super(ARPGraphLayoutCommand, self).__init__()
+        self.command = command
+        self.cache = cache
+        self.key = key
+        self.timeframe = timeframe
+        self.positions = None
+
+    def out_of_time(self):
+        remaining = getattr(self.command, 'remaining', None)
+        if remaining is None:
+            return False
+        remaining = remaining()
+        return remaining is not None and remaining <= 0
+
+    def execute(self):
+        self.command.execute()
+        table = self.annotated_results = self.command.annotated_results
+        self.debug_info = dict(self.command.debug_info)
+        if layout.numpy is None:
+            self.debug_info["layout"] = "unavailable"
+            return
+        if table.node_count > layout.MAX_NODES:
+            self.debug_info["layout"] = "too many nodes"
+            return
+
+        digest = table.digest()
+        names = list(table.iter_nodes())
+        hit, layouts = self.cache.lookup(self.key)
+        if not hit:
+            layouts = []
+
+        previous = None
+        for timeframe, laid_out, placed in layouts:
+            if timeframe == self.timeframe:
+                if laid_out == digest:
+                    self.positions = [placed[name] for name in names]
+                    self.debug_info["layout"] = "cached"
+                    return
+                previous = placed
+                break
+        else:
+            if layouts:
+                previous = layouts[0][2]
+
+        self.positions, finished = layout.layout_table(table, previous,
+                                                       self.out_of_time)
+        if not finished:
+            self.debug_info["layout"] = "partial"
+            digest = None
+        elif previous:
+            self.debug_info["layout"] = "warm"
+        else:
+            self.debug_info["layout"] = "cold"
+
+        # Entries are shared between requests, so the list is replaced
+        # rather than changed.
+        entry = (self.timeframe, digest, dict(zip(names, self.positions)))
+        others = [other for other in layouts if other[0] != self.timeframe]
+        layouts = [entry] + others[:self.LAYOUTS_PER_KEY - 1]
+        self.cache.store(self.key, layouts)
+
+# The last few layouts per set of filters, per worker process.
+ARP_LAYOUT_CACHE = ResultCache(maxsize=64)
+
+class ARPGraphLayoutCommandFactory(CommandFactoryABS):
+    """
+    Creates an ARPGraphLayoutCommand from parsed options (see
+    parse.ARPGraphParser).  Layouts are kept per set of filters, and within
+    that per (snapped) timeframe, so dashboards over different timeframes
+    don't displace each other's, and a graph over a sliding timeframe is
+    warm started from the last one.
+    """
+    def __init__(self, options, layouts=ARP_LAYOUT_CACHE,
+                 cache=ARP_GRAPH_CACHE, clock=time.time):
+        self._options = options
+        self._layouts = layouts
+        self._cache = cache
+        self._clock = clock
+
+    def create_command(self):
+        factory = ARPGraphCommandFactory(self._options, self._cache,
+                                         self._clock)
+        key = (ARPGraphLayoutCommand.__name__, factory.filters().fingerprint())
+        timeframe = factory.snap(self._options['timeframe'])
+        return ARPGraphLayoutCommand(factory.create_command(), self._layouts,
+                                     key, (timeframe.start, timeframe.end))
+
+class ARPAddressesCommand(MongoQueryCommandABS):
+    """
+    Finds which IP address each MAC claimed in a timeframe, from the "x is at
+    MAC" ARP replies.  annotated_results is {mac: ip}.
+    """
+    COLLECTION = RAW
 
     def __init__(self, options):
+        self._timeframe = None
+        super(ARPAddressesCommand, self).__init__(options)
+
+    @property
+    def timeframe(self):
+        return self._timeframe
+
+    @timeframe.setter
+    def timeframe(self, timeframe):
+        self._timeframe = timeframe
+
+    def pipeline(self):
+        """
+        One document per distinct reply: {"_id": message, "pk": packets}
+        """
+        message = "$" + HDF.MESSAGE
+        return [
+            {"$match": {"$and": [
+                self.timeframe.to_match_doc(),
+                {HDF.MESSAGE: {"$regex": " is at "}},
+            ]}},
+            {"$group": {
+                "_id": message,
+                HDF.PACKETS: {"$sum": "$" + HDF.PACKETS},
+            }},
+        ]
+
+    def execute(self):
+        replies = self.aggregate(self.COLLECTION, self.pipeline())
+        self.annotated_results = coarsen.addresses_from_messages(
+            (reply["_id"], reply[HDF.PACKETS]) for reply in replies)
+        self.debug_info["addresses"] = len(self.annotated_results)
+
+class ARPGraphCoarsenCommand(CommandInterface):
+    """
+    Wraps a command producing an ARP graph (an ARPEdgeTable), and collapses
+    the graph's nodes into groups (see coarsen.py).  annotated_results is the
+    coarse graph, as d3 style python structures.
+
+    Grouping by subnet also needs an ARPAddressesCommand, to find the MACs'
+    addresses.
+    """
+    def __init__(self, command, mode, expand=None, addresses=None):
+        super(ARPGraphCoarsenCommand, self).__init__()
+        self.command = command
+        self.mode = mode
+        self.expand = expand
+        self.addresses = addresses
+
+    def execute(self):
+        self.command.execute()
+        table = self.command.annotated_results
+        self.debug_info = dict(self.command.debug_info)
+
+        addresses = None
+        if self.addresses is not None:
+            self.addresses.execute()
+            addresses = self.addresses.annotated_results
+            self.debug_info["addresses"] = len(addresses)
+
+        groups = coarsen.group_names(table, self.mode, addresses)
+        self.annotated_results = coarsen.coarsen(table, groups, self.expand)
+        self.debug_info["coarsen"] = self.mode
+        self.debug_info["groups"] = len(self.annotated_results["nodes"])
+
+class ARPGraphCoarsenCommandFactory(CommandFactoryABS):
+    """
+    Creates an ARPGraphCoarsenCommand from parsed options (see
+    parse.ARPGraphCoarsenParser).  The graph, and for subnets the addresses,
+    come from the result cache when they can.
+    """
+    def __init__(self, options, cache=ARP_GRAPH_CACHE, clock=time.time):
         self._options = options
+        self._cache = cache
+        self._clock = clock
 
     def create_command(self):
-        return ARPGraphCommand(self._options)
+        options = dict(self._options)
+        mode = options.pop('coarsen')
+        expand = options.pop('expand', None)
+
+        factory = ARPGraphCommandFactory(options, self._cache, self._clock)
+        graph_command = factory.create_command()
+
+        addresses = None
+        if mode == 'subnet':
+            timeframe = factory.snap(options['timeframe'])
+            addresses = ARPAddressesCommand({
+                'db': options['db'],
+                'timeframe': timeframe,
+                'index_checker': options.get('index_checker'),
+                'budget': options.get('budget'),
+                'profiler': options.get('profiler'),
+            })
+            if self._cache is not None:
+                addresses = CachedCommand(
+                    addresses, self._cache,
+                    (ARPAddressesCommand.__name__, timeframe.start,
+                     timeframe.end),
+                    factory.cache_ttl(timeframe), ARP_GRAPH_FLIGHTS,
+                    JSONCodec())
 
+        return ARPGraphCoarsenCommand(graph_command, mode, expand, addresses)
@@ -0,0 +1,368 @@
+# cache.py
+#
+# A small, thread-safe result cache: least-recently-used eviction once it's
+# full, plus an optional time-to-live per entry.  And SingleFlight, which
+# keeps concurrent requests for the same missing entry from all computing it.
+
+import errno
+import json
+import os
+import stat
+import threading
+import time
+from hashlib import sha1
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+class ResultCache(object):
+    """
+    Maps keys to results.  Holds at most maxsize entries, evicting the least
+    recently used.  Entries stored with a ttl (in seconds) expire after it.
+    """
+    # Positions in each entry of the linked list
+    PREV, NEXT, KEY, VALUE, EXPIRES = range(5)
+
+    def __init__(self, maxsize=128, ttl=None, clock=time.time):
+        if maxsize < 1:
+            raise ValueError("A cache needs room for at least one entry")
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+
+        self.hits = 0
+        self.misses = 0
+
+        # key -> entry.  Entries also form a circular, doubly linked list,
+        # most recently used at the end, starting and ending with _root.
+        self._entries = {}
+        self._root = root = []
+        root[:] = [root, root, None, None, None]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _unlink(self, entry):
+        prev, next = entry[self.PREV], entry[self.NEXT]
+        prev[self.NEXT] = next
+        next[self.PREV] = prev
+
+    def _append(self, entry):
+        root = self._root
+        last = root[self.PREV]
+        entry[self.PREV] = last
+        entry[self.NEXT] = root
+        last[self.NEXT] = root[self.PREV] = entry
+
+    def lookup(self, key):
+        """
+        Returns (True, result) for a live entry, otherwise (False, None).
+        """
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires = entry[self.EXPIRES]
+                if expires is not None and expires <= self.clock():
+                    self._unlink(entry)
+                    del self._entries[key]
+                    entry = None
+
+            if entry is None:
+                self.misses += 1
+                return False, None
+
+            self._unlink(entry)
+            self._append(entry)
+            self.hits += 1
+            return True, entry[self.VALUE]
+        finally:
+            self._lock.release()
+
+    def store(self, key, value, ttl=None):
+        """
+        Stores value under key, with ttl (or the cache's default ttl).
+        """
+        if ttl is None:
+            ttl = self.ttl
+        expires = None
+        if ttl is not None:
+            expires = self.clock() + ttl
+
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._unlink(entry)
+
+            entry = [None, None, key, value, expires]
+            self._append(entry)
+            self._entries[key] = entry
+
+            while len(self._entries) > self.maxsize:
+                oldest = self._root[self.NEXT]
+                self._unlink(oldest)
+                del self._entries[oldest[self.KEY]]
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            root = self._root
+            root[:] = [root, root, None, None, None]
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """
+        Returns hit and miss counts, for debug_info.
+        """
+        return {"hits": self.hits, "misses": self.misses,
+                "size": len(self._entries), "maxsize": self.maxsize}
+
+class FlightTimeout(Exception):
+    """
+    A SingleFlight caller ran out of time waiting on a call under its key.
+    """
+
+class _Flight(object):
+    """
+    A call in progress, for SingleFlight.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls with the same key: while one is running, any
+    others wait for it and get its result, rather than doing the same work
+    again.  Keys are the same as a ResultCache's, and a SingleFlight is
+    meant to go in front of one, to cover the time before the result is in
+    the cache.  Callers that would accept different results (say, partial
+    ones) have to use different keys.
+
+    Within a process, callers wait on the running call directly.  Given a
+    lock_dir (see private_directory), calls run with a codec are also
+    coalesced across the processes sharing it (like uwsgi workers): each key
+    has a lock file there, held with flock while the call runs, and its
+    result is written alongside by the codec for the callers waiting in
+    other processes.
+
+    Callers wait no longer than the time they have left, and then raise
+    FlightTimeout.  So does one that waited on another process whose call
+    left no result (it failed, or ran out of time itself): running the call
+    again, one waiting worker after another, would only pile up more work.
+    Callers without a deadline wait up to timeout seconds for another
+    process, then make the call themselves.
+
+    Codecs have dump(result, stream) and load(stream) methods, and must
+    only ever load data, never objects that run code (so no pickles).
+    """
+    POLL = 0.05 # Seconds
+
+    def __init__(self, lock_dir=None, timeout=60):
+        self.lock_dir = lock_dir
+        self.timeout = timeout
+
+        self.coalesced = 0
+
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, function, codec=None, remaining=None):
+        """
+        Returns (result, shared), where result is function()'s, or that of
+        a call under the same key that was already running, in which case
+        shared is True.  If that call raised, so does this one.  remaining
+        is the seconds the caller has left, or None for no limit.  Results
+        are only passed to other processes with a codec.
+        """
+        self._lock.acquire()
+        try:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.coalesced += 1
+        finally:
+            self._lock.release()
+
+        if not leader:
+            if remaining is None:
+                flight.done.wait()
+            else:
+                flight.done.wait(max(remaining, 0))
+            if not flight.done.isSet():
+                raise FlightTimeout("Ran out of time waiting on %r" % (key,))
+            if flight.error is not None:
+                raise flight.error
+            return flight.value, True
+
+        try:
+            try:
+                flight.value, shared = self._run_locked(key, function, codec,
+                                                       remaining)
+            except Exception, e:
+                flight.error = e
+                raise
+        finally:
+            self._lock.acquire()
+            try:
+                del self._flights[key]
+            finally:
+                self._lock.release()
+            flight.done.set()
+        return flight.value, shared
+
+    def _run_locked(self, key, function, codec, remaining):
+        """
+        Runs function under the key's lock file, unless another process has
+        just done so for us.
+        """
+        if self.lock_dir is None or codec is None or fcntl is None:
+            return function(), False
+
+        digest = sha1(repr(key)).hexdigest()
+        result_path = os.path.join(self.lock_dir, digest + '.result')
+        lock_path = os.path.join(self.lock_dir, digest + '.lock')
+        started = time.time()
+        if remaining is None:
+            give_up = started + self.timeout
+        else:
+            give_up = started + max(remaining, 0)
+
+        lock = open(lock_path, 'a')
+        try:
+            acquired, waited = self._acquire(lock, give_up)
+            if not acquired:
+                if remaining is not None:
+                    raise FlightTimeout("Ran out of time waiting on %r in "
+                                        "another worker" % (key,))
+                # Whoever has it is taking too long; don't hold up the
+                # request any longer.
+                return function(), False
+            try:
+                # Touched, so the sweep leaves locks in use alone.
+                os.utime(lock_path, None)
+                found, value = self._load(result_path, started, codec)
+                if found:
+                    self.coalesced += 1
+                    return value, True
+                if waited and remaining is not None:
+                    raise FlightTimeout("%r failed or ran out of time in "
+                                        "another worker" % (key,))
+                value = function()
+                self._save(result_path, value, codec)
+                return value, False
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        finally:
+            lock.close()
+
+    def _acquire(self, lock, give_up):
+        """
+        Returns (whether the lock was got before give_up, whether it had to
+        be waited for).
+        """
+        waited = False
+        while True:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True, waited
+            except IOError, e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+            if time.time() >= give_up:
+                return False, True
+            waited = True
+            time.sleep(self.POLL)
+
+    def _load(self, path, started, codec):
+        """
+        Returns (True, result) if another process finished a call since
+        started, otherwise (False, None).
+        """
+        try:
+            if os.path.getmtime(path) < started:
+                return False, None
+            stream = open(path, 'rb')
+        except (IOError, OSError):
+            return False, None
+        try:
+            try:
+                return True, codec.load(stream)
+            except Exception:
+                return False, None
+        finally:
+            stream.close()
+
+    def _save(self, path, value, codec):
+        # Written aside and renamed into place, so it's never seen half done.
+        temporary = '%s.%d' % (path, os.getpid())
+        descriptor = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                             0600)
+        stream = os.fdopen(descriptor, 'wb')
+        try:
+            codec.dump(value, stream)
+        finally:
+            stream.close()
+        os.rename(temporary, path)
+        self._sweep()
+
+    def _sweep(self):
+        """
+        Deletes results too old for anyone to be waiting on, and the locks
+        of keys no one has run for as long.
+        """
+        oldest = time.time() - self.timeout
+        for name in os.listdir(self.lock_dir):
+            if not name.endswith(('.result', '.lock')):
+                continue
+            path = os.path.join(self.lock_dir, name)
+            try:
+                if os.path.getmtime(path) < oldest:
+                    os.remove(path)
+            except OSError:
+                pass
+
+class JSONCodec(object):
+    """
+    A SingleFlight codec for results that are plain json data.
+    """
+    def dump(self, value, stream):
+        json.dump(value, stream)
+
+    def load(self, stream):
+        return json.load(stream)
+
+def private_directory(path):
+    """
+    Makes sure path is a directory only this user can get at, for
+    SingleFlight.lock_dir, creating it (mode 0700) if need be: owned by the
+    effective user, not a symlink, and without any permissions for group
+    or others.  Anyone else able to write there could feed results to every
+    worker.  Raises ValueError if it isn't, and returns path if it is.
+    """
+    try:
+        os.makedirs(path, 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode):
+        raise ValueError("%s isn't a directory" % path)
+    if info.st_uid != os.geteuid():
+        raise ValueError("%s isn't owned by uid %d" % (path, os.geteuid()))
+    if stat.S_IMODE(info.st_mode) & 077:
+        raise ValueError("%s must only be accessible to its owner (mode 0700)"
+                         % path)
+    return path
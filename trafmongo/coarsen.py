@@ -0,0 +1,187 @@
+# coarsen.py
+#
+# Level of detail for ARP graphs.  Rather than every MAC, the graph can be
+# drawn with nodes collapsed into groups: by /24 subnet (from the "x is at
+# MAC" replies), by the vendor prefix (OUI) of the MAC, or by community, as
+# found by label propagation.  Links between groups are summed, and links
+# within a group become the group's internal weight.
+#
+# One group can be expanded back into its MACs.  However big the LAN, the
+# result has at most max_nodes nodes: past that, the lightest are lumped
+# together into a single OTHER node.
+
+import re
+import socket
+import struct
+
+MODES = ('subnet', 'oui', 'community')
+
+MAX_NODES = 250
+SUBNET_BITS = 24
+COMMUNITY_ROUNDS = 20
+
+OTHER = 'other'
+UNKNOWN = 'unknown'
+
+# The ARP reply messages, as in "192.168.168.1 is at 00:13:10:1a:a2:88"
+IS_AT_RE = re.compile(r"^(\d{1,3}(?:\.\d{1,3}){3}) is at ([0-9a-fA-F:]{17})$")
+
+def oui(mac):
+    """
+    Returns the vendor prefix of a MAC, its first three octets.
+    """
+    return mac.lower()[:8]
+
+def subnet(ip, bits=SUBNET_BITS):
+    """
+    Returns the subnet containing a dotted quad, as "a.b.c.d/bits".
+    """
+    value = struct.unpack('!L', socket.inet_aton(ip))[0]
+    value &= ~((1 << (32 - bits)) - 1) & 0xffffffff
+    return '%s/%d' % (socket.inet_ntoa(struct.pack('!L', value)), bits)
+
+def parse_is_at(message):
+    """
+    Returns (ip, mac) from an ARP reply message, or None for anything else.
+    """
+    match = IS_AT_RE.match(message or '')
+    if match is None:
+        return None
+    return match.group(1), match.group(2).lower()
+
+def addresses_from_messages(messages):
+    """
+    Takes (message, packets) pairs, and returns {mac: ip}.  A MAC that's
+    claimed more than one address gets the one it claimed most.
+    """
+    claims = {}
+    for message, packets in messages:
+        parsed = parse_is_at(message)
+        if parsed is None:
+            continue
+        ip, mac = parsed
+        best = claims.get(mac)
+        if best is None or (packets, ip) > best:
+            claims[mac] = (packets, ip)
+    return dict((mac, ip) for mac, (packets, ip) in claims.iteritems())
+
+def communities(table, rounds=COMMUNITY_ROUNDS):
+    """
+    Returns {mac: community} for an arpgraph.ARPEdgeTable, by weighted label
+    propagation: each node starts in a community of its own, and in turn
+    joins whichever community its links to are heaviest, until nothing
+    changes.  Nodes are visited in node order and ties go to the current or
+    the lowest numbered community, so the result is deterministic.
+    """
+    names = list(table.iter_nodes())
+    neighbours = [[] for name in names]
+    for source, target, weight in table.iter_links():
+        neighbours[source].append((target, weight))
+        neighbours[target].append((source, weight))
+
+    labels = range(len(names))
+    for round in xrange(rounds):
+        changed = False
+        for node, links in enumerate(neighbours):
+            totals = {}
+            for other, weight in links:
+                label = labels[other]
+                totals[label] = totals.get(label, 0) + weight
+            if not totals:
+                continue
+
+            heaviest = max(totals.itervalues())
+            if totals.get(labels[node]) == heaviest:
+                continue
+            best = min(label for label, total in totals.iteritems()
+                       if total == heaviest)
+            labels[node] = best
+            changed = True
+        if not changed:
+            break
+
+    return dict((name, 'community ' + names[labels[node]])
+                for node, name in enumerate(names))
+
+def group_names(table, mode, addresses=None):
+    """
+    Returns {mac: group} for every node in table.  Subnets need addresses,
+    {mac: ip}; MACs without one are UNKNOWN.
+    """
+    if mode == 'subnet':
+        addresses = addresses or {}
+        groups = {}
+        for name in table.iter_nodes():
+            ip = addresses.get(name.lower())
+            groups[name] = subnet(ip) if ip is not None else UNKNOWN
+        return groups
+    if mode == 'oui':
+        return dict((name, oui(name)) for name in table.iter_nodes())
+    if mode == 'community':
+        return communities(table)
+    raise ValueError("Unknown coarsening " + repr(mode))
+
+def coarsen(table, groups, expand=None, max_nodes=MAX_NODES):
+    """
+    Collapses table's nodes into groups, {mac: group}, except for the members
+    of the group expand, which are kept as they are.  Returns a d3 style
+    graph:
+
+        {"nodes": [{"name": group, "members": MACs in it,
+                    "internal": weight of links within it}, ...],
+         "links": [{"source": ..., "target": ..., "value": ...}, ...]}
+
+    Nodes are in order of total weight, heaviest first, and there are at
+    most max_nodes of them: the lightest are lumped into one OTHER node.
+    """
+    links = table.link_weights()
+
+    def node_of(mac):
+        group = groups[mac]
+        if group == expand:
+            return mac
+        return group
+
+    # Weigh everything, to pick which nodes to keep.
+    members = {}
+    for mac in table.iter_nodes():
+        node = node_of(mac)
+        members[node] = members.get(node, 0) + 1
+    totals = dict.fromkeys(members, 0)
+    for (source, target), weight in links.iteritems():
+        totals[node_of(source)] += weight
+        totals[node_of(target)] += weight
+
+    ranked = sorted(members, key=lambda node: (-totals[node], node))
+    kept = set(ranked)
+    if len(ranked) > max_nodes:
+        kept = set(ranked[:max_nodes - 1])
+        ranked = ranked[:max_nodes - 1] + [OTHER]
+        members[OTHER] = sum(count for node, count in members.iteritems()
+                             if node not in kept)
+
+    def final(mac):
+        node = node_of(mac)
+        if node in kept:
+            return node
+        return OTHER
+
+    number = dict((node, index) for index, node in enumerate(ranked))
+    internal = dict.fromkeys(ranked, 0)
+    between = {}
+    for (source, target), weight in links.iteritems():
+        source = number[final(source)]
+        target = number[final(target)]
+        if source == target:
+            internal[ranked[source]] += weight
+            continue
+        if target < source:
+            source, target = target, source
+        between[source, target] = between.get((source, target), 0) + weight
+
+    return {
+        "nodes": [{"name": node, "members": members[node],
+                   "internal": internal[node]} for node in ranked],
+        "links": [{"source": source, "target": target, "value": value}
+                  for (source, target), value in sorted(between.iteritems())],
+    }
@@ -18,7 +18,17 @@
 #
 ###
 
+import os
 import sys
+import threading
+import time
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
+from pymongo.errors import OperationFailure
+
+from trafmongo.cache import FlightTimeout
+from trafmongo.profiling import NULL_PROFILER
 
 # XXX: Python 2.5 Doesn't support @property.setter, so we hack it in for now.
 # Squeeze uses python 2.6, which DOES support @property.setter
@@ -40,6 +50,14 @@ if sys.version_info < (2,6,0):
             return self.fget.__doc__
 # End Hack
 
+class CommandTimeout(Exception):
+    """
+    A command ran out of time (see ConfigurableCommandABS.budget).
+    """
+
+# The error code mongo fails a query with when it runs past its maxTimeMS.
+MONGO_EXCEEDED_TIME_LIMIT = 50
+
 class CommandInterface(object):
     """
     A command.
@@ -50,6 +68,116 @@ class CommandInterface(object):
     def execute(self):
         raise NotImplementedError
 
+class CachedCommand(CommandInterface):
+    """
+    Wraps another command, only running it if its results aren't already in
+    the cache (a cache.ResultCache) under key.  Cached results are shared
+    between requests, so annotated_results must be treated as read-only.
+
+    Given flights (a cache.SingleFlight), concurrent misses on the same key
+    run the command once between them, and all get its results; with a
+    codec for (annotated_results, debug_info, partial), so do misses in
+    other workers sharing the flights' lock_dir.  Misses only wait as long
+    as the command's deadline allows, and only share with misses that take
+    partial results if they do.
+    """
+    def __init__(self, command, cache, key, ttl=None, flights=None,
+                 codec=None):
+        super(CachedCommand, self).__init__()
+        self.command = command
+        self.cache = cache
+        self.key = key
+        self.ttl = ttl
+        self.flights = flights
+        self.codec = codec
+
+    def remaining(self):
+        """
+        Returns the seconds the wrapped command has left (see
+        ConfigurableCommandABS.remaining), or None.
+        """
+        remaining = getattr(self.command, 'remaining', None)
+        if remaining is None:
+            return None
+        return remaining()
+
+    def _run(self):
+        self.command.execute()
+        result = (self.command.annotated_results, self.command.debug_info,
+                  getattr(self.command, 'partial', False))
+        # Results cut short by a deadline aren't worth keeping.
+        if not result[2]:
+            self.cache.store(self.key, result[:2], self.ttl)
+        return result
+
+    def execute(self):
+        hit, cached = self.cache.lookup(self.key)
+        coalesced = False
+        if hit:
+            self.annotated_results, debug_info = cached
+            self.partial = False
+        else:
+            if self.flights is None:
+                result = self._run()
+            else:
+                # Partial results are only shared with callers that would
+                # take them.
+                allow_partial = getattr(self.command, 'allow_partial', False)
+                try:
+                    result, coalesced = self.flights.run(
+                        (self.key, allow_partial), self._run,
+                        codec=self.codec, remaining=self.remaining())
+                except FlightTimeout, e:
+                    raise CommandTimeout(str(e))
+                # Results from another worker aren't in this one's cache yet.
+                if coalesced and not result[2]:
+                    self.cache.store(self.key, result[:2], self.ttl)
+            self.annotated_results, debug_info, self.partial = result
+
+        self.debug_info = dict(debug_info)
+        self.debug_info['cache'] = self.cache.stats()
+        self.debug_info['cache']['hit'] = hit
+        self.debug_info['cache']['coalesced'] = coalesced
+
+# The subcommands of MultiCommands run in this many threads, shared by the
+# whole process, so a burst of requests can't start an unbounded number of
+# queries at once.
+POOL_SIZE = 8
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+_pool_thread = threading.local()
+
+def _mark_pool_thread():
+    _pool_thread.active = True
+
+def in_shared_pool():
+    """
+    Tests if the calling thread is one of the shared pool's.
+    """
+    return getattr(_pool_thread, 'active', False)
+
+def shared_pool():
+    """
+    Returns the process's thread pool, starting it if need be.  A pool
+    inherited over a fork has no threads, so a forked child (like a uwsgi
+    worker) gets a pool of its own.
+    """
+    global _pool, _pool_pid
+    _pool_lock.acquire()
+    try:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadPool(POOL_SIZE, _mark_pool_thread)
+            _pool_pid = os.getpid()
+        return _pool
+    finally:
+        _pool_lock.release()
+
+def _execute(command):
+    command.execute()
+    return command
+
 class ConfigurableCommandABS(CommandInterface):
     """
     Root of all KnightWatch Mongo Queries.  Using mixins and such, this could
@@ -57,6 +185,10 @@ class ConfigurableCommandABS(CommandInterface):
     """
     def __init__(self, options):
         super(ConfigurableCommandABS,self).__init__()
+        self._deadline = None
+        self._allow_partial = False
+        self._profiler = NULL_PROFILER
+        self.partial = False
         self.options(options)
 
     def options(self, options):
@@ -67,10 +199,133 @@ class ConfigurableCommandABS(CommandInterface):
             # "self.OPTIONNAME = OPTIONVALUE"
             setattr(self, name, value)
 
+    @property
+    def profiler(self):
+        """
+        A profiling.Profiler to report to.  By default, one that does
+        nothing.
+        """
+        return self._profiler
+
+    @profiler.setter
+    def profiler(self, profiler):
+        self._profiler = profiler or NULL_PROFILER
+
+    @property
+    def deadline(self):
+        """
+        When (as in time.time()) the command has to be finished by, or None
+        for whenever.
+        """
+        return self._deadline
+
+    @deadline.setter
+    def deadline(self, deadline):
+        self._deadline = deadline
+
+    @property
+    def budget(self):
+        """
+        Setting a budget, in seconds, sets the deadline that far from now.
+        """
+        return self.remaining()
+
+    @budget.setter
+    def budget(self, seconds):
+        if seconds is None:
+            self._deadline = None
+            return
+        seconds = float(seconds)
+        if seconds <= 0:
+            raise ValueError("A command's time budget must be positive")
+        self._deadline = time.time() + seconds
+
+    @property
+    def allow_partial(self):
+        """
+        If true, a command that runs out of time stops, flags itself
+        partial, and returns what it has.  Otherwise it raises
+        CommandTimeout.
+        """
+        return self._allow_partial
+
+    @allow_partial.setter
+    def allow_partial(self, allow_partial):
+        self._allow_partial = bool(allow_partial)
+
+    def remaining(self):
+        """
+        Returns the seconds left before the deadline, or None if there isn't
+        one.
+        """
+        if self.deadline is None:
+            return None
+        return self.deadline - time.time()
+
+    def timed_out(self, stage):
+        """
+        Deals with having run out of time at stage: flags the command
+        partial if that's allowed, otherwise raises CommandTimeout.
+        """
+        if not self.allow_partial:
+            raise CommandTimeout("%s ran out of time at %s"
+                                 % (type(self).__name__, stage))
+        self.partial = True
+        self.debug_info['partial'] = stage
+
+    def out_of_time(self, stage):
+        """
+        Called between stages.  Returns False if there's time to go on, or,
+        if there isn't, True when the command should stop with what it has
+        (see timed_out).
+        """
+        remaining = self.remaining()
+        if remaining is None or remaining > 0:
+            return False
+        self.timed_out(stage)
+        return True
+
+    def run_ordered(self, function, arguments):
+        """
+        Calls function(*args) for each args in arguments, all at once in the
+        shared pool, and yields (args, result) in the order arguments are
+        given, each as soon as it and those before it are done.  Results can
+        so be merged in order while later ones are still being worked out.
+        Raises CommandTimeout if the deadline passes while waiting, and
+        whatever a call raised.
+
+        As with MultiCommand, calls from inside the pool are made one after
+        another instead.
+        """
+        arguments = list(arguments)
+        if len(arguments) < 2 or in_shared_pool():
+            for args in arguments:
+                yield args, function(*args)
+            return
+
+        pool = shared_pool()
+        pending = [(args, pool.apply_async(function, args))
+                   for args in arguments]
+        for args, result in pending:
+            remaining = self.remaining()
+            try:
+                if remaining is None:
+                    value = result.get()
+                else:
+                    value = result.get(max(remaining, 0))
+            except TimeoutError:
+                raise CommandTimeout("%s ran out of time waiting on %r"
+                                     % (type(self).__name__, args))
+            yield args, value
+
     def execute(self):
         raise NotImplementedError
 
 class MongoQueryCommandABS(ConfigurableCommandABS):
+    def __init__(self, options):
+        self._index_checker = None
+        super(MongoQueryCommandABS, self).__init__(options)
+
     @property
     def db(self):
         return self._db
@@ -79,6 +334,183 @@ class MongoQueryCommandABS(ConfigurableCommandABS):
     def db(self, db):
         self._db = db
 
+    @property
+    def index_checker(self):
+        """
+        An indexes.IndexChecker to look over queries before they're run, or
+        None not to.
+        """
+        return self._index_checker
+
+    @index_checker.setter
+    def index_checker(self, index_checker):
+        self._index_checker = index_checker
+
+    def aggregate(self, collection, pipeline, **kwargs):
+        """
+        Runs an aggregation pipeline against the named collection and returns
+        an iterable of the resulting documents.  Older pymongos hand back the
+        whole command response, newer ones a cursor; this hides the difference.
+        """
+        match_doc = None
+        if pipeline and "$match" in pipeline[0]:
+            match_doc = pipeline[0]["$match"]
+        if self.index_checker is not None and match_doc is not None:
+            self.index_checker.check(collection, match_doc)
+
+        # Mongo gives up on its own once the deadline has passed.
+        remaining = self.remaining()
+        if remaining is not None:
+            if remaining <= 0:
+                raise CommandTimeout("No time left to query " + collection)
+            kwargs['maxTimeMS'] = max(1, int(remaining * 1000))
+
+        profile = None
+        if self.profiler.enabled and match_doc is not None:
+            profile = self.profiler.query(self.db[collection], match_doc,
+                                          remaining)
+
+        try:
+            result = self.db[collection].aggregate(pipeline, **kwargs)
+        except OperationFailure, e:
+            raise self._translate(e, collection)
+        if isinstance(result, dict):
+            if profile is not None:
+                profile["results"] = len(result['result'])
+            return result['result']
+        return self._iterate(result, collection, profile)
+
+    def _translate(self, error, collection):
+        if getattr(error, 'code', None) == MONGO_EXCEEDED_TIME_LIMIT:
+            return CommandTimeout("Query on %s ran out of time" % collection)
+        return error
+
+    def _iterate(self, cursor, collection, profile=None):
+        # A cursor can run out of time while it's being read, too.
+        try:
+            for document in cursor:
+                if profile is not None:
+                    profile["results"] += 1
+                yield document
+        except OperationFailure, e:
+            raise self._translate(e, collection)
+
+class MultiCommand(ConfigurableCommandABS):
+    """
+    Runs several commands (the subcommands option) at once, in the shared
+    pool, and merges their results.  Takes as long as the slowest of them,
+    rather than all of them added up.
+
+    subcommands is either a list of commands, giving a list of their
+    results, or a dictionary of them, giving a dictionary of results under
+    the same keys.  Override merge() to combine results some other way.  If
+    any subcommand fails, the first failure is raised once they've all
+    finished.
+
+    Subcommands of a MultiCommand that's itself running in the pool are run
+    one after another, in its thread, so nested MultiCommands can't tie up
+    every thread waiting on each other.
+
+    A MultiCommand's deadline applies to its subcommands too.  If it runs
+    out, and partial results are allowed, the results of the subcommands
+    that did finish are merged; the rest are left out (or None, in a list).
+    """
+    def __init__(self, options):
+        self._subcommands = []
+        super(MultiCommand, self).__init__(options)
+
+    @property
+    def subcommands(self):
+        return self._subcommands
+
+    @subcommands.setter
+    def subcommands(self, subcommands):
+        self._subcommands = subcommands
+
+    def _items(self):
+        if isinstance(self.subcommands, dict):
+            return sorted(self.subcommands.items())
+        return list(enumerate(self.subcommands))
+
+    def execute(self):
+        items = self._items()
+        commands = [command for key, command in items]
+
+        for command in commands:
+            if self.deadline is not None and \
+                    isinstance(command, ConfigurableCommandABS) and \
+                    (command.deadline is None or
+                     command.deadline > self.deadline):
+                command.deadline = self.deadline
+
+        if len(commands) > 1 and not in_shared_pool():
+            done = self._execute_pooled(items)
+        else:
+            done = []
+            for key, command in items:
+                if self.out_of_time(key):
+                    break
+                command.execute()
+                done.append((key, command))
+
+        for key, command in done:
+            if getattr(command, 'partial', False):
+                self.partial = True
+                self.debug_info['partial'] = key
+
+        self.annotated_results = self.merge(items, done)
+        self.debug_info['subcommands'] = self.merge_debug(done)
+
+    def _execute_pooled(self, items):
+        """
+        Runs items in the shared pool, and returns those that finished in
+        time.
+        """
+        pool = shared_pool()
+        pending = [(key, command, pool.apply_async(_execute, (command,)))
+                   for key, command in items]
+        done = []
+        error = None
+        for key, command, result in pending:
+            remaining = self.remaining()
+            try:
+                if remaining is None:
+                    result.get()
+                else:
+                    result.get(max(remaining, 0))
+                done.append((key, command))
+            except TimeoutError:
+                if error is None and not self.allow_partial:
+                    error = CommandTimeout("%s ran out of time waiting on %s"
+                                           % (type(self).__name__, key))
+                self.partial = True
+                self.debug_info['partial'] = key
+            except Exception, e:
+                if error is None:
+                    error = e
+        if error is not None:
+            raise error
+        return done
+
+    def merge(self, items, done):
+        """
+        Combines the subcommands' results.  items is [(key, command), ...],
+        where keys are list positions or dictionary keys, and done is the
+        ones of them that finished.
+        """
+        if isinstance(self.subcommands, dict):
+            return dict((key, command.annotated_results)
+                        for key, command in done)
+        results = [None] * len(items)
+        for key, command in done:
+            results[key] = command.annotated_results
+        return results
+
+    def merge_debug(self, done):
+        if isinstance(self.subcommands, dict):
+            return dict((key, command.debug_info) for key, command in done)
+        return [command.debug_info for key, command in done]
+
 ###
 # Command Factories
 #
@@ -97,3 +529,31 @@ class CommandFactoryABS(object):
         Returns something that impliments CommandInterface
         """
         raise NotImplementedError
+
+class PolyProtocolCommandFactory(CommandFactoryABS):
+    """
+    Creates a MultiCommand with a subcommand per segment that has filters,
+    as PolyProtocolTrafficFiltersFactory produces them: {segment:
+    TrafficFilterList}.  Each subcommand is made by subfactory, a
+    CommandFactoryABS, from the options with that segment as db_segment and
+    its filters as filters.  Results are keyed by segment NAME.  The
+    MultiCommand gets the options too, so the request's budget,
+    allow_partial and profiler cover it as well as each segment.
+    """
+    def __init__(self, options, subfactory, MultiCommandClass=MultiCommand):
+        self._options = options
+        self._subfactory = subfactory
+        self._MultiCommandClass = MultiCommandClass
+
+    def create_command(self):
+        subcommands = {}
+        for segment, filters in self._options['filters'].iteritems():
+            options = dict(self._options)
+            options['db_segment'] = segment
+            options['filters'] = filters
+            subcommands[segment.NAME] = \
+                self._subfactory(options).create_command()
+
+        options = dict(self._options)
+        options['subcommands'] = subcommands
+        return self._MultiCommandClass(options)
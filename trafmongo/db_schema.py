@@ -22,10 +22,13 @@ if sys.version_info < (2,6,0):
             return self.fget.__doc__
 # End Hack
 
+import json
 import math
 import re
 from collections import defaultdict
 
+from cache import ResultCache
+
 class HotDataFormat(object):
     """
     Information and functions for the Hot Data collection format.
@@ -48,6 +51,7 @@ class HotDataFormat(object):
     CLIENT_FLAGS = 'f1'
     SERVER_FLAGS = 'f2'
     MESSAGE = 'm'
+    PACKETS = 'pk'
     TIME_BEGIN = 'tb'
     INDX_TIME_BEGIN = 'tbm'
     TIME_END = 'te'
@@ -242,7 +246,14 @@ class OtherTrafficSegment(TrafficSegmentABS):
         'capture_bytes': 'oth_captureBytes',
         'capture_info': 'oth_captureInfo',
         'capture_groups': 'oth_captureGroups',
-        'capture_groups2': 'oth_captureGroups2'
+        'capture_groups2': 'oth_captureGroups2',
+        # ARP graph rollups.  One document per window per (s, d) pair,
+        # {tbm: window start, s: source, d: destination, pk: packets},
+        # covering the ARP records that began in that window.
+        'arp_groups': 'oth_arpGroups',
+        'arp_groups2': 'oth_arpGroups2',
+        # {_id: rollup collection name, until: end of the last window done}
+        'arp_rollup_status': 'oth_arpRollupStatus'
     }
 
 DB_SEGMENTS = {
@@ -318,6 +329,21 @@ class MongoJSON(object):
 
         return mongo_query
 
+    @classmethod
+    def ranges(cls, queryname, intervals):
+        """
+        Matches queryname within any of intervals, a sorted list of disjoint
+        [start, end] pairs (both inclusive): a single range directly, several
+        as an $or of them, and none, not at all.
+        """
+        docs = [{queryname: {"$gte": start, "$lte": end}}
+                for start, end in intervals]
+        if len(docs) == 1:
+            return docs[0]
+        if not docs:
+            return {queryname: {"$in": []}}
+        return {"$or": docs}
+
     @classmethod
     def pr(cls, queryname, pr, positive=True):
         if positive:
@@ -341,15 +367,146 @@ class MongoJSON(object):
         else:
             return {queryname: {"$not": expr}}
 
+###
+# Address intervals
+#
+# IP filters are combined as sets of addresses rather than as one range (or,
+# negated, an $or of two) per filter.  An interval list is a sorted list of
+# disjoint, non-adjacent [start, end] pairs, ends included.
+IPV4_MAX = 2 ** 32 - 1
+ALL_ADDRESSES = [(0, IPV4_MAX)]
+
+def cidr_interval(ipaddr):
+    """
+    Returns the (first, last) addresses of [address, netmask length].
+    """
+    size = 2 ** (32 - ipaddr[1])
+    start = ipaddr[0] - (ipaddr[0] % size)
+    return (start, start + size - 1)
+
+def merge_intervals(intervals):
+    """
+    Returns any [start, end] pairs as an interval list, with overlapping and
+    adjacent ones merged.
+    """
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1] + 1:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+def intersect_intervals(a, b):
+    """
+    Returns the addresses in both interval lists a and b.
+    """
+    both = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        start = max(a[i][0], b[j][0])
+        end = min(a[i][1], b[j][1])
+        if start <= end:
+            both.append((start, end))
+        if a[i][1] < b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return both
+
+def complement_intervals(intervals):
+    """
+    Returns the addresses not in an interval list.
+    """
+    rest = []
+    next = 0
+    for start, end in intervals:
+        if start > next:
+            rest.append((next, start - 1))
+        next = end + 1
+    if next <= IPV4_MAX:
+        rest.append((next, IPV4_MAX))
+    return rest
+
+def subtract_intervals(a, b):
+    """
+    Returns the addresses in interval list a but not b.
+    """
+    return intersect_intervals(a, complement_intervals(b))
+
+class AddressRanges(object):
+    """
+    The client and server addresses that a set of IP filters (all of which
+    have to match) allow, each as an interval list: positive filters'
+    subnets intersected, less negative filters' subnets.  Becomes one
+    match document per field filtered on, each a single range or an $or of
+    them, so each is a handful of index range scans however many subnets
+    went in.
+    """
+    def __init__(self, filters=()):
+        self.within = {}    # field -> interval list, of the positive subnets
+        self.excluded = {}  # field -> [interval, ...], the negative subnets
+        for filter in filters:
+            self.add(filter)
+
+    def add(self, filter):
+        for name, field in ((HTTPGetFormat.SOURCE, HotDataFormat.CLIENT_IP),
+                            (HTTPGetFormat.DEST, HotDataFormat.SERVER_IP)):
+            ipaddr = getattr(filter, name)
+            if ipaddr is None:
+                continue
+            subnet = cidr_interval(ipaddr)
+            if filter.positive:
+                self.within[field] = intersect_intervals(
+                    self.within.get(field, ALL_ADDRESSES), [subnet])
+            else:
+                self.excluded.setdefault(field, []).append(subnet)
+
+    @property
+    def allowed(self):
+        """
+        {field: interval list} for each field filtered on.  The negative
+        subnets, which may overlap, are merged into an interval list first
+        and taken off in one pass.
+        """
+        allowed = {}
+        for field in set(self.within) | set(self.excluded):
+            intervals = self.within.get(field, ALL_ADDRESSES)
+            if field in self.excluded:
+                intervals = subtract_intervals(
+                    intervals, merge_intervals(self.excluded[field]))
+            allowed[field] = intervals
+        return allowed
+
+    def to_match_docs(self):
+        return [MongoJSON.ranges(field, intervals)
+                for field, intervals in sorted(self.allowed.iteritems())]
+
 class TrafficFilterABS(object):
     """
     Scaffolding around the 'options' concept
     """
+    # The attributes a filter of this type can be configured with.
+    FIELDS = ()
+
     def __init__(self, json):
         self.positive = True # Init.
         for name, value in json.iteritems():
             setattr(self, name, value)
 
+    def to_json(self):
+        """
+        Returns the filter's settings as a json-able dictionary, the same
+        shape the constructor takes.
+        """
+        settings = {HGF.POSITIVE: self.positive}
+        for name in self.FIELDS:
+            value = getattr(self, name)
+            if value is not None:
+                settings[name] = value
+        return settings
+
     def is_empty(self):
         """
         If true indicates an empty filter. (Which is a filter to select all
@@ -367,6 +524,8 @@ class IPTrafficFilter(TrafficFilterABS):
     """
     Used to generate match documents for mongodb
     """
+    FIELDS = ('s', 'd')
+
     @staticmethod
     def check_ip(ip):
         if not isinstance(ip,list):
@@ -391,13 +550,20 @@ class IPTrafficFilter(TrafficFilterABS):
             return False
         return True
 
-    def to_match_doc(self):
+    def to_match_doc(self, addresses=True):
+        """
+        Without addresses, leaves out s and d, for a TrafficFilterList to
+        combine with other filters' (see AddressRanges).
+        """
         pson = {}
-        if self.s is not None:
-            pson.update(MongoJSON.cidr(HotDataFormat.CLIENT_IP, self.s, self.positive))
-            
-        if self.d is not None:
-            pson.update(MongoJSON.cidr(HotDataFormat.SERVER_IP, self.d, self.positive))
+        if addresses:
+            # A negated s and d each need an $or, so more than one field
+            # goes in an $and.
+            docs = AddressRanges([self]).to_match_docs()
+            if len(docs) == 1:
+                pson.update(docs[0])
+            elif docs:
+                pson["$and"] = docs
             
         return pson
             
@@ -423,6 +589,7 @@ class UDPTrafficFilter(IPTrafficFilter):
     """
 
     TYPE = UDPTrafficSegment
+    FIELDS = IPTrafficFilter.FIELDS + ('p1', 'p2')
 
     @staticmethod
     def check_p(p):
@@ -446,8 +613,8 @@ class UDPTrafficFilter(IPTrafficFilter):
             return False
         return True
 
-    def to_match_doc(self):
-        pson = super(UDPTrafficFilter,self).to_match_doc()
+    def to_match_doc(self, addresses=True):
+        pson = super(UDPTrafficFilter,self).to_match_doc(addresses)
         if self.p1 is not None:
             pson.update(MongoJSON.port(HotDataFormat.CLIENT_PORT, self.p1, self.positive))
             
@@ -484,6 +651,7 @@ class ICMPTrafficFilter(IPTrafficFilter):
     """
 
     TYPE = ICMPTrafficSegment
+    FIELDS = IPTrafficFilter.FIELDS + ('ty1',)
 
     TY_RE = re.compile("""
         [0-9]{1,2}      # First Number
@@ -511,8 +679,8 @@ class ICMPTrafficFilter(IPTrafficFilter):
             return False
         return True
 
-    def to_match_doc(self):
-        pson = super(ICMPTrafficFilter,self).to_match_doc()
+    def to_match_doc(self, addresses=True):
+        pson = super(ICMPTrafficFilter,self).to_match_doc(addresses)
         if self.ty1 is not None:
             pson.update(MongoJSON.port(HotDataFormat.TYPE_1, self.ty1, self.positive))
         return pson
@@ -528,6 +696,7 @@ class ICMPTrafficFilter(IPTrafficFilter):
 
 class OtherTrafficFilter(TrafficFilterABS):
     TYPE = OtherTrafficSegment
+    FIELDS = ('m', 's', 'd')
 
     ADDR_RE = re.compile("""
         [0-9a-fA-F.*:]*     #Just a collection of numbers and punctuation.
@@ -625,25 +794,86 @@ class TrafficFilterList(list):
                 break
         return answer
 
+    def fingerprint(self):
+        """
+        Returns a string that identifies this set of filters, regardless of
+        the order they're in.
+        """
+        filters = sorted(json.dumps([filter.TYPE.NAME, filter.to_json()],
+                                    sort_keys=True)
+                         for filter in self)
+        return '[' + ', '.join(filters) + ']'
+
     def to_match_doc(self):
         ands = []
 
+        # IP addresses from every filter are combined into the fewest ranges
+        # (see AddressRanges), and go first.
+        addresses = AddressRanges()
+
         # We treat the first positive filter differently, putting it first.
         placed_first = False
         for filter in self:
-            json = filter.to_match_doc()
+            if isinstance(filter, IPTrafficFilter):
+                addresses.add(filter)
+                json = filter.to_match_doc(addresses=False)
+                if not json:
+                    continue
+            else:
+                json = filter.to_match_doc()
             if placed_first or not filter.positive:
                 ands.append(json)
             else:
                 placed_first = True
                 ands.insert(0, json)
-            
+
+        ands[:0] = addresses.to_match_docs()
+        if not ands:
+            ands.append({})
         return {"$and": ands}
+
+    def match_plan(self):
+        """
+        Returns the MatchPlan for these filters, compiled only the first time
+        any list of the same filters asks.
+        """
+        key = self.fingerprint()
+        hit, plan = MATCH_PLANS.lookup(key)
+        if not hit:
+            plan = MatchPlan(self)
+            MATCH_PLANS.store(key, plan)
+        return plan
                 
     @property
     def TYPE(self):
         return self[0].TYPE
 
+class MatchPlan(object):
+    """
+    A TrafficFilterList's part of a match document, built once and kept, with
+    the timeframe left as a parameter.  Plans are shared, so the documents
+    they hold are never to be modified; to_match_doc() returns a fresh
+    $and around them.
+    """
+    def __init__(self, filters):
+        self.fingerprint = filters.fingerprint()
+        self.ands = ()
+        if len(filters) > 0:
+            self.ands = tuple(filters.to_match_doc()["$and"])
+
+    def to_match_doc(self, timeframe=None):
+        """
+        Returns {"$and": [timeframe's match document, filters'...]}, without
+        the timeframe if it's None.
+        """
+        ands = list(self.ands)
+        if timeframe is not None:
+            ands.insert(0, timeframe.to_match_doc())
+        return {"$and": ands}
+
+# Compiled MatchPlans, by the fingerprint of their filters, per worker process.
+MATCH_PLANS = ResultCache(maxsize=256)
+
 class PolyProtocolTrafficFiltersFactory(object):
     """
     Methods for creating filters.
@@ -728,6 +958,20 @@ class Timeframe(object):
     def duration(self):
         return self._end - self._start
 
+    @staticmethod
+    def floor(time, duration):
+        """
+        Rounds time down to a multiple of duration.
+        """
+        return time - (time % duration)
+
+    @staticmethod
+    def ceil(time, duration):
+        """
+        Rounds time up to a multiple of duration.
+        """
+        return time + (-time % duration)
+
 class InfoTimeframe(Timeframe):
     def to_match_doc(self):
         pson = {}
@@ -738,6 +982,19 @@ class InfoTimeframe(Timeframe):
 
         return pson
 
+class InfoStartTimeframe(Timeframe):
+    """
+    Matches info documents that *begin* within the timeframe, rather than
+    overlapping it.  Consecutive InfoStartTimeframes partition the documents,
+    so results from each can be added up without counting anything twice.
+    """
+    def to_match_doc(self):
+        pson = {}
+        pson.update(MongoJSON.sec_range(HotDataFormat.TIME_BEGIN, self.start, self.end))
+        pson.update(MongoJSON.sec_range(HotDataFormat.INDX_TIME_BEGIN, self.start - 59, self.end + 59))
+
+        return pson
+
 class BytesTimeframe(Timeframe):
     def to_match_doc(self):
         pson = {}
@@ -754,3 +1011,104 @@ class GroupsTimeframe(Timeframe):
         # include the 15 minute interval that contains the start time.
         start = self.start - (self.start % self.SECONDS_PER_DOC)
         return MongoJSON.sec_range(HotDataFormat.INDX_TIME_BEGIN, start, self.end)
+
+class Groups2Timeframe(GroupsTimeframe):
+    SECONDS_PER_DOC = 3 * 60 * 60
+
+def split_timeframe(timeframe, pieces,
+                    align=TrafficSegmentABS.GROUPS_DOC_DURATION):
+    """
+    Splits timeframe into roughly pieces consecutive timeframes, split at
+    multiples of align, which between them match exactly what timeframe
+    does.  An InfoTimeframe's first piece matches the records overlapping
+    its start, as it did, and the rest are InfoStartTimeframes, so no record
+    is matched twice.  Other kinds split into more of the same kind; since
+    BytesTimeframes match documents overlapping them, their documents'
+    samples have to be clipped to each piece (see timeseries.Samples.clip).
+    """
+    size = int(math.ceil(timeframe.duration / float(max(pieces, 1))))
+    size = Timeframe.ceil(max(size, 1), align)
+
+    boundaries = [timeframe.start]
+    boundary = Timeframe.floor(timeframe.start, align) + size
+    while boundary < timeframe.end:
+        boundaries.append(boundary)
+        boundary += size
+    boundaries.append(timeframe.end)
+
+    Rest = type(timeframe)
+    if isinstance(timeframe, InfoTimeframe):
+        Rest = InfoStartTimeframe
+    return [type(timeframe)(boundaries[0], boundaries[1])] + \
+           [Rest(start, end) for start, end in zip(boundaries[1:-1],
+                                                   boundaries[2:])]
+
+###
+# Storage tiers
+#
+# Each segment keeps its traffic at three resolutions: bytes, a bucket a
+# second, and the groups and groups2 rollups, at 15 seconds and 2 minutes.
+# The rollups are far fewer documents, but they lose GROUP_INFO_LOST.
+#
+# (name in collectionNames, data pitch, document duration, timeframe class),
+# finest first.  Bytes documents aren't aligned to anything.
+TIERS = [
+    ('bytes', TrafficSegmentABS.BASE_DATA_PITCH, None, BytesTimeframe),
+    ('groups', TrafficSegmentABS.GROUPS_DATA_PITCH,
+     TrafficSegmentABS.GROUPS_DOC_DURATION, GroupsTimeframe),
+    ('groups2', TrafficSegmentABS.GROUPS2_DATA_PITCH,
+     TrafficSegmentABS.GROUPS2_DOC_DURATION, Groups2Timeframe),
+]
+
+def usable_tiers(segment, bucket_size=None, filters=None):
+    """
+    Returns the TIERS that can answer a query on segment: those whose pitch
+    divides bucket_size (in seconds; None for any), so every bucket is made
+    of whole samples, and, if the filters need a field the rollups lose,
+    only bytes.
+    """
+    tiers = [tier for tier in TIERS
+             if bucket_size is None or bucket_size % tier[1] == 0]
+    if filters is not None:
+        for param in segment.GROUP_INFO_LOST:
+            if filters.contains_param(param):
+                return tiers[:1]
+    return tiers
+
+def plan_tiers(segment, timeframe, bucket_size=None, filters=None):
+    """
+    Returns [(collection name, timeframe), ...], the pieces to read a query
+    on segment over timeframe from, in order.  The coarsest usable tier (see
+    usable_tiers) reads the middle of the timeframe, aligned to its
+    documents, and the unaligned ends are planned the same way with the
+    finer tiers, down to bytes, which can read anything.  So a week at a
+    ten minute pitch is mostly groups2 documents, with at most a few hours
+    of groups and a quarter hour of bytes at either end.
+
+    Bytes documents are matched if they overlap a piece, so their buckets
+    have to be clipped to it when the pieces' results are put together.
+    """
+    tiers = usable_tiers(segment, bucket_size, filters)
+    if not tiers:
+        raise ValueError("No data is kept at a pitch that divides %s seconds"
+                         % bucket_size)
+    return _plan_span(segment, timeframe.start, timeframe.end, tiers)
+
+def _plan_span(segment, start, end, tiers):
+    name, pitch, duration, TimeframeClass = tiers[-1]
+    collection = segment.collectionNames[name]
+    if duration is None:
+        return [(collection, TimeframeClass(start, end))]
+
+    middle_start = Timeframe.ceil(start, duration)
+    middle_end = Timeframe.floor(end, duration)
+    if middle_start >= middle_end:
+        return _plan_span(segment, start, end, tiers[:-1])
+
+    pieces = []
+    if start < middle_start:
+        pieces.extend(_plan_span(segment, start, middle_start, tiers[:-1]))
+    pieces.append((collection, TimeframeClass(middle_start, middle_end)))
+    if middle_end < end:
+        pieces.extend(_plan_span(segment, middle_end, end, tiers[:-1]))
+    return pieces
@@ -0,0 +1,228 @@
+# evaluate.py
+#
+# Applies a TrafficFilterList in process, rather than in mongo, to records
+# that are already here: cached results, rollups, json lines files.
+#
+# Records come in columnar batches, either a dictionary of NumPy arrays or a
+# NumPy record array, one column per field (see COLUMN_TYPES).  A filter list
+# is compiled once into predicates, each of which turns a batch into a boolean
+# mask with vectorized operations.  IP addresses are tested against the
+# combined ranges of every filter (see db_schema.AddressRanges) with a single
+# binary search, and everything else is evaluated from the same match
+# documents that mongo would be sent, so the two agree on what matches.  As in
+# mongo, a field a batch doesn't have matches no values, but does match
+# negations.
+
+import operator
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from trafmongo.db_schema import HotDataFormat as HDF
+from trafmongo.db_schema import (AddressRanges, IPTrafficFilter, InfoTimeframe,
+                                 InfoStartTimeframe)
+
+# The dtypes of the columns filters usually look at.
+COLUMN_TYPES = {
+    HDF.CLIENT_IP: 'uint32',
+    HDF.SERVER_IP: 'uint32',
+    HDF.CLIENT_PORT: 'uint16',
+    HDF.SERVER_PORT: 'uint16',
+    HDF.TIME_BEGIN: 'float64',
+    HDF.TIME_END: 'float64',
+}
+
+COMPARISONS = {
+    '$gt': operator.gt,
+    '$gte': operator.ge,
+    '$lt': operator.lt,
+    '$lte': operator.le,
+}
+
+def _column(batch, name):
+    """
+    Returns a batch's column, or None if it doesn't have one by that name.
+    """
+    names = getattr(getattr(batch, 'dtype', None), 'names', None)
+    if names is not None:
+        if name in names:
+            return batch[name]
+        return None
+    return batch.get(name)
+
+def batch_length(batch):
+    if hasattr(batch, 'dtype'):
+        return len(batch)
+    for column in batch.itervalues():
+        return len(column)
+    return 0
+
+def _none(batch):
+    return numpy.zeros(batch_length(batch), dtype=bool)
+
+def _negate(predicate):
+    def negated(batch):
+        return ~predicate(batch)
+    return negated
+
+def _all(predicates):
+    if len(predicates) == 1:
+        return predicates[0]
+    def all_of(batch):
+        mask = numpy.ones(batch_length(batch), dtype=bool)
+        for predicate in predicates:
+            mask &= predicate(batch)
+        return mask
+    return all_of
+
+def _any(predicates):
+    def any_of(batch):
+        mask = _none(batch)
+        for predicate in predicates:
+            mask |= predicate(batch)
+        return mask
+    return any_of
+
+def _compare(field, compare, value):
+    def comparison(batch):
+        column = _column(batch, field)
+        if column is None:
+            return _none(batch)
+        return numpy.asarray(compare(column, value), dtype=bool)
+    return comparison
+
+def _member(field, values):
+    values = numpy.array(list(values))
+    def member(batch):
+        column = _column(batch, field)
+        if column is None or len(values) == 0:
+            return _none(batch)
+        return numpy.in1d(column, values)
+    return member
+
+def in_intervals(field, intervals):
+    """
+    Returns a predicate testing if field is within any of intervals, an
+    interval list (see db_schema.merge_intervals): a binary search for the
+    last interval starting at or before each value, then a test against its
+    end.
+    """
+    starts = numpy.array([start for start, end in intervals],
+                         dtype=numpy.int64)
+    ends = numpy.array([end for start, end in intervals], dtype=numpy.int64)
+    def within(batch):
+        column = _column(batch, field)
+        if column is None or len(starts) == 0:
+            return _none(batch)
+        values = numpy.asarray(column, dtype=numpy.int64)
+        index = numpy.searchsorted(starts, values, 'right') - 1
+        return (index >= 0) & (values <= ends[numpy.maximum(index, 0)])
+    return within
+
+def compile_condition(field, condition):
+    """
+    Returns a predicate for the match document {field: condition}.
+    Understands equality, $ne, $not, $in and the comparisons, which is all
+    the filters produce.
+    """
+    if hasattr(condition, 'pattern'):
+        raise ValueError("Regular expressions can't be evaluated in process")
+    if not isinstance(condition, dict):
+        return _compare(field, operator.eq, condition)
+
+    predicates = []
+    for name, value in sorted(condition.iteritems()):
+        if name in COMPARISONS:
+            predicates.append(_compare(field, COMPARISONS[name], value))
+        elif name == '$ne':
+            predicates.append(_negate(_compare(field, operator.eq, value)))
+        elif name == '$not':
+            predicates.append(_negate(compile_condition(field, value)))
+        elif name == '$in':
+            predicates.append(_member(field, value))
+        else:
+            raise ValueError("Can't evaluate %s in process" % name)
+    return _all(predicates)
+
+def compile_doc(match_doc):
+    """
+    Returns a predicate for a match document: its fields' conditions, plus
+    any $and and $or of further documents.
+    """
+    predicates = []
+    for key, value in sorted(match_doc.iteritems()):
+        if key == '$and':
+            predicates.extend(compile_doc(doc) for doc in value)
+        elif key == '$or':
+            predicates.append(_any([compile_doc(doc) for doc in value]))
+        elif key.startswith('$'):
+            raise ValueError("Can't evaluate %s in process" % key)
+        else:
+            predicates.append(compile_condition(key, value))
+    if not predicates:
+        return lambda batch: numpy.ones(batch_length(batch), dtype=bool)
+    return _all(predicates)
+
+def compile_timeframe(timeframe):
+    """
+    Returns a predicate for an InfoTimeframe (records overlapping it) or an
+    InfoStartTimeframe (records beginning in it), on tb and te.
+    """
+    if isinstance(timeframe, InfoStartTimeframe):
+        return compile_doc({HDF.TIME_BEGIN: {"$gte": timeframe.start,
+                                             "$lt": timeframe.end}})
+    if isinstance(timeframe, InfoTimeframe):
+        return compile_doc({HDF.TIME_BEGIN: {"$lt": timeframe.end},
+                            HDF.TIME_END: {"$gte": timeframe.start}})
+    raise ValueError("Can't evaluate a %s in process"
+                     % type(timeframe).__name__)
+
+class FilterEvaluator(object):
+    """
+    A TrafficFilterList (and optionally a timeframe), compiled to test
+    batches of records in process.  Matches the same records as the filters'
+    match document would in mongo.
+    """
+    def __init__(self, filters, timeframe=None):
+        if numpy is None:
+            raise RuntimeError("Evaluating filters in process needs NumPy")
+
+        self.predicates = []
+        if timeframe is not None:
+            self.predicates.append(compile_timeframe(timeframe))
+
+        addresses = AddressRanges(filter for filter in filters
+                                  if isinstance(filter, IPTrafficFilter))
+        for field, intervals in sorted(addresses.allowed.iteritems()):
+            self.predicates.append(in_intervals(field, intervals))
+
+        for filter in filters:
+            if isinstance(filter, IPTrafficFilter):
+                match_doc = filter.to_match_doc(addresses=False)
+            else:
+                match_doc = filter.to_match_doc()
+            if match_doc:
+                self.predicates.append(compile_doc(match_doc))
+
+    def mask(self, batch):
+        """
+        Returns a boolean array, true for the records in batch that match.
+        """
+        mask = numpy.ones(batch_length(batch), dtype=bool)
+        for predicate in self.predicates:
+            if not mask.any():
+                break
+            mask &= predicate(batch)
+        return mask
+
+    def apply(self, batch):
+        """
+        Returns the records in batch that match, as a batch of the same kind.
+        """
+        mask = self.mask(batch)
+        if isinstance(batch, dict):
+            return dict((name, column[mask])
+                        for name, column in batch.iteritems())
+        return batch[mask]
@@ -0,0 +1,233 @@
+# indexes.py
+#
+# The indexes the traffic collections need, and a check that a query will be
+# able to use one of them.
+#
+# Indexes are declared per kind of collection (see the collectionNames of
+# each segment in db_schema.DB_SEGMENTS), following the match documents the
+# Timeframe classes and filters build.  ensure_indexes() creates them all;
+# it's run at startup (see trafmongo.main) or by the trafmongo-ensure-indexes
+# script.  An IndexChecker looks at a match document before it's run, and
+# complains if mongo would have to scan the whole collection for it.
+
+import logging
+import re
+
+from trafmongo.db_schema import HDF, HGF, DB_SEGMENTS
+
+log = logging.getLogger(__name__)
+
+ASCENDING = 1
+
+# Which time fields each kind of collection is queried on, in index order.
+# Bytes documents are matched with BytesTimeframe; info documents with
+# InfoTimeframe and InfoStartTimeframe, which use the minute-rounded index
+# helper fields; groups documents with GroupsTimeframe.
+TIME_FIELDS = {
+    'info': (HDF.INDX_TIME_BEGIN, HDF.INDX_TIME_END),
+    'bytes': (HDF.B_TIME_BEGIN, HDF.B_TIME_END),
+    'groups': (HDF.INDX_TIME_BEGIN,),
+}
+
+# The kind of each collection name in collectionNames.  Collections that
+# aren't listed here (like the ARP rollup status) are only ever looked up by
+# _id.
+COLLECTION_KINDS = {
+    'info': 'info',
+    'capture_info': 'info',
+    'bytes': 'bytes',
+    'capture_bytes': 'bytes',
+    'groups': 'groups',
+    'groups2': 'groups',
+    'capture_groups': 'groups',
+    'capture_groups2': 'groups',
+    'arp_groups': 'groups',
+    'arp_groups2': 'groups',
+}
+
+# Kinds of collection that keep the source and destination of each record,
+# and so are filtered on them.
+ADDRESSED_KINDS = set(('info', 'groups'))
+
+class IndexCoverageError(Exception):
+    """
+    A query would have scanned a whole collection.
+    """
+
+def segment_indexes(segment):
+    """
+    Returns {collection name: [index, ...]} for a segment, where each index is
+    a list of (field, direction) pairs, as pymongo's create_index takes.
+
+    Every collection gets an index on its time fields.  Those filtered by
+    address also get one per address field, followed by the start time, for
+    filters narrow enough to beat the timeframe.
+    """
+    addresses = (segment.GROUP_DEFS[HGF.SOURCE],
+                 segment.GROUP_DEFS[HGF.DEST])
+
+    declared = {}
+    for name, collection in segment.collectionNames.iteritems():
+        kind = COLLECTION_KINDS.get(name)
+        if kind is None:
+            continue
+
+        time_fields = TIME_FIELDS[kind]
+        indexes = [[(field, ASCENDING) for field in time_fields]]
+        if kind in ADDRESSED_KINDS:
+            for address in addresses:
+                indexes.append([(address, ASCENDING),
+                                (time_fields[0], ASCENDING)])
+        declared[collection] = indexes
+
+    return declared
+
+def declared_indexes(segments=None):
+    """
+    Returns {collection name: [index, ...]} for all the given segments (by
+    default, every one in DB_SEGMENTS).
+    """
+    if segments is None:
+        segments = DB_SEGMENTS.values()
+
+    declared = {}
+    for segment in segments:
+        declared.update(segment_indexes(segment))
+    return declared
+
+def ensure_indexes(db, segments=None, background=True):
+    """
+    Creates any of the declared indexes that db is missing.  Building an index
+    on a large collection takes a while, so by default it's done in the
+    background.  Returns [(collection name, index name), ...].
+    """
+    ensured = []
+    for collection, indexes in sorted(declared_indexes(segments).iteritems()):
+        for index in indexes:
+            name = db[collection].create_index(index, background=background)
+            log.debug("Index %s on %s is in place", name, collection)
+            ensured.append((collection, name))
+    return ensured
+
+def _anchored(pattern, options=''):
+    """
+    Tests if a regex, compiled or a string with its $options, only matches
+    from the start of a value, case-sensitively, so mongo can scan just a
+    range of the index for it.
+    """
+    if hasattr(pattern, 'pattern'):
+        if pattern.flags & re.IGNORECASE:
+            return False
+        pattern = pattern.pattern
+    return pattern.startswith('^') and 'i' not in options
+
+def _usable(condition):
+    """
+    Tests if a field's condition narrows an index scan on it.  Negations
+    ($ne, $not, $nin) and regexes that aren't anchored, or ignore case,
+    don't: mongo still has to walk the whole index.
+    """
+    if hasattr(condition, 'pattern'):
+        return _anchored(condition)
+    if isinstance(condition, dict):
+        for operator, value in condition.iteritems():
+            if not operator.startswith('$'):
+                return True # Matching a subdocument exactly
+            if operator in ('$eq', '$gt', '$gte', '$lt', '$lte', '$in'):
+                return True
+            if operator == '$regex' and \
+                    _anchored(value, condition.get('$options', '')):
+                return True
+        return False
+    return True
+
+def _conjuncts(match_doc):
+    """
+    Flattens a match document's (possibly nested) $and into its conditions:
+    returns ({field: [condition, ...]}, [[$or branch, ...], ...]).
+    """
+    fields = {}
+    ors = []
+    for key, value in match_doc.iteritems():
+        if key == '$and':
+            for doc in value:
+                more_fields, more_ors = _conjuncts(doc)
+                for field, conditions in more_fields.iteritems():
+                    fields.setdefault(field, []).extend(conditions)
+                ors.extend(more_ors)
+        elif key == '$or':
+            ors.append(value)
+        elif not key.startswith('$'):
+            fields.setdefault(key, []).append(value)
+    return fields, ors
+
+def covering_index(match_doc, indexes):
+    """
+    Returns the first of indexes (lists of (field, direction) pairs, or just
+    field names) that a query on match_doc can use, or None if it'd scan the
+    whole collection.
+
+    An index can be used if the query narrows its first field.  A query with
+    an $or can also use a different index for each branch, as long as every
+    branch has one.
+    """
+    fields, ors = _conjuncts(match_doc)
+    usable = set(field for field, conditions in fields.iteritems()
+                 if any(_usable(condition) for condition in conditions))
+
+    for index in indexes:
+        first = index[0]
+        if isinstance(first, (tuple, list)):
+            first = first[0]
+        if first in usable:
+            return index
+
+    for branches in ors:
+        branch_indexes = [covering_index(branch, indexes)
+                          for branch in branches]
+        if branches and None not in branch_indexes:
+            return branch_indexes[0]
+
+    return None
+
+class IndexChecker(object):
+    """
+    Checks queries against the indexes that actually exist in db before
+    they're run.  Uncovered queries are logged as warnings or, if strict,
+    refused with an IndexCoverageError.
+
+    Each collection's indexes are looked up once and remembered; call
+    forget() after changing them.
+    """
+    def __init__(self, db, strict=False):
+        self.db = db
+        self.strict = strict
+        self._indexes = {}
+
+    def indexes(self, collection):
+        """
+        Returns the key lists of collection's indexes.
+        """
+        indexes = self._indexes.get(collection)
+        if indexes is None:
+            information = self.db[collection].index_information()
+            indexes = [info['key'] for info in information.itervalues()]
+            self._indexes[collection] = indexes
+        return indexes
+
+    def forget(self):
+        self._indexes.clear()
+
+    def check(self, collection, match_doc):
+        """
+        Returns the index a query on collection with match_doc can use.  If
+        there isn't one, warns or raises, depending on strict.
+        """
+        index = covering_index(match_doc, self.indexes(collection))
+        if index is None:
+            message = ("Query on %s can't use an index, and would scan the "
+                       "whole collection: %r" % (collection, match_doc))
+            if self.strict:
+                raise IndexCoverageError(message)
+            log.warning(message)
+        return index
@@ -0,0 +1,188 @@
+# layout.py
+#
+# Server side layout for ARP graphs, so the browser only has to draw them.
+#
+# A Fruchterman-Reingold force directed layout, vectorized with NumPy: every
+# pair of nodes repels, every link attracts its ends, and each step moves a
+# node at most the current temperature, which cools as the layout settles.
+# The all-pairs repulsion is worked out a block of rows at a time, to bound
+# memory.  Positions are in the unit square.
+#
+# A layout can be warm started from an earlier one (see layout_table): nodes
+# keep their old positions, new ones start next to their neighbours, and only
+# a few cool steps are run, so a refreshed graph moves only a little.
+#
+# Every step is over all pairs of nodes, so graphs of more than MAX_NODES
+# nodes aren't laid out here at all, and a layout can be stopped between
+# steps when the request runs out of time.
+
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Graphs with more nodes than this are left for the browser to lay out, or
+# to be coarsened (see coarsen.py).  At this size a layout from scratch takes
+# about a second.
+MAX_NODES = 2000
+
+# Steps for a layout from scratch, and for one warm started from an earlier
+# layout.
+ITERATIONS = 60
+WARM_ITERATIONS = 12
+
+# The largest move a step can make, as a fraction of the unit square, at the
+# start of a layout from scratch and of a warm started one.
+TEMPERATURE = 0.1
+WARM_TEMPERATURE = 0.01
+
+# Pulls everything gently toward the middle, so unconnected pieces of the
+# graph don't drift off to the edges.
+GRAVITY = 10.0
+
+# How many pairwise differences to work on at once.
+BLOCK_ELEMENTS = 1 << 20
+
+# Nodes closer than this fraction of the ideal distance push each other as
+# if they were this far apart.
+MIN_DISTANCE = 0.01
+
+def force_layout(positions, sources, targets, weights,
+                 iterations=ITERATIONS, temperature=TEMPERATURE,
+                 out_of_time=None):
+    """
+    Lays out a graph of len(positions) nodes, starting from positions (an
+    (n, 2) array), with links given as parallel arrays of node numbers and
+    weights.  Returns the new (n, 2) array of positions, and whether every
+    step was run: out_of_time, if given, is called before each step, and
+    once it returns true the positions so far are returned.
+    """
+    positions = numpy.array(positions, dtype=numpy.float64)
+    count = len(positions)
+    if count == 0:
+        return positions, True
+
+    sources = numpy.asarray(sources, dtype=numpy.intp)
+    targets = numpy.asarray(targets, dtype=numpy.intp)
+
+    # Heavy links pull harder, but only logarithmically, or a few chatty
+    # pairs would collapse onto each other.
+    strengths = numpy.log1p(numpy.asarray(weights, dtype=numpy.float64))
+    if len(strengths):
+        strengths /= strengths.mean() or 1.0
+
+    k = math.sqrt(1.0 / count)  # The ideal distance between nodes
+    closest2 = (MIN_DISTANCE * k) ** 2
+    block = max(1, BLOCK_ELEMENTS // count)
+    cooling = temperature / (iterations + 1)
+
+    for step in xrange(iterations):
+        if out_of_time is not None and out_of_time():
+            return positions, False
+        moves = numpy.zeros_like(positions)
+
+        # Repulsion, k^2 / d, between every pair.  Summing
+        # (p_i - p_j) * k^2 / d_ij^2 over j is p_i * sum_j(f_ij) - f . p, and
+        # the distances come from |p_i|^2 + |p_j|^2 - 2 p_i . p_j, so all
+        # the work over pairs is a few matrix products and elementwise ops.
+        # Single precision is plenty for a picture, and twice as fast.
+        points = positions.astype(numpy.float32)
+        norms = numpy.einsum('ij,ij->i', points, points)
+        for start in xrange(0, count, block):
+            stop = min(start + block, count)
+            rows = points[start:stop]
+            force = numpy.dot(rows, points.T)
+            force *= -2.0
+            force += norms[start:stop, numpy.newaxis]
+            force += norms
+            numpy.maximum(force, closest2, out=force)
+            numpy.divide(k * k, force, out=force)
+            moves[start:stop] += (rows * force.sum(axis=1)[:, numpy.newaxis]
+                                  - numpy.dot(force, points))
+
+        # Attraction, d^2 / k, along each link.
+        if len(sources):
+            delta = positions[sources] - positions[targets]
+            distance = numpy.sqrt(numpy.einsum('ij,ij->i', delta, delta))
+            pull = delta * (distance * strengths / k)[:, numpy.newaxis]
+            numpy.add.at(moves, sources, -pull)
+            numpy.add.at(moves, targets, pull)
+
+        moves -= GRAVITY * (positions - 0.5)
+
+        # Move each node along its net force, at most temperature.
+        length = numpy.sqrt(numpy.einsum('ij,ij->i', moves, moves))
+        numpy.maximum(length, closest2, out=length)
+        positions += moves * (numpy.minimum(length, temperature)
+                              / length)[:, numpy.newaxis]
+        numpy.clip(positions, 0.0, 1.0, out=positions)
+
+        temperature -= cooling
+
+    return positions, True
+
+def initial_positions(names, sources, targets, previous, random):
+    """
+    Returns ((n, 2) starting positions, how many came from previous).
+
+    Nodes in previous, a {name: (x, y)} dictionary, start where they were.
+    Others start near the middle of their already placed neighbours, or
+    anywhere, if they have none.
+    """
+    count = len(names)
+    positions = random.uniform(0.0, 1.0, (count, 2))
+    placed = numpy.zeros(count, dtype=bool)
+    for number, name in enumerate(names):
+        position = previous.get(name)
+        if position is not None:
+            positions[number] = position
+            placed[number] = True
+
+    kept = int(placed.sum())
+    if 0 < kept < count and len(sources):
+        sources = numpy.asarray(sources, dtype=numpy.intp)
+        targets = numpy.asarray(targets, dtype=numpy.intp)
+
+        # Sum the placed neighbours of each node, both ways round.
+        ends = numpy.concatenate((sources, targets))
+        others = numpy.concatenate((targets, sources))
+        useful = placed[others]
+        ends = ends[useful]
+        others = others[useful]
+        totals = numpy.zeros((count, 2))
+        numpy.add.at(totals, ends, positions[others])
+        neighbours = numpy.bincount(ends, minlength=count)
+
+        new = ~placed & (neighbours > 0)
+        jitter = random.uniform(-0.01, 0.01, (int(new.sum()), 2))
+        positions[new] = (totals[new] / neighbours[new][:, numpy.newaxis]
+                          + jitter)
+
+    return positions, kept
+
+def layout_table(table, previous=None, out_of_time=None):
+    """
+    Lays out an arpgraph.ARPEdgeTable.  Returns a list of (x, y), one per
+    node in node number order, and whether the layout was finished (see
+    force_layout for out_of_time).  If previous, a {name: (x, y)} dictionary
+    from an earlier layout, shares any nodes with this one, the layout is
+    warm started from it.
+    """
+    names = list(table.iter_nodes())
+    sources, targets, weights = table.columns()
+
+    # Seeded by the graph, so the same graph is always laid out the same way.
+    random = numpy.random.RandomState(int(table.digest()[:8], 16))
+    positions, kept = initial_positions(names, sources, targets,
+                                        previous or {}, random)
+    if kept:
+        positions, finished = force_layout(positions, sources, targets,
+                                           weights, WARM_ITERATIONS,
+                                           WARM_TEMPERATURE, out_of_time)
+    else:
+        positions, finished = force_layout(positions, sources, targets,
+                                           weights, out_of_time=out_of_time)
+
+    return [(float(x), float(y)) for x, y in positions.tolist()], finished
@@ -6,8 +6,12 @@ import sys
 import re
 import socket   #For IP Address Manipulation
 import struct   #For IP Address Manipulation
+from collections import defaultdict
 from db_schema import HTTPGetFormat as HGF
 from db_schema import PolyProtocolTrafficFiltersFactory, Timeframe
+from db_schema import TrafficFilterList
+from cache import ResultCache
+from coarsen import MODES as COARSEN_MODES
 
 if sys.version_info < (2,6,0):
     import simplejson as json
@@ -21,6 +25,9 @@ TIME_PITCH = 'pitch'
 FILTERS = 'filters'
 GROUP_BY = 'groupBy'
 HOST_IP = 'hostip'
+WATERMARK = 'since'
+COARSEN = 'coarsen'
+EXPAND = 'expand'
 
 class GenericParser(object):
     """
@@ -251,6 +258,12 @@ class TrafficFiltersParserMixin(GenericParser):
         # If neither cidr or mac, the address must not be valid/supported.
         raise ValueError("Invalid address value: " + addr)
 
+    # Filters that don't say which protocols they're for apply to these.
+    DEFAULT_PROTOCOLS = PolyProtocolTrafficFiltersFactory.protocols
+
+    # If False, a missing filters parameter means no filters at all.
+    FILTERS_REQUIRED = True
+
     @staticmethod
     def parse_protocols(protocols):
         """
@@ -294,7 +307,9 @@ class TrafficFiltersParserMixin(GenericParser):
             try:
                 self.__filters_json = json.loads(self.to_parse.GET[FILTERS])
             except KeyError:
-                raise ValueError("Expected a json list for \"" + FILTERS + "\"")
+                if self.FILTERS_REQUIRED:
+                    raise ValueError("Expected a json list for \"" + FILTERS + "\"")
+                self.__filters_json = []
 
     def __add_hard_coded_filter(self):
         # XXX: Defunct
@@ -309,7 +324,26 @@ class TrafficFiltersParserMixin(GenericParser):
         return filter_json['positive']
 
     def traffic_filters_parser(self):
+        """
+        Parses the filters parameter, or, since dashboards ask for the same
+        filters over and over, finds them already parsed.  Filters from
+        the cache are shared between requests, and mustn't be modified.
+        """
         self.handled.add(FILTERS)
+        key = (self.to_parse.GET.get(FILTERS),
+               tuple(sorted(self.DEFAULT_PROTOCOLS)), self.FILTERS_REQUIRED)
+        hit, filters = PARSED_FILTERS.lookup(key)
+        if not hit:
+            filters = self.build_filters()
+            PARSED_FILTERS.store(key, filters)
+
+        self.parsed['filters'] = defaultdict(TrafficFilterList, filters)
+
+    def build_filters(self):
+        """
+        Validates the filters parameter and builds the filters from it.
+        Returns {segment: TrafficFilterList}.
+        """
         self.__load_json()
 
         valid_filters_json = []
@@ -320,7 +354,7 @@ class TrafficFiltersParserMixin(GenericParser):
 
             # Set default protocols (all) if none are specified.
             if HGF.TRANSPORT not in filter_json:
-                filter_json[HGF.TRANSPORT] = list(PolyProtocolTrafficFiltersFactory.protocols)
+                filter_json[HGF.TRANSPORT] = list(self.DEFAULT_PROTOCOLS)
 
             # Put each parameter through its respective parser
             for param, value in filter_json.iteritems():
@@ -344,7 +378,11 @@ class TrafficFiltersParserMixin(GenericParser):
             # Put the validated json through the filter factory
             factory.create_one(valid_json)
 
-        self.parsed['filters'] = factory.output
+        return factory.output
+
+# Parsed filters, by the raw filters parameter (and the parser's defaults),
+# per worker process.
+PARSED_FILTERS = ResultCache(maxsize=256)
 
 class TimePitchParserMixin(GenericParser):
     """
@@ -367,6 +405,57 @@ class TimePitchParserMixin(GenericParser):
         self.parsed['bucket_size'] = valid_value
         
 
+class WatermarkParserMixin(GenericParser):
+    """
+    Parses out the optional 'since' parameter, a watermark handed back by an
+    earlier response.
+    """
+    WATERMARK_RE = re.compile("^[0-9a-f]{40}$")
+
+    def __init__(self):
+        super(WatermarkParserMixin,self).__init__()
+        self._add_step(self.watermark_parser)
+
+    def watermark_parser(self):
+        self.handled.add(WATERMARK)
+
+        watermark = self.to_parse.GET.get(WATERMARK) or None
+        if watermark is not None and not self.WATERMARK_RE.match(watermark):
+            raise ValueError("Expected \"" + WATERMARK + "\" to be a "
+                             "watermark from an earlier response")
+
+        self.parsed['since'] = watermark
+
+class CoarsenParserMixin(GenericParser):
+    """
+    Parses out the optional 'coarsen' parameter, how to group the graph's
+    nodes, and 'expand', a group to show the members of.  Neither ends up in
+    parsed unless it's given.
+    """
+    def __init__(self):
+        super(CoarsenParserMixin,self).__init__()
+        self._add_step(self.coarsen_parser)
+
+    def coarsen_parser(self):
+        self.handled.add(COARSEN)
+        self.handled.add(EXPAND)
+
+        mode = self.to_parse.GET.get(COARSEN) or None
+        expand = self.to_parse.GET.get(EXPAND) or None
+        if mode is None:
+            if expand is not None:
+                raise ValueError("\"" + EXPAND + "\" only makes sense with "
+                                 "\"" + COARSEN + "\"")
+            return
+
+        if mode not in COARSEN_MODES:
+            raise ValueError("Expected \"" + COARSEN + "\" to be one of " +
+                             ", ".join(COARSEN_MODES))
+
+        self.parsed['coarsen'] = mode
+        if expand is not None:
+            self.parsed['expand'] = expand
+
 # The order of classes is important.  Here, TimePitchParserMixin is given a
 # "more basic" spot, so that it will execute relevent pieces of code before
 # TimeframeParserMixin.  Google python mro for more information.
@@ -384,3 +473,23 @@ class HostByIPParser(TimeframeParserMixin, IPParserMixin):
     """
     Parser for HostByIP
     """
+
+class ARPGraphParser(TrafficFiltersParserMixin, TimeframeParserMixin):
+    """
+    Parser for the ARP graph.  ARP lives with the non-IP traffic, so filters
+    default to the "other" protocol, and are optional.
+    """
+    DEFAULT_PROTOCOLS = ['other']
+    FILTERS_REQUIRED = False
+
+class ARPGraphDeltaParser(ARPGraphParser, WatermarkParserMixin):
+    """
+    Parser for changes to the ARP graph: the graph's parameters, plus the
+    watermark of the graph the client already has.
+    """
+
+class ARPGraphCoarsenParser(ARPGraphParser, CoarsenParserMixin):
+    """
+    Parser for the ARP graph with an optional level of detail: the graph's
+    parameters, plus how to group its nodes.
+    """
@@ -0,0 +1,209 @@
+# profiling.py
+#
+# Lightweight, per request profiling for commands, reported in debug_info.
+#
+# A Profiler times named phases (wall clock and CPU), and, for each query a
+# command runs, asks mongo to explain the query's $match and keeps a summary:
+# the index used, if any, and documents examined against returned.  Explains
+# run the match again, so profiling is off (a NullProfiler) unless a request
+# is picked by the sampling rate, or asks for it where that's been turned on
+# (see profiler_for), and explains get no more time than the query has.
+
+import random
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+PROFILE = 'profile'
+
+def cpu_time():
+    """
+    Seconds of CPU used by the process so far, user and system.  Counts
+    every thread, so phases that overlap other work are overstated.
+    """
+    if resource is None:
+        return time.clock()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def _winning_stages(plan):
+    """
+    Yields every stage of a (modern) explain plan tree.
+    """
+    yield plan
+    children = list(plan.get('inputStages', ()))
+    if 'inputStage' in plan:
+        children.append(plan['inputStage'])
+    for child in children:
+        for stage in _winning_stages(child):
+            yield stage
+
+def summarize_explain(explain):
+    """
+    Boils the output of cursor.explain() down to
+    {"index": name or None for a collection scan, "examined": documents,
+     "keys": index keys examined, "returned": documents, "millis": ...}.
+    Understands both the mongo 3 format (queryPlanner, executionStats) and
+    the older one (cursor, nscanned, n).  Missing numbers are None.
+    """
+    if 'queryPlanner' in explain:
+        indexes = []
+        for stage in _winning_stages(explain['queryPlanner']['winningPlan']):
+            if stage.get('stage') == 'IXSCAN':
+                indexes.append(stage.get('indexName'))
+        stats = explain.get('executionStats', {})
+        return {
+            "index": ", ".join(indexes) or None,
+            "examined": stats.get('totalDocsExamined'),
+            "keys": stats.get('totalKeysExamined'),
+            "returned": stats.get('nReturned'),
+            "millis": stats.get('executionTimeMillis'),
+        }
+
+    # Before mongo 3.  An $or explains each of its clauses separately.
+    clauses = explain.get('clauses') or [explain]
+    indexes = []
+    for clause in clauses:
+        cursor = clause.get('cursor', '')
+        if cursor.startswith('BtreeCursor '):
+            indexes.append(cursor[len('BtreeCursor '):].split(' ')[0])
+    return {
+        "index": ", ".join(indexes) or None,
+        "examined": explain.get('nscannedObjects'),
+        "keys": explain.get('nscanned'),
+        "returned": explain.get('n'),
+        "millis": explain.get('millis'),
+    }
+
+class _Phase(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.wall = time.time()
+        self.cpu = cpu_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.record(self.name, time.time() - self.wall,
+                             cpu_time() - self.cpu)
+        return False
+
+class _NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+class NullProfiler(object):
+    """
+    A profiler that does nothing, at next to no cost.  The default.
+    """
+    enabled = False
+    report = None
+
+    def phase(self, name):
+        """
+        Returns a context manager that times what it wraps as phase name.
+        """
+        return _NullPhase()
+
+    def iter_phase(self, name, iterable):
+        """
+        Returns iterable, with the time spent producing each item counted
+        as phase name.
+        """
+        return iterable
+
+    def query(self, collection, match_doc, remaining=None):
+        """
+        Notes a query on collection (a pymongo collection) with match_doc,
+        which has remaining seconds to run in, or None for as long as it
+        takes.  Returns the query's entry in the report, for the caller to
+        count "results" into, or None.
+        """
+        return None
+
+NULL_PROFILER = NullProfiler()
+
+class Profiler(NullProfiler):
+    """
+    Collects a report:
+
+        {"phases": {name: {"wall": ms, "cpu": ms, "count": n}, ...},
+         "queries": [{"collection": ..., "index": ..., "examined": ...,
+                      "keys": ..., "returned": ..., "millis": ...,
+                      "results": documents out of the pipeline}, ...]}
+
+    Phases run more than once are added up.  Safe to share between the
+    threads of a MultiCommand.
+    """
+    enabled = True
+
+    def __init__(self, explain=True):
+        self.explain = explain
+        self.report = {"phases": {}, "queries": []}
+        self._lock = threading.Lock()
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def record(self, name, wall, cpu):
+        self._lock.acquire()
+        try:
+            phase = self.report["phases"].setdefault(
+                name, {"wall": 0.0, "cpu": 0.0, "count": 0})
+            phase["wall"] = round(phase["wall"] + wall * 1000, 3)
+            phase["cpu"] = round(phase["cpu"] + cpu * 1000, 3)
+            phase["count"] += 1
+        finally:
+            self._lock.release()
+
+    def iter_phase(self, name, iterable):
+        iterator = iter(iterable)
+        while True:
+            phase = self.phase(name).__enter__()
+            try:
+                item = iterator.next()
+            except StopIteration:
+                phase.__exit__()
+                return
+            phase.__exit__()
+            yield item
+
+    def query(self, collection, match_doc, remaining=None):
+        entry = {"collection": collection.name, "results": 0}
+        if self.explain:
+            try:
+                cursor = collection.find(match_doc)
+                if remaining is not None:
+                    cursor = cursor.max_time_ms(max(1, int(remaining * 1000)))
+                entry.update(summarize_explain(cursor.explain()))
+            except Exception, e:
+                entry["error"] = str(e)
+
+        self._lock.acquire()
+        try:
+            self.report["queries"].append(entry)
+        finally:
+            self._lock.release()
+        return entry
+
+def profiler_for(request, sample_rate=0.0, random=random.random,
+                 on_request=False):
+    """
+    Returns a Profiler if the request is picked by sample_rate, the fraction
+    of requests to profile, or, with on_request, asks for one (?profile=1),
+    and otherwise NULL_PROFILER.
+    """
+    asked = on_request and \
+            request.GET.get(PROFILE, '').lower() in ('1', 'true', 'yes')
+    if asked or (sample_rate > 0 and random() < sample_rate):
+        return Profiler()
+    return NULL_PROFILER
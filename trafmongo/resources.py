@@ -21,12 +21,18 @@ class ARPGraphData(BaseResource):
     /api/arpgraph
     """
 
+class ARPGraphDeltaData(BaseResource):
+    """
+    /api/arpgraphdelta
+    """
+
 class API(BaseResource):
     """
     Ajax API. (Not really REST)
     /api
     """
-    subresources = {"arpgraph": ARPGraphData}
+    subresources = {"arpgraph": ARPGraphData,
+                    "arpgraphdelta": ARPGraphDeltaData}
 
 class ARPViz(BaseResource):
     """
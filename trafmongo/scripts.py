@@ -0,0 +1,92 @@
+###
+# scripts.py
+#
+# Command line entry points.  See entry_points in setup.py.
+###
+
+import sys
+from optparse import OptionParser
+
+import pymongo
+
+from trafmongo import DB_URI, DB_PORT, DB_NAME
+from trafmongo.arpgraph_commands import ARPRollupCommandFactory
+from trafmongo.db_schema import DB_SEGMENTS
+from trafmongo.indexes import ensure_indexes as ensure_db_indexes
+
+def db_option_parser(usage):
+    """
+    An OptionParser that knows how to find the database.
+    """
+    parser = OptionParser(usage=usage)
+    parser.add_option("--host", default=DB_URI,
+                      help="MongoDB host [%default]")
+    parser.add_option("--port", type="int", default=DB_PORT,
+                      help="MongoDB port [%default]")
+    parser.add_option("--db", default=DB_NAME,
+                      help="Traffic database name [%default]")
+    return parser
+
+def connect(options):
+    return pymongo.Connection(options.host, options.port)[options.db]
+
+def arp_rollup(argv=None):
+    """
+    Brings the ARP graph rollups up to date.  Meant to be run from cron every
+    few minutes.
+    """
+    parser = db_option_parser("%prog [options]")
+    parser.add_option("--max-duration", type="int", metavar="SECONDS",
+                      help="The longest a record lasts; windows are held "
+                           "back this long for records still going")
+    parser.add_option("--lag", type="int", metavar="SECONDS",
+                      help="Hold windows back a further SECONDS for records "
+                           "to be written")
+    parser.add_option("--since", type="int", metavar="TIME",
+                      help="Start a rollup that has never been run at TIME "
+                           "(seconds since the epoch) [the oldest record]")
+    parser.add_option("--budget", type="float", metavar="SECONDS",
+                      help="Stop after SECONDS, leaving the rest for the "
+                           "next run")
+    options, args = parser.parse_args(argv)
+    if args:
+        parser.error("Unexpected arguments")
+
+    command_options = {'db': connect(options), 'allow_partial': True}
+    if options.budget is not None:
+        command_options['budget'] = options.budget
+    if options.max_duration is not None:
+        command_options['max_duration'] = options.max_duration
+    if options.lag is not None:
+        command_options['lag'] = options.lag
+    if options.since is not None:
+        command_options['since'] = options.since
+
+    command = ARPRollupCommandFactory(command_options).create_command()
+    command.execute()
+    for collection, status in sorted(command.annotated_results.items()):
+        sys.stdout.write("%s: %d windows, done until %s\n"
+                         % (collection, status["windows"], status["until"]))
+
+def ensure_indexes(argv=None):
+    """
+    Creates the indexes the traffic collections need, if they're missing.
+    """
+    parser = db_option_parser("%prog [options] [segment ...]")
+    parser.add_option("--foreground", action="store_true", default=False,
+                      help="Build indexes in the foreground, which is faster "
+                           "but blocks the database")
+    options, args = parser.parse_args(argv)
+    for name in args:
+        if name not in DB_SEGMENTS:
+            parser.error("Unknown segment %s; expected one of %s"
+                         % (name, ", ".join(sorted(DB_SEGMENTS))))
+
+    segments = None
+    if args:
+        segments = [DB_SEGMENTS[name] for name in args]
+
+    ensured = ensure_db_indexes(connect(options), segments,
+                                background=not options.foreground)
+    for collection, name in ensured:
+        sys.stdout.write("%s: %s\n" % (collection, name))
@@ -8,16 +8,70 @@ var force = d3.layout.force()
     .linkDistance(30)
     .size([width, height]);
 
+// The graph's parameters (see parse.ARPGraphParser) are taken from the
+// page's own query string: frameStart and frameEnd, in milliseconds, and
+// filters.  Without a timeframe, the last hour is drawn.
+function graphParams() {
+    var params = {};
+    window.location.search.replace(/^\?/, "").split("&").forEach(function(pair) {
+        var parts = pair.split("=");
+        if (parts[0]) {
+            params[decodeURIComponent(parts[0])] =
+                decodeURIComponent((parts[1] || "").replace(/\+/g, " "));
+        }
+    });
+
+    var now = new Date().getTime();
+    var graph = {
+        frameStart: params.frameStart || now - 60 * 60 * 1000,
+        frameEnd: params.frameEnd || now
+    };
+    if (params.filters) {
+        graph.filters = params.filters;
+    }
+    return graph;
+}
+
 $(function() {
     var svg = d3.select("#graph").append("svg:svg")
         .attr("width", width)
         .attr("height", height);
 
-    d3.json("/static/whohas.json", function(error, graph) {
-        force
-            .nodes(graph.nodes)
-            .links(graph.links)
-            .start();
+    d3.json("/api/arpgraph?" + $.param(graphParams()), function(error, response) {
+        if (error || !response.data) {
+            return;
+        }
+        var graph = response.data;
+
+        // /api/arpgraph lays graphs out on the server, in the unit square,
+        // and gives each node its x and y.  Scale them to fit and just draw
+        // them.  The force layout is only run here if a graph comes back
+        // without positions.
+        var laidOut = graph.nodes.length > 0 && graph.nodes.every(function(d) {
+            return d.x !== undefined && d.y !== undefined;
+        });
+
+        if (laidOut) {
+            var x = d3.scale.linear()
+                .domain(d3.extent(graph.nodes, function(d) { return d.x; }))
+                .range([20, width - 20]);
+            var y = d3.scale.linear()
+                .domain(d3.extent(graph.nodes, function(d) { return d.y; }))
+                .range([20, height - 20]);
+            graph.nodes.forEach(function(d) {
+                d.x = x(d.x);
+                d.y = y(d.y);
+            });
+            graph.links.forEach(function(d) {
+                d.source = graph.nodes[d.source];
+                d.target = graph.nodes[d.target];
+            });
+        } else {
+            force
+                .nodes(graph.nodes)
+                .links(graph.links)
+                .start();
+        }
 
         var link = svg.selectAll("line.link")
             .data(graph.links)
@@ -31,13 +85,12 @@ $(function() {
             .attr("class", "node")
 	    .attr("width", "40")
 	    .attr("height", "40")
-            .style("fill", function(d) { return "blue"; })
-            .call(force.drag);
+            .style("fill", function(d) { return "blue"; });
     
         node.append("title")
             .text(function(d) { return d.name; });
-    
-        force.on("tick", function() {
+
+        function draw() {
             link.attr("x1", function(d) { return d.source.x; })
                 .attr("y1", function(d) { return d.source.y; })
                 .attr("x2", function(d) { return d.target.x; })
@@ -45,6 +98,13 @@ $(function() {
     
             node.attr("x", function(d) { return d.x-20; })
                 .attr("y", function(d) { return d.y-20; });
-        });
+        }
+
+        if (laidOut) {
+            draw();
+        } else {
+            node.call(force.drag);
+            force.on("tick", draw);
+        }
     });
 });
@@ -0,0 +1,78 @@
+# streaming.py
+#
+# Responses that are written out a piece at a time, rather than rendered
+# whole.  Big results (like ARP graphs) would otherwise have to be serialized
+# into one string, and sit in the worker, before the first byte is sent.
+
+import zlib
+
+from pyramid.response import Response
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+GZIP_LEVEL = 6
+GZIP_WBITS = 16 + zlib.MAX_WBITS # A gzip header and trailer, not zlib's.
+
+def accepts_gzip(request):
+    """
+    Tests if the request's Accept-Encoding allows a gzipped response.
+    """
+    header = request.headers.get('Accept-Encoding', '')
+    for coding in header.split(','):
+        params = coding.strip().split(';')
+        name = params[0].strip().lower()
+        if name not in ('gzip', 'x-gzip', '*'):
+            continue
+
+        quality = 1.0
+        for param in params[1:]:
+            key, _, value = param.strip().partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            return True
+    return False
+
+def gzip_iter(chunks, level=GZIP_LEVEL):
+    """
+    Gzips an iterable of strings as it goes.  Only yields when the compressor
+    has something to hand over, so small chunks are coalesced.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+def iter_envelope(data_chunks, **fields):
+    """
+    Yields a json object, {"data": ..., <fields>}, where data is already json,
+    as an iterable of strings, and fields are plain values.  Data comes first
+    so it can start going out straight away.
+    """
+    yield '{"data": '
+    for chunk in data_chunks:
+        yield chunk
+    for name in sorted(fields):
+        yield ', %s: %s' % (json.dumps(name), json.dumps(fields[name]))
+    yield '}'
+
+def streaming_json_response(request, chunks):
+    """
+    Returns a Response that sends the json in chunks as it's produced, gzipped
+    on the way if the client can take it.
+    """
+    response = Response(content_type='application/json', charset='utf-8')
+    response.vary = ('Accept-Encoding',)
+    if accepts_gzip(request):
+        response.content_encoding = 'gzip'
+        chunks = gzip_iter(chunks)
+    response.app_iter = chunks
+    return response
@@ -14,3 +14,1336 @@ class ViewTests(unittest.TestCase):
         request = testing.DummyRequest()
         info = my_view(request)
         self.assertEqual(info['project'], 'TrafMongo')
+
+class ARPEdgeTableTests(unittest.TestCase):
+    def _make(self, records):
+        from trafmongo.arpgraph import ARPEdgeTable
+        table = ARPEdgeTable()
+        table.add_all(records)
+        return table
+
+    def test_numbering_and_weights(self):
+        table = self._make([
+            ("00:00:00:00:00:02", "00:00:00:00:00:01", 3),
+            ("00:00:00:00:00:01", "00:00:00:00:00:02", 4),
+            ("00:00:00:00:00:03", "00:00:00:00:00:01", 1),
+        ])
+        self.assertEqual(list(table.iter_nodes()), ["00:00:00:00:00:01",
+                                                    "00:00:00:00:00:02",
+                                                    "00:00:00:00:00:03"])
+        self.assertEqual(list(table.iter_links()), [(0, 1, 7), (0, 2, 1)])
+
+    def test_merge_matches_single_table(self):
+        from trafmongo.arpgraph import ARPEdgeTable
+        records = [
+            ("00:00:00:00:00:05", "00:00:00:00:00:04", 1),
+            ("00:00:00:00:00:04", "00:00:00:00:00:06", 2),
+            ("00:00:00:00:00:06", "00:00:00:00:00:05", 5),
+            ("00:00:00:00:00:05", "00:00:00:00:00:04", 1),
+        ]
+        merged = ARPEdgeTable()
+        merged.merge(*self._make(records[:2]).partial())
+        merged.merge(*self._make(records[2:]).partial())
+        whole = self._make(records)
+        self.assertEqual(list(merged.iter_nodes()), list(whole.iter_nodes()))
+        self.assertEqual(list(merged.iter_links()), list(whole.iter_links()))
+
+    def test_binary_round_trip(self):
+        from StringIO import StringIO
+        from trafmongo.arpgraph import write_graph_binary, read_graph_binary
+        table = self._make([
+            ("00:00:00:00:00:02", "00:00:00:00:00:01", 3),
+            ("00:00:00:00:00:03", "00:00:00:00:00:01", 2 ** 40),
+        ])
+        out = StringIO()
+        write_graph_binary(out, table)
+        copy = read_graph_binary(StringIO(out.getvalue()))
+        self.assertEqual(list(copy.iter_nodes()), list(table.iter_nodes()))
+        self.assertEqual(list(copy.iter_links()), list(table.iter_links()))
+
+    def test_json_output(self):
+        import json
+        from trafmongo.arpgraph import iter_graph_json
+        table = self._make([("00:00:00:00:00:02", "00:00:00:00:00:01", 3)])
+        graph = json.loads(''.join(iter_graph_json(table, chunk_size=1)))
+        self.assertEqual(graph, {
+            "nodes": [{"name": "00:00:00:00:00:01"},
+                      {"name": "00:00:00:00:00:02"}],
+            "links": [{"source": 0, "target": 1, "value": 3}]})
+
+    def test_digest_ignores_node_numbering(self):
+        from trafmongo.arpgraph import ARPEdgeTable
+        first = ARPEdgeTable()
+        first.add_all([("00:00:00:00:00:01", "00:00:00:00:00:02", 5),
+                       ("00:00:00:00:00:03", "00:00:00:00:00:01", 2)])
+        second = ARPEdgeTable()
+        second.add_all([("00:00:00:00:00:01", "00:00:00:00:00:03", 2),
+                        ("00:00:00:00:00:02", "00:00:00:00:00:01", 5)])
+        self.assertEqual(first.digest(), second.digest())
+        second.add("00:00:00:00:00:02", "00:00:00:00:00:01", 1)
+        second.flush()
+        self.assertNotEqual(first.digest(), second.digest())
+
+class HeavyLinkSummaryTests(unittest.TestCase):
+    def _records(self, count, seed):
+        # A few heavy links among many light ones, as in a busy segment.
+        import random
+        rng = random.Random(seed)
+        records = []
+        for i in xrange(count):
+            if rng.random() < 0.3:
+                a, b = rng.randint(1, 4), 0
+                weight = rng.randint(50, 100)
+            else:
+                a, b = rng.randint(1, 200), rng.randint(201, 400)
+                weight = rng.randint(1, 5)
+            records.append(("00:00:00:00:%02x:%02x" % divmod(a, 256),
+                            "00:00:00:00:%02x:%02x" % divmod(b, 256),
+                            weight))
+        return records
+
+    def _true_weights(self, records):
+        weights = {}
+        for macfrom, macto, weight in records:
+            key = tuple(sorted((macfrom, macto)))
+            weights[key] = weights.get(key, 0) + weight
+        return weights
+
+    def _assert_bounded(self, summary, records):
+        estimates = dict((tuple(sorted((a, b))), weight)
+                         for a, b, weight in summary.heaviest())
+        truth = self._true_weights(records)
+        self.assertEqual(summary.total, sum(truth.itervalues()))
+        self.assertTrue(summary.error <=
+                        summary.total / (summary.counters + 1.0))
+        for key, weight in truth.iteritems():
+            estimate = estimates.get(key, 0)
+            self.assertTrue(weight - summary.error <= estimate <= weight,
+                            (key, weight, estimate, summary.error))
+            if weight > summary.error:
+                self.assertTrue(key in estimates)
+
+    def test_compaction_keeps_the_error_bound(self):
+        from trafmongo.arpgraph import HeavyLinkSummary
+        summary = HeavyLinkSummary(10)
+        records = self._records(2000, 1)
+        summary.add_all(records)
+        self.assertTrue(summary.error > 0)
+        self.assertTrue(len(summary.weights) <= 2 * summary.counters)
+        self._assert_bounded(summary, records)
+        self.assertEqual(summary.error_bound()["max_underestimate"],
+                         summary.error)
+
+    def test_heaviest_links_come_first(self):
+        from trafmongo.arpgraph import HeavyLinkSummary
+        summary = HeavyLinkSummary(10)
+        summary.add_all([("00:00:00:00:00:01", "00:00:00:00:00:02", 5),
+                         ("00:00:00:00:00:03", "00:00:00:00:00:01", 9),
+                         ("00:00:00:00:00:02", "00:00:00:00:00:01", 2),
+                         ("00:00:00:00:00:04", "00:00:00:00:00:05", 1)])
+        self.assertEqual(summary.error, 0)
+        self.assertEqual(summary.heaviest(2), [
+            ("00:00:00:00:00:01", "00:00:00:00:00:03", 9),
+            ("00:00:00:00:00:01", "00:00:00:00:00:02", 7)])
+        self.assertEqual(len(summary.heaviest(min_weight=2)), 2)
+        table = summary.to_table(top=1)
+        self.assertEqual((table.node_count, table.link_count), (2, 1))
+
+    def test_merged_summaries_keep_the_error_bound(self):
+        from trafmongo.arpgraph import HeavyLinkSummary
+        first = self._records(1000, 2)
+        second = self._records(1000, 3)
+        summary = HeavyLinkSummary(10)
+        summary.add_all(first)
+        other = HeavyLinkSummary(10)
+        other.add_all(second)
+        summary.merge(*other.partial())
+        self.assertTrue(len(summary.weights) <= summary.counters)
+        self._assert_bounded(summary, first + second)
+
+class FakeCollection(object):
+    """
+    Hands back canned aggregation results, remembering the pipelines.
+    """
+    def __init__(self, results=(), found=None):
+        if not isinstance(results, Exception):
+            results = list(results)
+        self.results = results
+        self.found = found
+        self.pipelines = []
+        self.name = "fake"
+        self.indexes = {"_id_": {"key": [("_id", 1)]}}
+
+    def aggregate(self, pipeline, **kwargs):
+        self.pipelines.append(pipeline)
+        self.kwargs = kwargs
+        if isinstance(self.results, Exception):
+            raise self.results
+        return {"result": self.results, "ok": 1}
+
+    def find_one(self, spec):
+        return self.found
+
+    def find(self, spec):
+        return FakeCursor(spec)
+
+    def create_index(self, keys, **kwargs):
+        name = "_".join("%s_%s" % key for key in keys)
+        self.indexes[name] = {"key": keys}
+        return name
+
+    def index_information(self):
+        return self.indexes
+
+class FakeCursor(object):
+    def __init__(self, spec):
+        self.spec = spec
+        self.max_time = None
+
+    def max_time_ms(self, max_time):
+        self.max_time = max_time
+        return self
+
+    def explain(self):
+        return {"queryPlanner": {"winningPlan": {
+                    "stage": "FETCH",
+                    "inputStage": {"stage": "IXSCAN",
+                                   "indexName": "tbm_1_tem_1"}}},
+                "executionStats": {"totalDocsExamined": 10,
+                                   "totalKeysExamined": 12,
+                                   "nReturned": 8,
+                                   "executionTimeMillis": 3}}
+
+class FakeDatabase(dict):
+    def __missing__(self, name):
+        collection = self[name] = FakeCollection()
+        return collection
+
+class ARPGraphCommandTests(unittest.TestCase):
+    def _make_command(self, results, params=None, cache=None):
+        from trafmongo.parse import ARPGraphParser
+        from trafmongo.arpgraph_commands import (ARPGraphCommand,
+                                                 ARPGraphCommandFactory)
+        get = {"frameStart": "1361917125000", "frameEnd": "1361939174000"}
+        get.update(params or {})
+        options = ARPGraphParser().parse(testing.DummyRequest(params=get))
+        collection = FakeCollection(results)
+        options["db"] = FakeDatabase({ARPGraphCommand.COLLECTION: collection})
+        factory = ARPGraphCommandFactory(options, cache=cache)
+        return factory.create_command(), collection
+
+    def test_execute_builds_graph_from_reduced_edges(self):
+        command, collection = self._make_command([
+            {"_id": {"a": "00:00:00:00:00:01", "b": "00:00:00:00:00:02"},
+             "pk": 5},
+        ])
+        command.execute()
+        self.assertEqual(command.annotated_results.to_graph(), {
+            "nodes": [{"name": "00:00:00:00:00:02"},
+                      {"name": "00:00:00:00:00:01"}],
+            "links": [{"source": 1, "target": 0, "value": 5}]})
+
+        match, project, group = collection.pipelines[0]
+        self.assertEqual(group["$group"]["_id"], {"a": "$a", "b": "$b"})
+
+    def test_filters_are_matched_in_mongo(self):
+        command, collection = self._make_command([], {
+            "filters": '[{"positive": true, "s": "00:13:10:1a:a2:88"}]'})
+        command.execute()
+        match = collection.pipelines[0][0]["$match"]
+        self.assertTrue({"s": "00:13:10:1a:a2:88"} in match["$and"])
+
+    def test_cache_shares_snapped_timeframes(self):
+        from trafmongo.cache import ResultCache
+        cache = ResultCache()
+        results = [{"_id": {"a": "00:00:00:00:00:01",
+                            "b": "00:00:00:00:00:02"}, "pk": 5}]
+        first, collection = self._make_command(results, cache=cache)
+        first.execute()
+        second, unused = self._make_command(
+            results, {"frameEnd": "1361939174999"}, cache=cache)
+        second.execute()
+        self.assertFalse(first.debug_info["cache"]["hit"])
+        self.assertTrue(second.debug_info["cache"]["hit"])
+        self.assertTrue(second.annotated_results is first.annotated_results)
+
+    def test_long_timeframes_read_rollups(self):
+        from trafmongo.arpgraph_commands import (RAW, GROUPS, GROUPS2,
+                                                 ROLLUP_STATUS)
+        command, collection = self._make_command([], {
+            "frameStart": "1361917125000", "frameEnd": "1362217125000"})
+        command.db[ROLLUP_STATUS] = FakeCollection(found={"until": 1362199500})
+        plan = [(name, timeframe.start, timeframe.end)
+                for name, timeframe in command.plan()]
+        self.assertEqual(plan, [
+            (RAW, 1361917125, 1361917800),
+            (GROUPS, 1361917800, 1361923200),
+            (GROUPS2, 1361923200, 1362193200),
+            (GROUPS, 1362193200, 1362199500),
+            (RAW, 1362199500, 1362217125)])
+
+    def test_aligned_start_reads_records_overlapping_it(self):
+        from trafmongo.arpgraph_commands import RAW, GROUPS, ROLLUP_STATUS
+        command, collection = self._make_command([], {
+            "frameStart": "900000000", "frameEnd": "904500000"})
+        command.db[ROLLUP_STATUS] = FakeCollection(found={"until": 903600})
+        plan = command.plan()
+        self.assertEqual([(name, timeframe.start, timeframe.end)
+                          for name, timeframe in plan], [
+            (RAW, 900000, 900900),
+            (GROUPS, 900900, 903600),
+            (RAW, 903600, 904500)])
+        # Records that began before the start and are still going.
+        match = plan[0][1].to_match_doc()
+        self.assertEqual(match["te"], {"$gte": 900000})
+        self.assertEqual(match["tb"], {"$lt": 900900})
+
+class ARPRollupCommandTests(unittest.TestCase):
+    def _make_command(self, oldest=(), **options):
+        from trafmongo.arpgraph_commands import ARPRollupCommand, RAW
+
+        class OldestCollection(FakeCollection):
+            def find(self, spec, fields=None):
+                self.fields = fields
+                return self
+
+            def sort(self, key, direction):
+                self.sorted_on = key
+                return self
+
+            def limit(self, count):
+                return list(oldest)[:count]
+
+        options["db"] = FakeDatabase({RAW: OldestCollection()})
+        return ARPRollupCommand(options)
+
+    def test_windows_wait_for_the_longest_record(self):
+        import time
+        command = self._make_command(max_duration=3600, lag=900)
+        now = time.time()
+        self.assertTrue(now - 4501 <= command.rollable_until() <= now - 4500)
+
+    def test_first_window_is_found_on_the_index(self):
+        from trafmongo.arpgraph_commands import RAW, GROUPS_DURATION
+        command = self._make_command([{"tbm": 900000}])
+        self.assertEqual(command.first_window(RAW, GROUPS_DURATION), 899100)
+        self.assertEqual(command.db[RAW].sorted_on, "tbm")
+        self.assertEqual(self._make_command().first_window(RAW,
+                                                           GROUPS_DURATION),
+                         None)
+
+class ResultCacheTests(unittest.TestCase):
+    def test_lru_and_ttl(self):
+        from trafmongo.cache import ResultCache
+        now = [0]
+        cache = ResultCache(maxsize=2, clock=lambda: now[0])
+        cache.store("a", 1)
+        cache.store("b", 2, ttl=10)
+        cache.lookup("a")
+        cache.store("c", 3)
+        self.assertEqual(cache.lookup("b"), (False, None))
+        self.assertEqual(cache.lookup("a"), (True, 1))
+        cache.store("d", 4, ttl=10)
+        now[0] = 10
+        self.assertEqual(cache.lookup("d"), (False, None))
+        self.assertEqual(cache.stats()["hits"], 2)
+
+class IndexTests(unittest.TestCase):
+    def test_ensure_indexes_covers_timeframes_and_filters(self):
+        from trafmongo.db_schema import (InfoTimeframe, TrafficFilterList,
+                                         OtherTrafficFilter, TCPTrafficFilter)
+        from trafmongo.indexes import ensure_indexes, IndexChecker
+        db = FakeDatabase()
+        ensure_indexes(db)
+        self.assertTrue("tbm_1_tem_1" in db["tcp_sessionInfo"].indexes)
+        self.assertTrue("ip1_1_tbm_1" in db["tcp_sessionGroups"].indexes)
+        self.assertTrue("d_1_tbm_1" in db["oth_arpGroups"].indexes)
+
+        checker = IndexChecker(db, strict=True)
+        timeframe = InfoTimeframe(1361917125, 1361939174)
+        self.assertEqual(checker.check("tcp_sessionInfo",
+                                       timeframe.to_match_doc()),
+                         [("tbm", 1), ("tem", 1)])
+        filters = TrafficFilterList([OtherTrafficFilter({"s": "00:01"})])
+        self.assertEqual(checker.check("oth_arpGroups",
+                                       filters.to_match_doc()),
+                         [("s", 1), ("tbm", 1)])
+
+        # A negated subnet is an $or of two ranges, each able to use ip1.
+        negated = TrafficFilterList([TCPTrafficFilter({"s": [167772160, 8],
+                                                       "positive": False})])
+        self.assertEqual(checker.check("tcp_sessionInfo",
+                                       negated.to_match_doc()),
+                         [("ip1", 1), ("tbm", 1)])
+
+    def test_uncovered_queries_are_refused_when_strict(self):
+        from trafmongo.indexes import IndexChecker, IndexCoverageError
+        db = FakeDatabase()
+        checker = IndexChecker(db, strict=True)
+        self.assertRaises(IndexCoverageError, checker.check,
+                          "oth_sessionInfo", {"m": {"$ne": "x"}})
+        self.assertEqual(IndexChecker(db).check("oth_sessionInfo", {"tb": 1}),
+                         None)
+
+    def test_only_anchored_regexes_use_an_index(self):
+        import re
+        from trafmongo.indexes import (ensure_indexes, IndexChecker,
+                                       IndexCoverageError)
+        db = FakeDatabase()
+        ensure_indexes(db)
+        checker = IndexChecker(db, strict=True)
+        for condition in ({"$regex": " is at "}, re.compile(" is at "),
+                          {"$regex": "^00:13", "$options": "i"},
+                          re.compile("^00:13", re.IGNORECASE)):
+            self.assertRaises(IndexCoverageError, checker.check,
+                              "oth_sessionInfo", {"s": condition})
+        for condition in ({"$regex": "^00:13"}, re.compile("^00:13")):
+            self.assertEqual(checker.check("oth_sessionInfo",
+                                           {"s": condition}),
+                             [("s", 1), ("tbm", 1)])
+
+class StreamingTests(unittest.TestCase):
+    def test_gzipped_envelope_round_trips(self):
+        import gzip, json
+        from StringIO import StringIO
+        from trafmongo.arpgraph import ARPEdgeTable, iter_graph_json
+        from trafmongo.streaming import iter_envelope, streaming_json_response
+        table = ARPEdgeTable()
+        table.add("00:00:00:00:00:01", "00:00:00:00:00:02", 5)
+        table.flush()
+        chunks = iter_envelope(iter_graph_json(table), debug={"links": 1})
+
+        request = testing.DummyRequest(
+            headers={"Accept-Encoding": "deflate, gzip;q=0.5"})
+        response = streaming_json_response(request, chunks)
+        self.assertEqual(response.content_encoding, "gzip")
+        body = "".join(response.app_iter)
+        data = json.loads(gzip.GzipFile(fileobj=StringIO(body)).read())
+        self.assertEqual(data, {"data": table.to_graph(),
+                                "debug": {"links": 1}})
+
+    def test_accepts_gzip(self):
+        from trafmongo.streaming import accepts_gzip
+        def accepts(header):
+            return accepts_gzip(testing.DummyRequest(
+                headers={"Accept-Encoding": header}))
+        self.assertTrue(accepts("gzip"))
+        self.assertTrue(accepts("identity, *;q=0.1"))
+        self.assertFalse(accepts("gzip;q=0, deflate"))
+        self.assertFalse(accepts_gzip(testing.DummyRequest()))
+
+class ARPGraphDeltaTests(unittest.TestCase):
+    def _delta(self, results, versions, since=None):
+        from trafmongo.parse import ARPGraphDeltaParser
+        from trafmongo.arpgraph_commands import (ARPGraphCommand,
+                                                 ARPGraphDeltaCommandFactory)
+        get = {"frameStart": "1361917125000", "frameEnd": "1361939174000"}
+        if since is not None:
+            get["since"] = since
+        options = ARPGraphDeltaParser().parse(testing.DummyRequest(params=get))
+        options["db"] = FakeDatabase({ARPGraphCommand.COLLECTION:
+                                      FakeCollection(results)})
+        command = ARPGraphDeltaCommandFactory(options, versions,
+                                              cache=None).create_command()
+        command.execute()
+        return command.annotated_results
+
+    def test_changes_since_watermark(self):
+        from trafmongo.cache import ResultCache
+        versions = ResultCache()
+        ab = {"_id": {"a": "00:00:00:00:00:01", "b": "00:00:00:00:00:02"},
+              "pk": 5}
+        first = self._delta([ab], versions)
+        self.assertTrue(first["reset"])
+        self.assertEqual(first["links"]["added"], [
+            {"source": "00:00:00:00:00:01", "target": "00:00:00:00:00:02",
+             "value": 5}])
+
+        same = self._delta([ab], versions, first["watermark"])
+        self.assertFalse(same["reset"])
+        self.assertEqual(same["watermark"], first["watermark"])
+        self.assertEqual(same["links"],
+                         {"added": [], "removed": [], "changed": []})
+
+        ab2 = dict(ab, pk=7)
+        bc = {"_id": {"a": "00:00:00:00:00:02", "b": "00:00:00:00:00:03"},
+              "pk": 1}
+        later = self._delta([ab2, bc], versions, first["watermark"])
+        self.assertFalse(later["reset"])
+        self.assertEqual(later["nodes"],
+                         {"added": ["00:00:00:00:00:03"], "removed": []})
+        self.assertEqual(later["links"]["changed"], [
+            {"source": "00:00:00:00:00:01", "target": "00:00:00:00:00:02",
+             "value": 7, "delta": 2}])
+        self.assertEqual(len(later["links"]["added"]), 1)
+
+        unknown = self._delta([bc], versions, "0" * 40)
+        self.assertTrue(unknown["reset"])
+
+class ARPGraphLayoutTests(unittest.TestCase):
+    def _layout(self, results, layouts, params=None):
+        from trafmongo.parse import ARPGraphParser
+        from trafmongo.arpgraph_commands import (ARPGraphCommand,
+                                                 ARPGraphLayoutCommandFactory)
+        get = {"frameStart": "1361917125000", "frameEnd": "1361939174000"}
+        get.update(params or {})
+        options = ARPGraphParser().parse(testing.DummyRequest(params=get))
+        options["db"] = FakeDatabase({ARPGraphCommand.COLLECTION:
+                                      FakeCollection(results)})
+        command = ARPGraphLayoutCommandFactory(options, layouts,
+                                               cache=None).create_command()
+        command.execute()
+        return command
+
+    def test_layouts_are_cached_and_warm_started(self):
+        from trafmongo.cache import ResultCache
+        from trafmongo.arpgraph import int_to_mac
+        layouts = ResultCache()
+        results = [{"_id": {"a": int_to_mac(i), "b": int_to_mac(i + 1)},
+                    "pk": i} for i in range(1, 30)]
+        first = self._layout(results, layouts)
+        self.assertEqual(first.debug_info["layout"], "cold")
+        self.assertEqual(len(first.positions), 30)
+        for x, y in first.positions:
+            self.assertTrue(0 <= x <= 1 and 0 <= y <= 1)
+
+        again = self._layout(results, layouts)
+        self.assertEqual(again.debug_info["layout"], "cached")
+        self.assertEqual(again.positions, first.positions)
+
+        results.append({"_id": {"a": int_to_mac(30), "b": int_to_mac(31)},
+                        "pk": 1})
+        warm = self._layout(results, layouts)
+        self.assertEqual(warm.debug_info["layout"], "warm")
+        moved = max(abs(a - b) for old, new in zip(first.positions,
+                                                    warm.positions)
+                    for a, b in zip(old, new))
+        self.assertTrue(moved < 0.2)
+
+    def _results(self, count):
+        from trafmongo.arpgraph import int_to_mac
+        return [{"_id": {"a": int_to_mac(i), "b": int_to_mac(i + 1)},
+                 "pk": i} for i in range(1, count)]
+
+    def test_timeframes_keep_their_own_layouts(self):
+        from trafmongo.cache import ResultCache
+        layouts = ResultCache()
+        results = self._results(30)
+        first = self._layout(results, layouts)
+        other = self._layout(results, layouts, {"frameEnd": "1362939174000"})
+        self.assertEqual(other.debug_info["layout"], "warm")
+        again = self._layout(results, layouts)
+        self.assertEqual(again.debug_info["layout"], "cached")
+        self.assertEqual(again.positions, first.positions)
+
+    def test_big_graphs_are_left_to_the_client(self):
+        from trafmongo import layout
+        from trafmongo.cache import ResultCache
+        saved = layout.MAX_NODES
+        layout.MAX_NODES = 10
+        try:
+            command = self._layout(self._results(30), ResultCache())
+        finally:
+            layout.MAX_NODES = saved
+        self.assertEqual(command.debug_info["layout"], "too many nodes")
+        self.assertEqual(command.positions, None)
+
+    def test_layout_stops_when_out_of_time(self):
+        from trafmongo.arpgraph import ARPEdgeTable, int_to_mac
+        from trafmongo.arpgraph_commands import ARPGraphLayoutCommand
+        from trafmongo.cache import ResultCache
+
+        class LateGraph(object):
+            def __init__(self, remaining):
+                self.left = remaining
+                self.debug_info = {}
+                self.annotated_results = ARPEdgeTable()
+                self.annotated_results.add_all(
+                    [(int_to_mac(i), int_to_mac(i + 1), i)
+                     for i in range(1, 30)])
+
+            def execute(self):
+                pass
+
+            def remaining(self):
+                return self.left
+
+        layouts = ResultCache()
+        late = ARPGraphLayoutCommand(LateGraph(0), layouts, "key", (0, 900))
+        late.execute()
+        self.assertEqual(late.debug_info["layout"], "partial")
+        self.assertEqual(len(late.positions), 30)
+
+        # An unfinished layout is only used to start the next one from.
+        again = ARPGraphLayoutCommand(LateGraph(None), layouts, "key",
+                                      (0, 900))
+        again.execute()
+        self.assertEqual(again.debug_info["layout"], "warm")
+
+class CoarsenTests(unittest.TestCase):
+    def _table(self):
+        from trafmongo.arpgraph import ARPEdgeTable
+        table = ARPEdgeTable()
+        table.add_all([("00:00:0c:00:00:01", "00:00:0c:00:00:02", 5),
+                       ("00:00:0c:00:00:01", "00:1e:37:00:00:01", 3),
+                       ("00:1e:37:00:00:01", "00:1e:37:00:00:02", 7),
+                       ("00:1e:37:00:00:02", "bc:5f:f4:00:00:01", 1)])
+        return table
+
+    def test_oui_groups_and_expand(self):
+        from trafmongo.coarsen import coarsen, group_names
+        table = self._table()
+        groups = group_names(table, "oui")
+        graph = coarsen(table, groups)
+        self.assertEqual(graph["nodes"], [
+            {"name": "00:1e:37", "members": 2, "internal": 7},
+            {"name": "00:00:0c", "members": 2, "internal": 5},
+            {"name": "bc:5f:f4", "members": 1, "internal": 0}])
+        self.assertEqual(graph["links"], [
+            {"source": 0, "target": 1, "value": 3},
+            {"source": 0, "target": 2, "value": 1}])
+
+        expanded = coarsen(table, groups, expand="00:1e:37")
+        names = [node["name"] for node in expanded["nodes"]]
+        self.assertEqual(sorted(names), ["00:00:0c", "00:1e:37:00:00:01",
+                                         "00:1e:37:00:00:02", "bc:5f:f4"])
+
+        bounded = coarsen(table, groups, max_nodes=2)
+        self.assertEqual([(node["name"], node["members"])
+                          for node in bounded["nodes"]],
+                         [("00:1e:37", 2), ("other", 3)])
+
+    def test_subnets_from_replies(self):
+        from trafmongo.coarsen import addresses_from_messages, group_names
+        addresses = addresses_from_messages([
+            ("10.1.2.3 is at 00:00:0C:00:00:01", 4),
+            ("10.1.9.3 is at 00:00:0c:00:00:01", 1),
+            ("10.1.2.7 is at 00:00:0c:00:00:02", 1),
+            ("who-has 10.1.2.3 tell 10.1.2.7", 9)])
+        groups = group_names(self._table(), "subnet", addresses)
+        self.assertEqual(groups["00:00:0c:00:00:01"], "10.1.2.0/24")
+        self.assertEqual(groups["00:00:0c:00:00:02"], "10.1.2.0/24")
+        self.assertEqual(groups["bc:5f:f4:00:00:01"], "unknown")
+
+    def test_communities(self):
+        from trafmongo.coarsen import communities
+        groups = communities(self._table())
+        self.assertEqual(groups["00:00:0c:00:00:01"],
+                         groups["00:00:0c:00:00:02"])
+        self.assertEqual(groups["00:1e:37:00:00:01"],
+                         groups["00:1e:37:00:00:02"])
+
+class SleepCommand(object):
+    """
+    Takes a while, then hands back its value, or raises it if it's an
+    exception.
+    """
+    def __init__(self, value, seconds=0.2):
+        self.value = value
+        self.seconds = seconds
+        self.debug_info = {}
+
+    def execute(self):
+        import time
+        time.sleep(self.seconds)
+        if isinstance(self.value, Exception):
+            raise self.value
+        self.annotated_results = self.value
+
+class MultiCommandTests(unittest.TestCase):
+    def test_subcommands_run_concurrently(self):
+        import time
+        from trafmongo.commands import MultiCommand
+        command = MultiCommand({"subcommands": [SleepCommand(i)
+                                                for i in range(4)]})
+        started = time.time()
+        command.execute()
+        self.assertTrue(time.time() - started < 0.6)
+        self.assertEqual(command.annotated_results, [0, 1, 2, 3])
+
+        nested = MultiCommand({"subcommands": {
+            "a": MultiCommand({"subcommands": [SleepCommand(1, 0)] * 2}),
+            "b": SleepCommand(ValueError("b"), 0)}})
+        self.assertRaises(ValueError, nested.execute)
+
+    def test_poly_protocol_factory(self):
+        from trafmongo.commands import (CommandFactoryABS,
+                                        PolyProtocolCommandFactory)
+        from trafmongo.db_schema import (TCPTrafficSegment,
+                                         UDPTrafficSegment,
+                                         TrafficFilterList)
+        class Factory(CommandFactoryABS):
+            def create_command(self):
+                return SleepCommand(self._options["db_segment"].NAME, 0)
+        filters = {TCPTrafficSegment: TrafficFilterList(),
+                   UDPTrafficSegment: TrafficFilterList()}
+        command = PolyProtocolCommandFactory({"filters": filters},
+                                             Factory).create_command()
+        command.execute()
+        self.assertEqual(command.annotated_results,
+                         {"TCP": "TCP", "UDP": "UDP"})
+
+        # The request's budget covers the segments as a whole.
+        from trafmongo.profiling import Profiler
+        profiler = Profiler()
+        command = PolyProtocolCommandFactory(
+            {"filters": filters, "budget": 5, "allow_partial": True,
+             "profiler": profiler}, Factory).create_command()
+        self.assertTrue(0 < command.remaining() <= 5)
+        self.assertTrue(command.allow_partial)
+        self.assertTrue(command.profiler is profiler)
+
+class BudgetTests(unittest.TestCase):
+    def _command(self, results, **options):
+        from trafmongo.arpgraph_commands import ARPGraphCommand
+        from trafmongo.db_schema import InfoTimeframe
+        collection = FakeCollection(results)
+        options["db"] = FakeDatabase({ARPGraphCommand.COLLECTION: collection})
+        options["timeframe"] = InfoTimeframe(1361917125, 1361939174)
+        return ARPGraphCommand(options), collection
+
+    def test_budget_becomes_max_time(self):
+        command, collection = self._command([], budget=5)
+        command.execute()
+        self.assertTrue(0 < collection.kwargs["maxTimeMS"] <= 5000)
+        self.assertFalse(command.partial)
+
+    def test_timeouts_are_errors_or_partial_results(self):
+        from pymongo.errors import OperationFailure
+        from trafmongo.commands import CommandTimeout
+        timeout = OperationFailure("operation exceeded time limit", 50)
+        command, collection = self._command(timeout, budget=5)
+        self.assertRaises(CommandTimeout, command.execute)
+
+        command, collection = self._command(timeout, budget=5,
+                                            allow_partial=True)
+        command.execute()
+        self.assertTrue(command.partial)
+        self.assertEqual(command.annotated_results.link_count, 0)
+
+        # Out of time before starting: no query at all.
+        command, collection = self._command([], deadline=1,
+                                            allow_partial=True)
+        command.execute()
+        self.assertTrue(command.partial)
+        self.assertEqual(collection.pipelines, [])
+
+    def test_multicommand_deadline(self):
+        import time
+        from trafmongo.commands import MultiCommand, CommandTimeout
+        slow = [SleepCommand(0, 0), SleepCommand(1, 1)]
+        command = MultiCommand({"subcommands": slow, "budget": 0.2})
+        self.assertRaises(CommandTimeout, command.execute)
+
+        command = MultiCommand({"subcommands": slow, "budget": 0.2,
+                                "allow_partial": True})
+        started = time.time()
+        command.execute()
+        self.assertTrue(time.time() - started < 0.8)
+        self.assertTrue(command.partial)
+        self.assertEqual(command.annotated_results, [0, None])
+
+class ProfilingTests(unittest.TestCase):
+    def setUp(self):
+        self.config = testing.setUp(settings={"profile_on_request": True})
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def test_profiled_view(self):
+        import json
+        from trafmongo.api import ARPGraphView
+        from trafmongo.arpgraph_commands import ARPGraphCommand
+        request = testing.DummyRequest(params={
+            "frameStart": "1361917125000", "frameEnd": "1361939174000",
+            "profile": "1"})
+        request.index_checker = None
+        request.db = FakeDatabase({ARPGraphCommand.COLLECTION: FakeCollection(
+            [{"_id": {"a": "00:00:00:00:00:01", "b": "00:00:00:00:00:02"},
+              "pk": 5}])})
+        request.context = testing.DummyResource(db=request.db,
+                                                request=request)
+        response = ARPGraphView(request.context, request)
+        profile = json.loads("".join(response.app_iter))["debug"]["profile"]
+        self.assertEqual(sorted(profile["phases"]), [
+            "execute", "match", "parse", "post-process", "query",
+            "serialize"])
+        self.assertEqual(profile["queries"], [{
+            "collection": "fake", "index": "tbm_1_tem_1", "examined": 10,
+            "keys": 12, "returned": 8, "millis": 3, "results": 1}])
+
+    def test_legacy_explain_and_sampling(self):
+        from trafmongo.profiling import (summarize_explain, profiler_for,
+                                         NULL_PROFILER)
+        self.assertEqual(summarize_explain({
+            "cursor": "BasicCursor", "nscannedObjects": 100,
+            "nscanned": 100, "n": 3, "millis": 40}),
+            {"index": None, "examined": 100, "keys": 100, "returned": 3,
+             "millis": 40})
+        request = testing.DummyRequest()
+        self.assertTrue(profiler_for(request) is NULL_PROFILER)
+        self.assertTrue(profiler_for(request, 0.5, lambda: 0.25).enabled)
+
+        # Asking only works where it's been turned on.
+        asking = testing.DummyRequest(params={"profile": "1"})
+        self.assertTrue(profiler_for(asking) is NULL_PROFILER)
+        self.assertTrue(profiler_for(asking, on_request=True).enabled)
+
+    def test_explains_are_given_the_time_left(self):
+        from trafmongo.profiling import Profiler
+        cursors = []
+        class Collection(FakeCollection):
+            def find(self, spec):
+                cursors.append(FakeCursor(spec))
+                return cursors[-1]
+        entry = Profiler().query(Collection(), {"tb": 1}, 2.5)
+        self.assertEqual(cursors[0].max_time, 2500)
+        self.assertEqual(entry["index"], "tbm_1_tem_1")
+
+class SingleFlightTests(unittest.TestCase):
+    def _run_together(self, functions):
+        import threading
+        threads = [threading.Thread(target=function) for function in functions]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def test_concurrent_misses_share_one_execution(self):
+        from trafmongo.cache import ResultCache, SingleFlight
+        from trafmongo.commands import CachedCommand
+        cache = ResultCache()
+        flights = SingleFlight()
+        commands = [CachedCommand(SleepCommand("graph", 0.3), cache, "key",
+                                  flights=flights) for i in range(5)]
+        self._run_together([command.execute for command in commands])
+
+        self.assertEqual([command.annotated_results for command in commands],
+                         ["graph"] * 5)
+        self.assertEqual(cache.stats()["misses"], 5)
+        self.assertEqual(flights.coalesced, 4)
+        self.assertEqual(len([command for command in commands
+                              if command.debug_info["cache"]["coalesced"]]), 4)
+
+    def test_coalesced_across_workers(self):
+        import shutil
+        import tempfile
+        from trafmongo.cache import SingleFlight, JSONCodec
+        lock_dir = tempfile.mkdtemp()
+        try:
+            calls = []
+            def query():
+                calls.append(1)
+                SleepCommand(None, 0.3).execute()
+                return {"nodes": len(calls)}
+
+            # Two workers, which only share the directory.
+            workers = [SingleFlight(lock_dir), SingleFlight(lock_dir)]
+            results = []
+            self._run_together([
+                lambda worker=worker: results.append(
+                    worker.run("key", query, codec=JSONCodec()))
+                for worker in workers])
+
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(sorted(shared for result, shared in results),
+                             [False, True])
+            self.assertEqual([result for result, shared in results],
+                             [{"nodes": 1}] * 2)
+        finally:
+            shutil.rmtree(lock_dir)
+
+    def test_only_identical_keys_wait_across_workers(self):
+        import shutil
+        import tempfile
+        import time
+        from trafmongo.cache import SingleFlight, JSONCodec
+        lock_dir = tempfile.mkdtemp()
+        try:
+            def query():
+                time.sleep(0.3)
+                return 1
+            workers = [SingleFlight(lock_dir), SingleFlight(lock_dir)]
+            started = time.time()
+            self._run_together([
+                lambda worker=worker, key=key: worker.run(key, query,
+                                                          JSONCodec())
+                for worker, key in zip(workers, ["first", "second"])])
+            self.assertTrue(time.time() - started < 0.5)
+        finally:
+            shutil.rmtree(lock_dir)
+
+    def test_waiting_is_bounded_by_the_callers_deadline(self):
+        import shutil
+        import tempfile
+        import time
+        from trafmongo.cache import SingleFlight, JSONCodec, FlightTimeout
+        flights = SingleFlight()
+        errors = []
+        def follow():
+            time.sleep(0.05)
+            started = time.time()
+            try:
+                flights.run("key", lambda: 2, remaining=0.1)
+            except FlightTimeout:
+                errors.append(time.time() - started)
+        self._run_together([
+            lambda: flights.run("key", lambda: time.sleep(0.5)), follow])
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0] < 0.3)
+
+        # A worker whose call failed leaves nothing to wait for; the others
+        # give up rather than run it again in turn.
+        lock_dir = tempfile.mkdtemp()
+        try:
+            calls = []
+            def fail():
+                calls.append(1)
+                time.sleep(0.3)
+                raise ValueError("No time left")
+            def lead():
+                try:
+                    SingleFlight(lock_dir).run("key", fail, JSONCodec(), 5)
+                except ValueError:
+                    pass
+            def late():
+                time.sleep(0.05)
+                try:
+                    SingleFlight(lock_dir).run("key", fail, JSONCodec(), 5)
+                except FlightTimeout:
+                    errors.append(None)
+            self._run_together([lead, late])
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(errors[-1], None)
+        finally:
+            shutil.rmtree(lock_dir)
+
+    def test_partial_results_only_go_to_callers_that_take_them(self):
+        from trafmongo.cache import ResultCache, SingleFlight
+        from trafmongo.commands import CachedCommand
+        cache = ResultCache()
+        flights = SingleFlight()
+        commands = []
+        for allow_partial in (True, False):
+            command = SleepCommand("graph", 0.3)
+            command.allow_partial = allow_partial
+            commands.append(CachedCommand(command, cache, "key",
+                                          flights=flights))
+        self._run_together([command.execute for command in commands])
+        self.assertEqual(flights.coalesced, 0)
+
+    def test_lock_dir_must_be_private(self):
+        import os
+        import shutil
+        import tempfile
+        from trafmongo.cache import private_directory
+        parent = tempfile.mkdtemp()
+        try:
+            path = os.path.join(parent, "coalesce")
+            self.assertEqual(private_directory(path), path)
+            self.assertEqual(os.stat(path).st_mode & 0777, 0700)
+            os.chmod(path, 0777)
+            self.assertRaises(ValueError, private_directory, path)
+            os.symlink(parent, path + "-link")
+            self.assertRaises(ValueError, private_directory, path + "-link")
+        finally:
+            shutil.rmtree(parent)
+
+    def test_graph_results_cross_workers_without_pickles(self):
+        from StringIO import StringIO
+        from trafmongo.arpgraph import ARPEdgeTable
+        from trafmongo.arpgraph_commands import ARPGraphResultCodec
+        table = ARPEdgeTable()
+        table.add_all([("00:00:00:00:00:02", "00:00:00:00:00:01", 3)])
+        codec = ARPGraphResultCodec()
+        stream = StringIO()
+        codec.dump((table, {"nodes": 2}, False), stream)
+        stream.seek(0)
+        copy, debug_info, partial = codec.load(stream)
+        self.assertEqual(copy.link_weights(), table.link_weights())
+        self.assertEqual((debug_info, partial), ({"nodes": 2}, False))
+
+class MatchPlanTests(unittest.TestCase):
+    def test_filters_and_match_documents_are_reused(self):
+        from trafmongo.parse import ARPGraphParser
+        from trafmongo.db_schema import InfoTimeframe, OtherTrafficSegment
+        def parse():
+            request = testing.DummyRequest(params={
+                "frameStart": "1361917125000", "frameEnd": "1361939174000",
+                "filters": '[{"positive": true, "s": "00:01"}]'})
+            return ARPGraphParser().parse(request)
+
+        first = parse()["filters"][OtherTrafficSegment]
+        second = parse()["filters"][OtherTrafficSegment]
+        self.assertTrue(first is second)
+
+        plan = first.match_plan()
+        self.assertTrue(second.match_plan() is plan)
+        timeframe = InfoTimeframe(1361917125, 1361939174)
+        self.assertEqual(plan.to_match_doc(timeframe), {"$and": [
+            timeframe.to_match_doc()] + first.to_match_doc()["$and"]})
+        self.assertEqual(len(plan.to_match_doc(timeframe)["$and"]), 2)
+        self.assertEqual(len(plan.ands), 1)
+
+class AddressRangeTests(unittest.TestCase):
+    def test_interval_arithmetic(self):
+        from trafmongo.db_schema import (merge_intervals, subtract_intervals,
+                                         complement_intervals, IPV4_MAX)
+        self.assertEqual(merge_intervals([(10, 19), (0, 4), (5, 7), (15, 30)]),
+                         [(0, 7), (10, 30)])
+        self.assertEqual(subtract_intervals([(0, 100)], [(10, 19), (50, 200)]),
+                         [(0, 9), (20, 49)])
+        self.assertEqual(complement_intervals([(0, 9)]), [(10, IPV4_MAX)])
+
+    def test_subnets_become_one_or_per_field(self):
+        from trafmongo.db_schema import TrafficFilterList, TCPTrafficFilter
+        ten = 10 << 24
+        filters = TrafficFilterList(
+            [TCPTrafficFilter({"s": [ten, 8], "p2": 80})] +
+            # Adjacent /24s, which merge into one hole.
+            [TCPTrafficFilter({"s": [ten + (i << 8), 24], "positive": False})
+             for i in range(50)] +
+            [TCPTrafficFilter({"s": [ten + (100 << 8), 24], "d": [ten, 16],
+                               "positive": False})])
+        doc = filters.to_match_doc()
+        self.assertEqual(doc, {"$and": [
+            {"$or": [{"ip1": {"$gte": ten + (50 << 8),
+                              "$lte": ten + (100 << 8) - 1}},
+                     {"ip1": {"$gte": ten + (101 << 8),
+                              "$lte": ten + (1 << 24) - 1}}]},
+            {"$or": [{"ip2": {"$gte": 0, "$lte": ten - 1}},
+                     {"ip2": {"$gte": ten + (1 << 16),
+                              "$lte": 2 ** 32 - 1}}]},
+            {"p2": 80}]})
+
+        # A negated source and destination used to overwrite one another.
+        alone = filters[-1].to_match_doc()
+        self.assertEqual(sorted(alone), ["$and"])
+        self.assertEqual(len(alone["$and"]), 2)
+
+    def test_overlapping_negative_subnets_are_merged(self):
+        from trafmongo.db_schema import AddressRanges, TCPTrafficFilter
+        ten = 10 << 24
+        sixteen = TCPTrafficFilter({"s": [ten, 16], "positive": False})
+        inside = TCPTrafficFilter({"s": [ten + (5 << 8), 24],
+                                   "positive": False})
+        expected = AddressRanges([sixteen]).allowed
+        self.assertEqual(expected, {"ip1": [(0, ten - 1),
+                                            (ten + (1 << 16), 2 ** 32 - 1)]})
+        self.assertEqual(AddressRanges([sixteen, inside]).allowed, expected)
+        self.assertEqual(AddressRanges([inside, sixteen]).allowed, expected)
+
+class FilterEvaluatorTests(unittest.TestCase):
+    def test_matches_mongo_semantics(self):
+        import numpy
+        from trafmongo.db_schema import (TrafficFilterList, TCPTrafficFilter,
+                                         OtherTrafficFilter, InfoTimeframe)
+        from trafmongo.evaluate import FilterEvaluator
+        ten = 10 << 24
+        batch = {
+            "ip1": numpy.array([ten + 1, ten + 300, ten + 1, 5, ten + 2],
+                               dtype=numpy.uint32),
+            "p2": numpy.array([80, 80, 22, 80, 80], dtype=numpy.uint16),
+            "tb": numpy.array([0, 10, 10, 10, 500], dtype=numpy.float64),
+            "te": numpy.array([5, 20, 20, 20, 600], dtype=numpy.float64),
+        }
+        filters = TrafficFilterList([
+            TCPTrafficFilter({"s": [ten, 8], "p2": 80}),
+            TCPTrafficFilter({"s": [ten + 256, 24], "positive": False})])
+        evaluator = FilterEvaluator(filters, InfoTimeframe(10, 100))
+        self.assertEqual(evaluator.mask(batch).tolist(),
+                         [False, False, False, False, False])
+        evaluator = FilterEvaluator(filters, InfoTimeframe(1, 1000))
+        self.assertEqual(evaluator.mask(batch).tolist(),
+                         [True, False, False, False, True])
+        self.assertEqual(evaluator.apply(batch)["tb"].tolist(), [0, 500])
+
+        # Missing fields match negations only, as in mongo.
+        self.assertEqual(FilterEvaluator(TrafficFilterList(
+            [OtherTrafficFilter({"m": "x", "positive": False})])).mask(
+                batch).tolist(), [True] * 5)
+        self.assertEqual(FilterEvaluator(TrafficFilterList(
+            [OtherTrafficFilter({"m": "x"})])).mask(batch).tolist(),
+            [False] * 5)
+
+class TierPlannerTests(unittest.TestCase):
+    def test_long_timeframes_use_coarse_tiers_in_the_middle(self):
+        from trafmongo.db_schema import (plan_tiers, Timeframe,
+                                         TCPTrafficSegment, TrafficFilterList,
+                                         TCPTrafficFilter)
+        start = 1361917125
+        week = Timeframe(start, start + 7 * 24 * 60 * 60)
+        plan = [(collection, type(timeframe).__name__, timeframe.start,
+                 timeframe.end) for collection, timeframe in
+                plan_tiers(TCPTrafficSegment, week, bucket_size=600)]
+        self.assertEqual(plan, [
+            ("tcp_sessionBytes", "BytesTimeframe", start, 1361917800),
+            ("tcp_sessionGroups", "GroupsTimeframe", 1361917800, 1361923200),
+            ("tcp_sessionGroups2", "Groups2Timeframe", 1361923200,
+             1362517200),
+            ("tcp_sessionGroups", "GroupsTimeframe", 1362517200, 1362521700),
+            ("tcp_sessionBytes", "BytesTimeframe", 1362521700, 1362521925)])
+
+        # Too fine a pitch for groups2; a filter on what rollups lose.
+        self.assertEqual(set(collection for collection, timeframe in
+                             plan_tiers(TCPTrafficSegment, week, 60)),
+                         set(["tcp_sessionBytes", "tcp_sessionGroups"]))
+        filters = TrafficFilterList([TCPTrafficFilter({"p1": 1234})])
+        self.assertEqual([collection for collection, timeframe in
+                          plan_tiers(TCPTrafficSegment, week, 600, filters)],
+                         ["tcp_sessionBytes"])
+
+    def test_pitches_must_divide_the_bucket_size(self):
+        from trafmongo.db_schema import (usable_tiers, plan_tiers, Timeframe,
+                                         TCPTrafficSegment)
+        tiers = lambda bucket_size: [name for name, pitch, duration, cls in
+                                     usable_tiers(TCPTrafficSegment,
+                                                  bucket_size)]
+        # 20 seconds is coarser than groups' 15, but not a multiple of it.
+        self.assertEqual(tiers(20), ["bytes"])
+        self.assertEqual(tiers(30), ["bytes", "groups"])
+        self.assertEqual(tiers(180), ["bytes", "groups"])
+        self.assertEqual(tiers(240), ["bytes", "groups", "groups2"])
+
+        start = 1361917125
+        day = Timeframe(start, start + 24 * 60 * 60)
+        self.assertEqual(set(collection for collection, timeframe in
+                             plan_tiers(TCPTrafficSegment, day, 20)),
+                         set(["tcp_sessionBytes"]))
+        self.assertRaises(ValueError, plan_tiers, TCPTrafficSegment, day, 0.5)
+
+class TimeseriesTests(unittest.TestCase):
+    def test_rebinning_with_partial_overlap(self):
+        from trafmongo.db_schema import Timeframe
+        from trafmongo.timeseries import Samples, rebin, to_json
+        # 15 second samples from a groups document, and 1 second ones from
+        # a bytes document.
+        groups = Samples.from_documents(
+            [{"tbm": 900, "b": [[0, 30, 3], [1, 60, 6], [3, 15, 0]]}],
+            15, "tbm")
+        seconds = Samples.from_documents(
+            [{"sb": 950, "b": [[0, 5, 1], [9, 5, 1]]}, {"sb": 961}], 1, "sb")
+        samples = Samples.concatenate([groups, seconds])
+
+        timeframe = Timeframe(910, 970)
+        sums = rebin(samples, timeframe, 20)
+        # Two thirds of the first sample are before the timeframe, and the
+        # third straddles the last two buckets.
+        self.assertEqual(sums.tolist(), [[10 + 60, 1 + 6], [5, 0],
+                                         [10 + 5 + 5, 1 + 1]])
+        self.assertEqual(rebin(samples, timeframe, 20, 'max').tolist(),
+                         [[60, 6], [15, 0], [15, 1]])
+        self.assertEqual(rebin(samples, timeframe, 20, 'rate')[0].tolist(),
+                         [3.5, 0.35])
+        self.assertEqual(to_json(sums[:1], timeframe, 20),
+                         {"start": 910, "pitch": 20, "values": [[70, 7]]})
+        self.assertRaises(ValueError, rebin, samples, timeframe, 10)
+
+class ShardedQueryTests(unittest.TestCase):
+    def test_split_timeframes_partition_records(self):
+        from trafmongo.db_schema import (split_timeframe, InfoTimeframe,
+                                         InfoStartTimeframe, GroupsTimeframe)
+        pieces = split_timeframe(InfoTimeframe(1000, 10000), 4)
+        self.assertEqual([(type(piece), piece.start, piece.end)
+                          for piece in pieces],
+                         [(InfoTimeframe, 1000, 3600),
+                          (InfoStartTimeframe, 3600, 6300),
+                          (InfoStartTimeframe, 6300, 9000),
+                          (InfoStartTimeframe, 9000, 10000)])
+        self.assertEqual(len(split_timeframe(GroupsTimeframe(900, 1800), 4)),
+                         1)
+
+    def test_chunks_are_merged_in_order(self):
+        from trafmongo.arpgraph_commands import ARPGraphCommand
+        from trafmongo.db_schema import InfoTimeframe
+        collection = FakeCollection(
+            [{"_id": {"a": "00:00:00:00:00:01", "b": "00:00:00:00:00:02"},
+              "pk": 5}])
+        command = ARPGraphCommand({
+            "db": FakeDatabase({ARPGraphCommand.COLLECTION: collection}),
+            "timeframe": InfoTimeframe(1361917125, 1361939174),
+            "shards": 4})
+        weights = [table.link_weights().values()
+                   for table in command.iter_partials()]
+        # Every chunk gets the same edge back from the fake.
+        self.assertEqual(command.debug_info["shards"], 4)
+        self.assertEqual(weights, [[5], [10], [15], [20]])
+        ends = sorted(pipeline[0]["$match"]["$and"][0]["tb"]["$lt"]
+                      for pipeline in collection.pipelines)
+        self.assertEqual(ends, [1361923200, 1361929500, 1361935800,
+                                1361939174])
+
+class DataToUsageTests(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def _path(self, name):
+        import os
+        return os.path.join(self.directory, name)
+
+    def _records(self, count, seed=0):
+        import random
+        rng = random.Random(seed)
+        records = []
+        for i in xrange(count):
+            tb = 1361917125 + rng.randint(0, 3600)
+            records.append({"s": "00:00:00:00:00:%02x" % rng.randint(1, 20),
+                            "d": "00:00:00:00:00:%02x" % rng.randint(1, 20),
+                            "m": "192.168.168.1 is at 00:13:10:1a:a2:88",
+                            "pk": rng.randint(1, 400),
+                            "tb": tb + 0.25,
+                            "te": tb + rng.randint(0, 600) + 0.5})
+        return records
+
+    def _capture(self, name, records, final_newline=True):
+        import json
+        filename = self._path(name)
+        capture = open(filename, 'ab')
+        lines = [json.dumps(record) for record in records]
+        capture.write('\n'.join(lines))
+        if lines and final_newline:
+            capture.write('\n')
+        capture.close()
+        return filename
+
+    def _run(self, *argv):
+        import json
+        from DataToUsage import main
+        output = self._path("graph.json")
+        main(["-o", output] + list(argv))
+        return json.load(open(output))
+
+    def _links(self, graph):
+        """
+        The graph's links by name, which doesn't depend on node numbering.
+        """
+        names = [node["name"] for node in graph["nodes"]]
+        return dict((tuple(sorted((names[link["source"]],
+                                   names[link["target"]]))), link["value"])
+                    for link in graph["links"])
+
+    def _whole_file_links(self, records):
+        # What the original script worked out, with the whole file in memory.
+        links = {}
+        for record in records:
+            key = tuple(sorted((record["d"], record["s"])))
+            links[key] = links.get(key, 0) + record["pk"]
+        return links
+
+    def test_streaming_matches_whole_file(self):
+        records = self._records(500)
+        capture = self._capture("capture.json", records, final_newline=False)
+        for chunk_size in ("7", "4096"):
+            graph = self._run("--chunk-size", chunk_size, capture)
+            self.assertEqual(self._links(graph),
+                             self._whole_file_links(records))
+            self.assertEqual(len(graph["nodes"]),
+                             len(set([r["s"] for r in records] +
+                                     [r["d"] for r in records])))
+
+    def test_lines_split_across_chunks(self):
+        from StringIO import StringIO
+        from DataToUsage import iter_lines
+        text = "first\nsecond line\n\nlast"
+        for chunk_size in (1, 3, 100):
+            self.assertEqual(list(iter_lines(StringIO(text), chunk_size)),
+                             ["first", "second line", "", "last"])
+        self.assertEqual(list(iter_lines(StringIO(text), 4, length=13)),
+                         ["first", "second "])
+
+    def test_shards_start_on_lines_and_cover_the_file(self):
+        import os
+        from DataToUsage import split_file
+        capture = self._capture("capture.json", self._records(100))
+        shards = split_file(capture, 1000)
+        self.assertTrue(len(shards) > 1)
+        data = open(capture, 'rb').read()
+        offset = 0
+        for filename, start, length in shards:
+            self.assertEqual(start, offset)
+            self.assertTrue(start == 0 or data[start - 1] == '\n')
+            offset += length
+        self.assertEqual(offset, os.path.getsize(capture))
+
+    def test_sharded_build_merges_to_serial(self):
+        first = self._capture("first.json", self._records(300, 1))
+        second = self._capture("second.json", self._records(300, 2),
+                               final_newline=False)
+        serial = self._run(first, second)
+        sharded = self._run("--jobs", "3", "--shard-size", "1000",
+                            first, second)
+        self.assertEqual(sharded, serial)
+
+    def test_resuming_from_state_counts_each_line_once(self):
+        import json
+        records = self._records(300, 3)
+        state = self._path("state")
+        capture = self._capture("capture.json", records[:100])
+
+        graph = self._run("--state", state, capture)
+        self.assertEqual(self._links(graph),
+                         self._whole_file_links(records[:100]))
+
+        # A line still being written is left for the next run.
+        line = json.dumps(records[200])
+        self._capture("capture.json", records[100:200])
+        partial = open(capture, 'ab')
+        partial.write(line[:len(line) // 2])
+        partial.close()
+        graph = self._run("--state", state, capture)
+        self.assertEqual(self._links(graph),
+                         self._whole_file_links(records[:200]))
+
+        partial = open(capture, 'ab')
+        partial.write(line[len(line) // 2:] + '\n')
+        partial.close()
+        graph = self._run("--state", state, capture)
+        self.assertEqual(self._links(graph),
+                         self._whole_file_links(records[:201]))
+
+        # Nothing new: nothing changes.
+        self.assertEqual(self._run("--state", state, capture), graph)
+
+        self._capture("capture.json", records[201:])
+        graph = self._run("--state", state, capture)
+        self.assertEqual(self._links(graph), self._whole_file_links(records))
+        self.assertEqual(graph, self._run(capture))
+
+    def test_window_edges(self):
+        from DataToUsage import WindowedGraphs
+        tumbling = WindowedGraphs(10)
+        self.assertEqual(list(tumbling.windows(0, 9.5)), [0])
+        # Ending on a window's start overlaps it; beginning on a window's end
+        # doesn't.
+        self.assertEqual(list(tumbling.windows(5, 10)), [0, 1])
+        self.assertEqual(list(tumbling.windows(10, 10)), [1])
+        self.assertEqual(list(tumbling.windows(9.99, 30)), [0, 1, 2, 3])
+
+        sliding = WindowedGraphs(10, 5)
+        self.assertEqual(list(sliding.windows(12, 12)), [1, 2])
+        self.assertEqual(list(sliding.windows(10, 10)), [1, 2])
+
+        # Windows further apart than they are long leave gaps.
+        gaps = WindowedGraphs(5, 10)
+        self.assertEqual(list(gaps.windows(6, 7)), [])
+        self.assertEqual(list(gaps.windows(4, 7)), [0])
+
+        self.assertRaises(ValueError, WindowedGraphs, 0)
+        self.assertRaises(ValueError, WindowedGraphs, 10, -5)
+
+    def test_windows_match_filtering_each_window(self):
+        records = self._records(300, 4)
+        capture = self._capture("capture.json", records)
+        windows = self._run("--window", "900", "--slide", "300", capture)
+        self.assertTrue(len(windows) > 1)
+        for graph in windows:
+            start, end = graph["start"], graph["end"]
+            self.assertEqual(end - start, 900)
+            self.assertEqual(self._links(graph), self._whole_file_links(
+                [record for record in records
+                 if record["tb"] < end and record["te"] >= start]))
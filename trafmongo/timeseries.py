@@ -0,0 +1,172 @@
+# timeseries.py
+#
+# Turns stored traffic samples into the buckets a client asked for.
+#
+# Documents in every tier (see db_schema.TIERS) hold their traffic as an
+# array, b, of [offset, client bytes, server bytes] samples, where a sample
+# covers the tier's pitch starting offset pitches after the document's start
+# time (sb for bytes, tbm for the rollups).  Samples from any number of
+# documents, and tiers, are loaded into NumPy arrays (Samples), then summed,
+# maxed or turned into rates per bucket, with bincount and maximum.reduceat
+# rather than a python loop per document.
+#
+# A sample that's only partly inside the timeframe, or that straddles two
+# buckets, counts in proportion to its overlap with each: rates and sums are
+# spread evenly across a sample.  Maximums count a sample in every bucket it
+# touches.  Buckets are never narrower than samples, so a sample touches at
+# most two of them.
+
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from trafmongo.db_schema import HotDataFormat as HDF
+
+AGGREGATIONS = ('sum', 'max', 'rate')
+
+# The columns of each sample kept by default.
+COLUMNS = (HDF.TRAFFIC_CLIENT, HDF.TRAFFIC_SERVER)
+
+class Samples(object):
+    """
+    Parallel arrays describing samples: where each starts and ends (in
+    seconds), its full width, before any clipping, and its values, a row per
+    sample and a column per value.
+    """
+    def __init__(self, starts, ends, widths, values):
+        self.starts = starts
+        self.ends = ends
+        self.widths = widths
+        self.values = values
+
+    def __len__(self):
+        return len(self.starts)
+
+    @classmethod
+    def empty(cls, columns=len(COLUMNS)):
+        nothing = numpy.zeros(0, dtype=numpy.float64)
+        return cls(nothing, nothing, nothing,
+                   numpy.zeros((0, columns), dtype=numpy.float64))
+
+    @classmethod
+    def from_documents(cls, documents, pitch, time_field, field=HDF.TRAFFIC,
+                       columns=COLUMNS):
+        """
+        Loads the samples from documents of one tier: pitch is the tier's
+        data pitch, and time_field the field documents start at.
+        """
+        doc_starts = []
+        counts = []
+        arrays = []
+        for document in documents:
+            samples = document.get(field)
+            if not samples:
+                continue
+            doc_starts.append(document[time_field])
+            counts.append(len(samples))
+            arrays.append(numpy.asarray(samples, dtype=numpy.float64))
+        if not arrays:
+            return cls.empty(len(columns))
+
+        table = numpy.concatenate(arrays)
+        starts = numpy.repeat(numpy.asarray(doc_starts, dtype=numpy.float64),
+                              counts)
+        starts += table[:, HDF.TRAFFIC_OFFSET] * pitch
+        widths = numpy.empty(len(starts), dtype=numpy.float64)
+        widths.fill(pitch)
+        return cls(starts, starts + widths, widths, table[:, list(columns)])
+
+    @classmethod
+    def concatenate(cls, all_samples):
+        """
+        Puts the samples from several tiers (or plan pieces) together.
+        """
+        all_samples = list(all_samples)
+        if not all_samples:
+            return cls.empty()
+        return cls(*[numpy.concatenate([getattr(samples, name)
+                                        for samples in all_samples])
+                     for name in ('starts', 'ends', 'widths', 'values')])
+
+    def clip(self, timeframe):
+        """
+        Returns the samples overlapping timeframe, cut down to it.  Bytes
+        documents overlapping a plan piece are read whole, so clip each
+        piece's samples to it before putting pieces together.
+        """
+        keep = (self.ends > timeframe.start) & (self.starts < timeframe.end)
+        return Samples(numpy.maximum(self.starts[keep], timeframe.start),
+                       numpy.minimum(self.ends[keep], timeframe.end),
+                       self.widths[keep], self.values[keep])
+
+def bucket_edges(timeframe, bucket_size):
+    """
+    Returns the edges of timeframe's buckets, the last bucket cut short at
+    the end of the timeframe.
+    """
+    count = int(math.ceil(timeframe.duration / float(bucket_size)))
+    edges = timeframe.start + numpy.arange(count + 1, dtype=numpy.float64) \
+            * bucket_size
+    edges[-1] = min(edges[-1], timeframe.end)
+    return edges
+
+def rebin(samples, timeframe, bucket_size, how='sum'):
+    """
+    Returns an array of a row per bucket of bucket_size seconds over
+    timeframe, and a column per value: the sum of the samples in it, their
+    maximum, or their rate (the sum per second).
+    """
+    if how not in AGGREGATIONS:
+        raise ValueError("Can't aggregate by " + repr(how))
+    samples = samples.clip(timeframe)
+    if len(samples) and samples.widths.max() > bucket_size:
+        raise ValueError("Buckets can't be narrower than the samples")
+
+    edges = bucket_edges(timeframe, bucket_size)
+    count = len(edges) - 1
+    result = numpy.zeros((count, samples.values.shape[1]),
+                         dtype=numpy.float64)
+    if not len(samples):
+        return result
+
+    # The bucket each sample starts in, and how much of it spills into the
+    # next.
+    first = ((samples.starts - timeframe.start) // bucket_size).astype(
+        numpy.intp)
+    boundary = edges[first + 1]
+    head = numpy.minimum(samples.ends, boundary) - samples.starts
+    tail = samples.ends - boundary
+    spills = tail > 0
+    index = numpy.concatenate([first, first[spills] + 1])
+    values = numpy.concatenate([samples.values, samples.values[spills]])
+
+    if how == 'max':
+        order = numpy.argsort(index, kind='mergesort')
+        index = index[order]
+        values = values[order]
+        runs = numpy.flatnonzero(numpy.concatenate(
+            [[True], index[1:] != index[:-1]]))
+        result[index[runs]] = numpy.maximum.reduceat(values, runs, axis=0)
+        return result
+
+    share = numpy.concatenate([head / samples.widths,
+                               tail[spills] / samples.widths[spills]])
+    values = values * share[:, numpy.newaxis]
+    for column in xrange(values.shape[1]):
+        result[:, column] = numpy.bincount(index, weights=values[:, column],
+                                           minlength=count)[:count]
+    if how == 'rate':
+        result /= numpy.diff(edges)[:, numpy.newaxis]
+    return result
+
+def to_json(series, timeframe, bucket_size):
+    """
+    The compact form for responses: where the buckets start and how wide
+    they are, and a row of values per bucket, rather than a time with every
+    value.
+    """
+    return {"start": timeframe.start, "pitch": bucket_size,
+            "values": series.tolist()}